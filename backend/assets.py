@@ -0,0 +1,115 @@
+import os, gzip, threading, argparse
+from pathlib import Path
+
+try:
+	import brotli # optional, only needed for brotli variants.
+except ImportError:
+	brotli = None
+
+# Backend code:
+import loader
+
+
+# Static assets served by the backend, e.g the files of libs-frontend/. Compressible files get precompressed
+# variants, saved in 'precompressedDir' with the same relative path and an encoding suffix. A variant is only
+# served while it is newer than its file, and the best variant accepted by the client is chosen, in the order
+# of 'encodingsSuffixes'. Brotli variants require the 'brotli' package, gzip ones are always available.
+precompressedDir = loader.cacheDir / 'precompressed'
+encodingsSuffixes = {'br': '.br', 'gzip': '.gz'} # by order of preference.
+compressibleExtensions = {'.js', '.css', '.html', '.json', '.svg', '.txt', '.md', '.map'}
+precompressionMinSize = 1024 # in bytes, smaller files are not worth it.
+assetsCacheTimeout = 365 * 24 * 3600 # in seconds. Files are still revalidated with their ETag once expired.
+
+
+def getVariantPath(rootDir, relativePath, encoding):
+	return precompressedDir / Path(rootDir).name / (str(relativePath) + encodingsSuffixes[encoding])
+
+
+def isCompressible(path):
+	return path.suffix in compressibleExtensions and path.stat().st_size >= precompressionMinSize
+
+
+def compress(content, encoding):
+	if encoding == 'br':
+		return brotli.compress(content, quality=11)
+	return gzip.compress(content, compresslevel=9, mtime=0) # same variant on each build.
+
+
+def getAvailableEncodings():
+	return [ encoding for encoding in encodingsSuffixes if encoding != 'br' or brotli is not None ]
+
+
+# Builds the missing or outdated variants of a file. Written atomically, for a variant to never be served partially.
+def precompressFile(rootDir, relativePath):
+	path = Path(rootDir) / relativePath
+	builtNumber = 0
+	for encoding in getAvailableEncodings():
+		variantPath = getVariantPath(rootDir, relativePath, encoding)
+		if variantPath.exists() and variantPath.stat().st_mtime_ns >= path.stat().st_mtime_ns:
+			continue
+		os.makedirs(variantPath.parent, exist_ok=True)
+		tempPath = variantPath.with_name(variantPath.name + '.tmp')
+		with open(path, 'rb') as file:
+			content = compress(file.read(), encoding)
+		with open(tempPath, 'wb') as file:
+			file.write(content)
+		os.replace(tempPath, variantPath)
+		builtNumber += 1
+	return builtNumber
+
+
+# Builds the variants of all compressible files of the given directory, and of its sub directories:
+def precompressDir(rootDir):
+	builtNumber = 0
+	for dirPath, dirNames, fileNames in os.walk(rootDir):
+		for fileName in fileNames:
+			path = Path(dirPath) / fileName
+			if isCompressible(path):
+				builtNumber += precompressFile(rootDir, path.relative_to(rootDir))
+	print('Built %d precompressed variants for: %s' % (builtNumber, rootDir))
+	return builtNumber
+
+
+# Same as precompressDir(), in a background thread. Files are served uncompressed until their variants are built.
+def startPrecompression(rootDir):
+	threading.Thread(target=precompressDir, args=(rootDir,), daemon=True).start()
+
+
+# Returns the path of the file to send and its encoding: either the best up to date variant accepted by the
+# client, or the file itself with a None encoding. 'acceptedEncodings' is the request werkzeug Accept object.
+def getServedFile(rootDir, relativePath, acceptedEncodings):
+	path = Path(rootDir) / relativePath
+	fileTime = path.stat().st_mtime_ns # raises if the file does not exist.
+	for encoding in getAvailableEncodings():
+		if acceptedEncodings[encoding] <= 0:
+			continue
+		variantPath = getVariantPath(rootDir, relativePath, encoding)
+		try:
+			if variantPath.stat().st_mtime_ns >= fileTime:
+				return (variantPath, encoding)
+		except OSError:
+			pass # variant not built yet.
+	return (path, None)
+
+
+_listingsLoader = {}
+
+# Returns the list of files and directories of the given directory. Listings are kept in memory,
+# and made again once the directory is modified, i.e when its content changes:
+def listDirectory(dirPath):
+	dirPath = Path(dirPath)
+	dirTime = dirPath.stat().st_mtime_ns
+	if dirPath in _listingsLoader and _listingsLoader[dirPath][0] == dirTime:
+		return _listingsLoader[dirPath][1]
+	listing = os.listdir(dirPath)
+	_listingsLoader[dirPath] = (dirTime, listing)
+	return listing
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Builds the precompressed variants of the files of a directory.')
+	parser.add_argument('directory', nargs='?', default='../libs-frontend/')
+	args = parser.parse_args()
+	if brotli is None:
+		print("Package 'brotli' not installed, only gzip variants will be built.")
+	precompressDir(args.directory)
@@ -0,0 +1,175 @@
+import math, argparse, traceback, multiprocessing
+from collections import Counter, deque
+from pathlib import Path
+import numpy as np
+
+# Backend code:
+import loader, formatter, preprocessing, columnar
+
+
+# Strokes data augmentation, done in batch on the NumPy representation of strokes given by formatter.strokesListToArrays().
+# Each variant of a sample gets a random affine transformation (rotation, scaling, stretching, shearing, translation) around
+# its center, some noise on each point, and may have its strokes order shuffled. Amplitudes are ratios of the sample size,
+# except rotations which are in degrees. Points time is left unchanged.
+augmentationConfig = {
+	'maxRotation': 12.,
+	'maxScaling': 0.1,
+	'maxStretching': 0.1,
+	'maxShearing': 0.15,
+	'maxTranslation': 0.05,
+	'noise': 0.005, # std of the noise added to each point.
+	'shuffleProbability': 0.2, # probability of shuffling strokes order, for samples with several strokes.
+}
+
+
+# Returns the concatenation of the ranges [starts[i], starts[i] + counts[i]), without any Python loop:
+def concatenateRanges(starts, counts):
+	ends = np.cumsum(counts)
+	return np.arange(ends[-1] if len(ends) > 0 else 0) + np.repeat(starts - ends + counts, counts)
+
+
+# Generates variants of a batch of samples, given by the arrays (points, strokeOffsets, sampleOffsets). 'variantsNumbers'
+# is the number of variants of each sample, and 'rng' a numpy Generator. Returns the arrays of the variants, ordered by
+# source sample, and the source sample of each variant. Everything is vectorized over all points of the batch.
+def augmentBatch(points, strokeOffsets, sampleOffsets, variantsNumbers, rng, config=augmentationConfig):
+	sources = np.repeat(np.arange(len(sampleOffsets) - 1), variantsNumbers)
+	variantsNumber = len(sources)
+	strokesNumbers = np.diff(sampleOffsets)[sources]
+	strokeVariants = np.repeat(np.arange(variantsNumber), strokesNumbers)
+	strokes = concatenateRanges(sampleOffsets[sources], strokesNumbers)
+
+	# Shuffling strokes order, by sorting strokes of each variant on random keys:
+	shuffled = (rng.random(variantsNumber) < config['shuffleProbability']) & (strokesNumbers > 1)
+	keys = np.where(shuffled[strokeVariants], rng.random(len(strokes)), np.arange(len(strokes)) / max(1, len(strokes)))
+	strokes = strokes[np.lexsort((keys, strokeVariants))]
+
+	pointsNumbers = np.diff(strokeOffsets)[strokes]
+	newPoints = np.array(points[concatenateRanges(strokeOffsets[strokes], pointsNumbers)], dtype=formatter.pointsDtype)
+	newStrokeOffsets = np.concatenate(([0], np.cumsum(pointsNumbers))).astype(formatter.offsetsDtype)
+	newSampleOffsets = np.concatenate(([0], np.cumsum(strokesNumbers))).astype(formatter.offsetsDtype)
+	pointOffsets = formatter.getPointOffsets(newStrokeOffsets, newSampleOffsets)
+	pointVariants = np.repeat(np.arange(variantsNumber), np.diff(pointOffsets))
+
+	# Random affine transformation of each variant, around its center:
+	xmin, xmax, ymin, ymax = formatter.getBatchPointsStats(newPoints, pointOffsets).T
+	with np.errstate(invalid='ignore'): # empty variants have infinite stats, but no point.
+		xCenters, yCenters = (xmin + xmax) / 2., (ymin + ymax) / 2.
+		sizes = np.maximum(xmax - xmin, ymax - ymin)
+	sizes = np.where(np.isfinite(sizes) & (sizes > 0.), sizes, 1.)
+	angles = np.radians(rng.uniform(-config['maxRotation'], config['maxRotation'], variantsNumber))
+	scales = 1. + rng.uniform(-config['maxScaling'], config['maxScaling'], variantsNumber)
+	stretchings = 1. + rng.uniform(-config['maxStretching'], config['maxStretching'], variantsNumber)
+	shearings = rng.uniform(-config['maxShearing'], config['maxShearing'], variantsNumber)
+	translations = rng.uniform(-config['maxTranslation'], config['maxTranslation'], (variantsNumber, 2)) * sizes[:, None]
+	cos, sin = np.cos(angles), np.sin(angles)
+	xScales, yScales = scales * stretchings, scales / stretchings
+	# Matrix: rotation @ shearing @ scaling.
+	a, b = cos * xScales, (cos * shearings - sin) * yScales
+	c, d = sin * xScales, (sin * shearings + cos) * yScales
+
+	x = newPoints[:, 0] - xCenters[pointVariants]
+	y = newPoints[:, 1] - yCenters[pointVariants]
+	noise = rng.normal(0., 1., (len(newPoints), 2)) * (config['noise'] * sizes[pointVariants])[:, None]
+	newPoints[:, 0] = a[pointVariants] * x + b[pointVariants] * y + (xCenters + translations[:, 0])[pointVariants] + noise[:, 0]
+	newPoints[:, 1] = c[pointVariants] * x + d[pointVariants] * y + (yCenters + translations[:, 1])[pointVariants] + noise[:, 1]
+	return (newPoints, newStrokeOffsets, newSampleOffsets, sources)
+
+
+# Returns the number of variants to generate for each sample of each class, for every class to have at least
+# 'target' samples. Classes already having enough samples get no variant. Returns a dict: symbol -> variants number.
+def getBalancedVariantsNumbers(classesCounts, target, maxVariantsNumber=20):
+	return { symbol : min(maxVariantsNumber, max(0, math.ceil(target / count) - 1))
+		for symbol, count in classesCounts.items() }
+
+
+def getClassesCounts(dataset):
+	if isinstance(dataset, columnar.ColumnarDataset):
+		labelsCounts = np.bincount(dataset.getLabels(), minlength=len(dataset.symbols))
+		return { dataset.symbols[label] : int(count) for label, count in enumerate(labelsCounts.tolist()) if count > 0 }
+	return Counter(symbol for symbol, strokes in dataset)
+
+
+def _augmentShard(args):
+	shardIndex, arrays, variantsNumbers, seed, config = args
+	rng = np.random.default_rng([seed, shardIndex]) # not depending on the processes number.
+	return augmentBatch(*arrays, variantsNumbers, rng, config)
+
+
+# Augments a dataset, being e.g the output of loader.loadDataset() or a columnar dataset, and streams the result to
+# a columnar dataset at 'outputPath'. Each sample gets 'variantsNumber' variants, or with 'balancingTarget' enough
+# variants for its class to reach that samples number (see getBalancedVariantsNumbers()). Only the classes in
+# 'symbolsSet' are augmented if given. Original samples are written too if 'keepingOriginals' is True.
+# The result only depends on 'seed' and 'shardSize', shards being augmented in parallel by 'processesNumber' processes.
+def augmentDataset(service, dataset, outputPath, variantsNumber=4, balancingTarget=None, symbolsSet=None,
+	keepingOriginals=True, seed=0, processesNumber=1, shardSize=1024, config=augmentationConfig):
+	try:
+		if balancingTarget is not None:
+			variantsNumbers = getBalancedVariantsNumbers(getClassesCounts(dataset), balancingTarget)
+		def getVariantsNumber(symbol):
+			if symbolsSet is not None and symbol not in symbolsSet:
+				return 0
+			return variantsNumber if balancingTarget is None else variantsNumbers[symbol]
+		print("\n-> Augmenting %d samples to: %s" % (len(dataset), outputPath))
+		with columnar.ColumnarWriter(outputPath, service) as writer, \
+			multiprocessing.Pool(processesNumber) if processesNumber > 1 else SerialPool() as pool:
+			pending = deque() # bounded, for the memory usage not to depend on the dataset size.
+			for shardIndex, (symbols, arrays) in enumerate(preprocessing.iterShards(dataset, shardSize)):
+				shardVariantsNumbers = np.array([ getVariantsNumber(symbol) for symbol in symbols ], dtype=np.int64)
+				task = (shardIndex, arrays, shardVariantsNumbers, seed, config)
+				pending.append((symbols, arrays, pool.apply_async(_augmentShard, (task,))))
+				while len(pending) > 2 * processesNumber:
+					writeAugmentedShard(writer, *pending.popleft(), keepingOriginals)
+			while len(pending) > 0:
+				writeAugmentedShard(writer, *pending.popleft(), keepingOriginals)
+		print('Wrote %d samples.' % writer.samplesNumber)
+		return writer.samplesNumber
+	except Exception:
+		print('\nFailure happened while augmenting a dataset:\n')
+		print(traceback.format_exc())
+		return 0
+
+
+def writeAugmentedShard(writer, symbols, arrays, result, keepingOriginals):
+	if keepingOriginals:
+		writer.appendArrays(symbols, *arrays)
+	points, strokeOffsets, sampleOffsets, sources = result.get()
+	writer.appendArrays([ symbols[source] for source in sources.tolist() ], points, strokeOffsets, sampleOffsets)
+
+
+# Runs tasks in the current process, with the same interface as multiprocessing.Pool:
+class SerialPool:
+	class Result:
+		def __init__(self, value):
+			self.value = value
+
+		def get(self):
+			return self.value
+
+	def apply_async(self, function, args):
+		return SerialPool.Result(function(*args))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Augments a dataset, the result being saved in the columnar format.')
+	parser.add_argument('service', help='service whose dataset is to be augmented.')
+	parser.add_argument('--dataset', help='path of the dataset, by default the service one.')
+	parser.add_argument('--output', help='path of the augmented dataset, by default next to the dataset.')
+	parser.add_argument('--variants', type=int, default=4, help='number of variants of each sample.')
+	parser.add_argument('--balance', type=int, help='generates variants for each class to have at least this number of samples.')
+	parser.add_argument('--symbols', nargs='*', help='only augments those classes.')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--processes', type=int, default=1)
+	args = parser.parse_args()
+	datasetPath = args.dataset if args.dataset is not None else loader.getDefaultDatasetPath(args.service)
+	if datasetPath is None:
+		exit()
+	outputPath = Path(args.output) if args.output is not None else Path(datasetPath).with_suffix('.augmented.columnar')
+	dataset = columnar.loadDataset(args.service, datasetPath)
+	augmentDataset(args.service, dataset, outputPath, variantsNumber=args.variants, balancingTarget=args.balance,
+		symbolsSet=None if args.symbols is None else set(args.symbols), seed=args.seed, processesNumber=args.processes)
@@ -1,10 +1,12 @@
-import sys, json, traceback, math
-from collections import OrderedDict
+import os, json, traceback, math, gzip, time, argparse, threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from tabulate import tabulate
 from tqdm import tqdm
+import numpy as np
 
 # Backend code:
-import server, loader, formatter, mappings
+import server, loader, formatter, mappings, cache, columnar, ensemble
 
 
 printingOrderKey = lambda x : (-x[1], x[0]) # sorting by decreasing samples number, and by name.
@@ -17,8 +19,13 @@ formatPercent = lambda x : '%5.1f %%' % (100. * x)
 # - samplesThreshold: used for computing top-k macro scores, classes with less samples than this threshold will be ignored.
 # - filterAnswersData: weither answered classes should be filtered when generating correlated answers data.
 # - suffix: will be added to the generated files name.
-def benchmark(service, dataset, mappingsList=[], top_k=5, samplesThreshold=50,
-	saving=True, saveUnrecognizedSamples=False, filterAnswersData=False, suffix=''):
+# - replay: if True, service answers are replayed from a record previously made, instead of querying the service.
+# - recording: if True, service answers are recorded for later replays. Unused when replaying.
+# - workersNumber: number of concurrent classification requests sent to the service.
+# - checkpointing: if True, the ingestion progress is periodically saved, for an interrupted run to be resumed.
+# - resume: if True, the run is resumed from the last checkpoint of a previous run, if any.
+def benchmark(service, dataset, mappingsList=[], top_k=5, samplesThreshold=50, saving=True, saveUnrecognizedSamples=False,
+	filterAnswersData=False, suffix='', replay=False, recording=True, workersNumber=1, checkpointing=True, resume=False):
 	try:
 		supportedMappings = loader.getSupportedMappings()
 		if len(mappingsList) == 0:
@@ -37,7 +44,22 @@ def benchmark(service, dataset, mappingsList=[], top_k=5, samplesThreshold=50,
 		}
 		loader.getLatexToUnicodeMap() # pre-loading, for prettier console output with tqdm.
 		datasetMining(stats, dataset)
-		ingestDataset(stats, dataset)
+		if replay:
+			record = loadRecord(service, len(dataset), suffix)
+			if record is None:
+				print("=> No valid record found, run the benchmark without '--replay' first.")
+				return {}
+			ingestDataset(stats, dataset, record=record)
+		else:
+			checkpointPath = getCheckpointPath(service, suffix) if checkpointing else None
+			resumeState = loadCheckpoint(stats, getCheckpointPath(service, suffix)) if resume else None
+			recordFile = openRecordFile(stats, suffix, appending=resumeState is not None) if recording else None
+			try:
+				ingestDataset(stats, dataset, recordFile=recordFile, workersNumber=workersNumber,
+					checkpointPath=checkpointPath, resumeState=resumeState)
+			finally:
+				if recordFile is not None:
+					recordFile.close()
 		aggregateStats(stats)
 		generateStatsRecap(stats)
 		if saving:
@@ -101,8 +123,16 @@ def datasetMining(stats, dataset, verboseLevel=1):
 		})
 
 
-# Collects stats on service answers given dataset samples. This does require a service to be running!
-def ingestDataset(stats, dataset):
+# Collects stats on service answers given dataset samples. This does require a service to be running,
+# unless a record of its answers is given (see loadRecord()), in which case those are replayed offline.
+# - recordFile: if given, the vanilla answers for every sample are written to it, see writeRecordEntry().
+# - workersNumber: number of classification requests kept in flight concurrently. Answers are still
+#   ingested in the dataset order, thus stats are identical to those of a serial run.
+# - checkpointPath: if given, the ingestion progress is periodically saved there, see Checkpointer. The checkpoint
+#   is removed once the run is done, unless some samples failed, for them to be retried by a resumed run.
+# - resumeState: checkpoint state from which the ingestion is resumed, see loadCheckpoint(). Samples which
+#   failed before are requested again.
+def ingestDataset(stats, dataset, record=None, recordFile=None, workersNumber=1, checkpointPath=None, resumeState=None):
 	service, top_k, mStats = stats['service'], stats['top_k'], stats['mappings']
 	symbolCandidatesSet = mappings.getSymbolCandidatesSet(service, mStats.keys())
 	print('\nFound %d symbol candidates for mappings: %s\n' % (len(symbolCandidatesSet), list(mStats.keys())))
@@ -112,53 +142,75 @@ def ingestDataset(stats, dataset):
 		mStats[m]['recalls'] = { key : [0] * (top_k+1) for key in projClassesSet } # class samples number and top_k counts
 		mStats[m]['unrecognized'] = {}
 		mStats[m]['answeredProjClassesSet'] = set()
-	strokesFormat = 'hwrt'
+	stats['failedRanks'] = []
+	metrics = stats['performance'] = PerformanceMetrics(mStats.keys(), replayed=record is not None)
 	xmin, xmax, ymin, ymax = math.inf, -math.inf, math.inf, -math.inf
-	for rank in tqdm(range(len(dataset))):
-		vanillaKey, strokes = dataset[rank]
+	missingRanksNumber = 0
+	firstRank, retriedRanks = 0, set()
+	if resumeState is not None:
+		for rank, strokesStats, results, unrecognizedStrokes in resumeState['samples']:
+			_xmin, _xmax, _ymin, _ymax = strokesStats
+			xmin, xmax, ymin, ymax = min(xmin, _xmin), max(xmax, _xmax), min(ymin, _ymin), max(ymax, _ymax)
+			for m, (key, answers) in results.items():
+				if not countMappingAnswers(stats, m, key, answers):
+					mStats[m]['unrecognized'][rank] = [key, unrecognizedStrokes]
+		for m in mStats:
+			mStats[m]['answeredProjClassesSet'].update(resumeState['answeredClasses'][m])
+		firstRank, retriedRanks = resumeState['lastRank'] + 1, resumeState['failedRanks']
+		print('Resuming the ingestion from rank %d, retrying %d failed samples.\n' % (firstRank, len(retriedRanks)))
+	checkpointer = None
+	if checkpointPath is not None:
+		checkpointer = Checkpointer(checkpointPath, getCheckpointHeader(stats), appending=resumeState is not None,
+			answeredClasses={ m : mStats[m]['answeredProjClassesSet'] for m in mStats })
+	compiledMappings = mappings.CompiledMappings(mStats.keys(), symbolCandidatesSet)
+	if record is not None:
+		samplesAnswers = replayVanillaAnswers(dataset, symbolCandidatesSet, record)
+	else:
+		samplesAnswers = requestVanillaAnswers(service, dataset, symbolCandidatesSet, recordFile is not None,
+			workersNumber, firstRank, metrics, retriedRanks)
+	for rank, vanillaKey, sampleAnswers in tqdm(samplesAnswers, total=len(dataset), initial=firstRank - len(retriedRanks)):
+		if checkpointer is not None and checkpointer.isDue(): # all ranks before this one have been ingested, or failed.
+			if recordFile is not None:
+				recordFile.flush()
+			checkpointer.save(max(firstRank, rank) - 1, { m : mStats[m]['answeredProjClassesSet'] for m in mStats })
+		if sampleAnswers is None:
+			continue # discarded sample.
+		strokes, strokesStats, vanillaAnswers, status = sampleAnswers
+		if status == 404 and record is not None:
+			missingRanksNumber += 1
+			continue # sample not recorded, cannot be replayed.
+		if status != 200:
+			if len(stats['failedRanks']) == 0:
+				print("\n=> Classify request failed at rank %d, make sure the '%s' service is running.\n" % (rank, service))
+			stats['failedRanks'].append(rank)
+			if checkpointer is not None:
+				checkpointer.addFailedRank(rank)
+			continue
+		metrics.samplesNumber += 1
+		if recordFile is not None:
+			writeRecordEntry(recordFile, rank, strokesStats, vanillaAnswers)
 		if vanillaKey not in symbolCandidatesSet:
-			# print('-> Ignored vanilla class:', vanillaKey)
-			continue # discarding classes whose projection isn't supported with any mapping.
-		if type(strokes) == str:
-			strokes = json.loads(strokes) # strokes full loading: str -> dict
-		if service == 'detexify':
-			strokes = formatter.formatStrokesTo(strokesFormat, strokes)
-		# print(vanillaKey, strokes)
-		_xmin, _xmax, _ymin, _ymax = formatter.getStrokesStats(strokesFormat, strokes)
+			continue # only recorded, for other mappings to be replayed later.
+		_xmin, _xmax, _ymin, _ymax = strokesStats
 		xmin, xmax, ymin, ymax = min(xmin, _xmin), max(xmax, _xmax), min(ymin, _ymin), max(ymax, _ymax)
-		vanillaAnswers, status = server.classifyRequest(service, 'none', strokes) # requests without mapping!
-		# print('vanillaAnswers:', vanillaAnswers)
-		if status != 200:
-			print("=> Classify request failed at rank %d, make sure the '%s' service is running.\n" % (rank, service))
-			exit() # will be catched by the exception mechanism.
-
-		# Projecting the vanilla answers with each mapping:
-		for m in mStats:
-			# Saving all answered classes with mapping m, as a consistency check:
-			answers = formatter.aggregateAnswers(service, m, vanillaAnswers)
-			mStats[m]['answeredProjClassesSet'].update([ answer['symbol_class'] for answer in answers ])
-			# Saving stats for supported classes:
-			key = mappings.getProjectedSymbol(vanillaKey, m)
-			if key not in mStats[m]['projClassesSet']:
-				# print('-> Ignored class:', key)
-				continue # discarding classes whose projection isn't supported with m.
-			mStats[m]['recalls'][key][0] += 1 # first value: class samples number.
-			maxAnswers = min(top_k, len(answers))
-			isKeyAnswered = False
-			for i in range(maxAnswers):
-				answer = answers[i]['symbol_class']
-				if key == answer:
-					isKeyAnswered = True
-					mStats[m]['recalls'][key][i+1] += 1 # top_k counts
-				mStats[m]['answers'][key][answer] += top_k - i # Adding >= 0 weights to the answers ranking.
-				# This does not rely on service scores which may be noisy, and would also require a unified
-				# score format across services.
-			if not isKeyAnswered:
-				formatter.reshiftTime(strokesFormat, strokes)
-				mStats[m]['unrecognized'][rank] = [key, strokes]
+		results, unrecognizedStrokes = ingestSampleAnswers(stats, rank, vanillaKey, strokes, vanillaAnswers, compiledMappings)
+		if checkpointer is not None:
+			checkpointer.addSample([rank, strokesStats, results, unrecognizedStrokes])
 
+	metrics.stop()
+	if checkpointer is not None:
+		checkpointer.save(len(dataset) - 1, { m : mStats[m]['answeredProjClassesSet'] for m in mStats })
+		checkpointer.close(removing=len(stats['failedRanks']) == 0) # else kept, for failed samples to be retried.
+		if len(stats['failedRanks']) > 0:
+			print("\nCheckpoint kept, run the benchmark with '--resume' to retry the failed samples.")
+	if missingRanksNumber > 0:
+		print('\n%d samples were missing from the record, and have been ignored.' % missingRanksNumber)
+	if len(stats['failedRanks']) > 0:
+		print('\n%d samples have been ignored, since their classification failed at ranks:\n%s'
+			% (len(stats['failedRanks']), stats['failedRanks']))
 	stats['strokesRange'] = [xmin, xmax, ymin, ymax]
-	print('\nStrokes coordinates range (among supported symbols):', stats['strokesRange'], '\n')
+	print('\nStrokes coordinates range (among supported symbols):', stats['strokesRange'])
+	print('Performance:', json.dumps(metrics.getRecap()), '\n')
 	for m in mStats:
 		invalidProjClasses = sorted(mStats[m]['answeredProjClassesSet'] - mStats[m]['projClassesSet'])
 		mStats[m]['invalidProjClasses'] = invalidProjClasses
@@ -167,6 +219,362 @@ def ingestDataset(stats, dataset):
 				service, len(invalidProjClasses), m), *invalidProjClasses, '', sep='\n')
 
 
+# Projecting the vanilla answers of a sample with each mapping, and updating the stats accordingly.
+# The sample key and its answers are projected and aggregated with all mappings at once by compiledMappings,
+# which gives the same answered classes as formatter.aggregateAnswers(), without building guesses.
+# For an ensemble, vanillaAnswers is a dict: service -> vanilla answers, fused like ensemble.fuseAnswers().
+# Returns the results of the sample for checkpoints: a dict m -> [key, top_k answers] for the mappings supporting
+# its class, and its strokes if it was unrecognized with some mapping, else None.
+def ingestSampleAnswers(stats, rank, vanillaKey, strokes, vanillaAnswers, compiledMappings):
+	service, mStats, metrics = stats['service'], stats['mappings'], stats['performance']
+	start = time.perf_counter()
+	if ensemble.isEnsemble(service):
+		ids = compiledMappings.getIds([vanillaKey])
+		aggregatedIds = ensemble.fuseAggregatedIds(compiledMappings, vanillaAnswers)
+	else:
+		ids = compiledMappings.getIds([vanillaKey] + [ guess.symbol_class for guess in vanillaAnswers ])
+		scores = np.array([ guess.score for guess in vanillaAnswers ], dtype=np.float64)
+		aggregatedIds = compiledMappings.aggregateIds(ids[1:], scores, summingScores=formatter.isScoreSummed(service))
+	projectedKeys = compiledMappings.projections[:, ids[0]].tolist()
+	metrics.aggregationDuration += time.perf_counter() - start
+	results, unrecognizedStrokes = {}, None
+	for m in mStats:
+		mappingStart = time.perf_counter()
+		index = compiledMappings.mappingIndexes[m]
+		answers = compiledMappings.getSymbols(aggregatedIds[index].tolist())
+		# Saving all answered classes with mapping m, as a consistency check:
+		mStats[m]['answeredProjClassesSet'].update(answers)
+		# Saving stats for supported classes:
+		key = compiledMappings.symbols[projectedKeys[index]]
+		if key in mStats[m]['projClassesSet']: # else discarding classes whose projection isn't supported with m.
+			strokes = ingestMappingAnswers(stats, m, rank, key, answers, strokes)
+			results[m] = [key, answers[:stats['top_k']]]
+			if rank in mStats[m]['unrecognized']:
+				unrecognizedStrokes = strokes
+		metrics.mappingsDurations[m] += time.perf_counter() - mappingStart
+	return (results, unrecognizedStrokes)
+
+
+# Updating the stats of mapping m with the answers of a sample, whose projected class is 'key'.
+# Returns the sample strokes, loaded if they had to be for the sample to be saved as unrecognized.
+def ingestMappingAnswers(stats, m, rank, key, answers, strokes):
+	service, mStats = stats['service'], stats['mappings']
+	if not countMappingAnswers(stats, m, key, answers):
+		strokes = loadStrokes(service, strokes) # not loaded yet when replaying.
+		formatter.reshiftTime('hwrt', strokes)
+		mStats[m]['unrecognized'][rank] = [key, strokes]
+	return strokes
+
+
+# Updating the recalls and answers counts of mapping m with the answers of a sample. Returns whether its class was answered.
+def countMappingAnswers(stats, m, key, answers):
+	top_k, mStats = stats['top_k'], stats['mappings']
+	mStats[m]['recalls'][key][0] += 1 # first value: class samples number.
+	maxAnswers = min(top_k, len(answers))
+	isKeyAnswered = False
+	for i in range(maxAnswers):
+		answer = answers[i]
+		if key == answer:
+			isKeyAnswered = True
+			mStats[m]['recalls'][key][i+1] += 1 # top_k counts
+		mStats[m]['answers'][key][answer] += top_k - i # Adding >= 0 weights to the answers ranking.
+		# This does not rely on service scores which may be noisy, and would also require a unified
+		# score format across services.
+	return isKeyAnswered
+
+
+# Yields for each rank of the dataset a tuple (rank, vanillaKey, sampleAnswers), where sampleAnswers is either None for
+# discarded samples, or a tuple (strokes, strokesStats, vanillaAnswers, status). The dataset is only iterated once. Requests are sent by a pool of 'workersNumber'
+# threads, and are bounded to a window of pending ranks, which are yielded in order.
+# If 'metrics' is given, the latency and phases durations of each request are added to it. Ranks before 'firstRank'
+# are skipped, except those in 'retriedRanks', e.g samples which failed in a previous run.
+def requestVanillaAnswers(service, dataset, symbolCandidatesSet, keepAllSamples, workersNumber, firstRank=0, metrics=None,
+	retriedRanks=()):
+	def classifySample(strokes, strokesStats):
+		try:
+			strokes = loadStrokes(service, strokes)
+			if strokesStats is None:
+				strokesStats = formatter.getStrokesStats('hwrt', strokes)
+			timings, start = {}, time.perf_counter()
+			if ensemble.isEnsemble(service):
+				vanillaAnswers, status = ensemble.classifyVanillaRequests(strokes, timings=timings, deadlines=False) # reproducible.
+			else:
+				vanillaAnswers, status = server.classifyVanillaRequest(service, strokes, timings) # requests without mapping!
+			if metrics is not None:
+				metrics.addRequest(time.perf_counter() - start, timings, status)
+			return (strokes, strokesStats, vanillaAnswers, status)
+		except Exception:
+			print('\nFailed to classify a sample:\n\n' + traceback.format_exc())
+			return (strokes, None, [], 500)
+	# Stats of columnar datasets are computed at once, with vectorized kernels:
+	batchStats = dataset.getStrokesStats().tolist() if isinstance(dataset, columnar.ColumnarDataset) else None
+	windowSize = 2 * workersNumber # keeping workers busy, while bounding memory usage.
+	with ThreadPoolExecutor(max_workers=workersNumber) as executor:
+		pending = deque()
+		for rank, (vanillaKey, strokes) in enumerate(dataset):
+			if rank < firstRank and rank not in retriedRanks:
+				continue
+			if keepAllSamples or vanillaKey in symbolCandidatesSet:
+				pending.append((rank, vanillaKey, executor.submit(classifySample, strokes,
+					None if batchStats is None else tuple(batchStats[rank]))))
+			else:
+				# print('-> Ignored vanilla class:', vanillaKey)
+				pending.append((rank, vanillaKey, None)) # discarding classes whose projection isn't supported with any mapping.
+			while len(pending) > 0 and (len(pending) > windowSize or pending[0][2] is None):
+				pendingRank, pendingKey, future = pending.popleft()
+				yield (pendingRank, pendingKey, None if future is None else future.result())
+		while len(pending) > 0:
+			pendingRank, pendingKey, future = pending.popleft()
+			yield (pendingRank, pendingKey, None if future is None else future.result())
+
+
+# Same as requestVanillaAnswers(), with answers read from a record. Missing samples have a 404 status.
+def replayVanillaAnswers(dataset, symbolCandidatesSet, record):
+	for rank, (vanillaKey, strokes) in enumerate(dataset):
+		if vanillaKey not in symbolCandidatesSet:
+			yield (rank, vanillaKey, None)
+		elif rank not in record:
+			yield (rank, vanillaKey, (strokes, None, [], 404))
+		else:
+			strokesStats, compacted = record[rank]
+			yield (rank, vanillaKey, (strokes, strokesStats, expandRecordAnswers(compacted), 200))
+
+
+# Measures the speed of the service and of the benchmark during the ingestion: latency of the classification
+# requests sent to the service, cached answers not counting, throughput in classified samples per second,
+# and time spent in each phase. Requests are added by the workers threads, aggregation durations by the
+# main thread. Phases are summed over all samples, in seconds:
+# - formatting: conversion of the strokes to the service request, by the client.
+# - request: HTTP request to the service, or inference for local services.
+# - extraction: conversion of the service answer to guesses.
+# - aggregation: projection and aggregation of the answers with all mappings at once, then stats update for each mapping.
+class PerformanceMetrics:
+	phases = ['formatting', 'request', 'extraction']
+
+	def __init__(self, mappingsList, replayed=False):
+		self.replayed = replayed # bool
+		self.latencies = [] # in seconds
+		self.phasesDurations = dict.fromkeys(PerformanceMetrics.phases, 0.)
+		self.aggregationDuration = 0.
+		self.mappingsDurations = dict.fromkeys(mappingsList, 0.)
+		self.cacheHitsNumber = 0
+		self.failuresNumber = 0
+		self.samplesNumber = 0 # classified samples.
+		self.lock = threading.Lock()
+		self.startTime = time.perf_counter()
+		self.duration = None
+
+	def addRequest(self, latency, timings, status):
+		with self.lock:
+			if status != 200:
+				self.failuresNumber += 1
+				return
+			if 'request' not in timings:
+				self.cacheHitsNumber += 1
+				return
+			self.latencies.append(latency)
+			for phase in timings:
+				self.phasesDurations[phase] += timings[phase]
+
+	def stop(self):
+		self.duration = time.perf_counter() - self.startTime
+
+	def getRecap(self):
+		duration = self.duration if self.duration is not None else time.perf_counter() - self.startTime
+		latencies = np.array(self.latencies) * 1000.
+		getPercentile = lambda q : round(float(np.percentile(latencies, q)), 3) if len(latencies) > 0 else None
+		phasesDurations = { phase : round(self.phasesDurations[phase], 3) for phase in PerformanceMetrics.phases }
+		phasesDurations['aggregation'] = round(self.aggregationDuration + sum(self.mappingsDurations.values()), 3)
+		phasesDurations['mappings'] = { m : round(self.mappingsDurations[m], 3) for m in self.mappingsDurations }
+		return {
+			'replayed': self.replayed,
+			'duration': round(duration, 3),
+			'samples': self.samplesNumber,
+			'throughput': round(self.samplesNumber / duration, 3) if duration > 0. else None, # samples per second.
+			'requests': len(self.latencies),
+			'cache_hits': self.cacheHitsNumber,
+			'failures': self.failuresNumber,
+			'latency_ms': {
+				'p50': getPercentile(50),
+				'p90': getPercentile(90),
+				'p99': getPercentile(99),
+				'max': getPercentile(100),
+			},
+			'phases': phasesDurations,
+		}
+
+
+# Strokes full loading, to the hwrt format:
+def loadStrokes(service, strokes):
+	if type(strokes) == str:
+		strokes = json.loads(strokes) # str -> dict
+		if service == 'detexify':
+			strokes = formatter.formatStrokesTo('hwrt', strokes)
+	return strokes
+
+
+# A record saves the vanilla answers of a service for each sample of a dataset, in order for the benchmark
+# to be replayed later with any mappings, without the service. It is a gzipped file of JSON lines: a header
+# with the service name and the dataset size, then one line per sample: [rank, strokesStats, answers],
+# answers being in the compact form of cache.compactAnswers(), and bounded to 'recordBound' answers.
+# For an ensemble, answers are a dict: service -> compacted answers, of the services which answered in time.
+recordBound = 100
+
+def getRecordPath(service, suffix):
+	return loader.recordsDir / ('%s%s.jsonl.gz' % (service, suffix))
+
+
+# When appending, e.g for a resumed run, the record is completed. Samples recorded
+# twice are not an issue, since the latest entry of a given rank is kept by loadRecord().
+def openRecordFile(stats, suffix, appending=False):
+	path = getRecordPath(stats['service'], suffix)
+	os.makedirs(path.parent, exist_ok=True)
+	if appending and os.path.exists(path):
+		recordFile = gzip.open(path, 'at')
+	else:
+		recordFile = gzip.open(path, 'wt')
+		recordFile.write(json.dumps({'service': stats['service'], 'datasetSize': stats['datasetSize']}) + '\n')
+	print('Recording the service answers to:', path)
+	return recordFile
+
+
+def writeRecordEntry(recordFile, rank, strokesStats, vanillaAnswers):
+	if isinstance(vanillaAnswers, dict):
+		compacted = { service : cache.compactAnswers(answers[:recordBound]) for service, answers in vanillaAnswers.items() }
+	else:
+		compacted = cache.compactAnswers(vanillaAnswers[:recordBound])
+	recordFile.write(json.dumps([rank, strokesStats, compacted], separators=(',', ':')) + '\n')
+
+
+def expandRecordAnswers(compacted):
+	if isinstance(compacted, dict):
+		return { service : cache.expandAnswers(answers) for service, answers in compacted.items() }
+	return cache.expandAnswers(compacted)
+
+
+# Returns a dict: rank -> (strokesStats, compacted answers), or None if the record is missing or invalid:
+def loadRecord(service, datasetSize, suffix):
+	path = getRecordPath(service, suffix)
+	try:
+		with gzip.open(path, 'rt') as file:
+			header = json.loads(file.readline())
+			if header['service'] != service or header['datasetSize'] != datasetSize:
+				print('Record %s does not match the given service and dataset: %s' % (path, header))
+				return None
+			record = {}
+			try:
+				for line in file:
+					rank, strokesStats, compacted = json.loads(line)
+					record[rank] = (strokesStats, compacted)
+			except (EOFError, ValueError):
+				print('Record %s is truncated, its last entry has been ignored.' % path) # e.g interrupted run.
+		print('Loaded the answers of %d samples from record: %s' % (len(record), path))
+		return record
+	except Exception:
+		print('\nCould not load the record %s:\n\n%s' % (path, traceback.format_exc()))
+		return None
+
+
+# Saves the ingestion progress to an append-only journal at the given path, for an interrupted run to be resumed.
+# The journal starts with a header identifying the run, then every 'interval' seconds a block is appended, holding
+# the results of the samples ingested since the previous block, and the ranks which failed meanwhile. Saving thus
+# only costs the new samples, whatever the stats size. Blocks are written by a background thread, not to slow down
+# the ingestion. A block truncated by an interruption is ignored when loading the journal, see loadCheckpoint().
+class Checkpointer:
+	def __init__(self, path, header, appending=False, answeredClasses={}, interval=30.):
+		self.path = path # Path
+		self.interval = interval # float, in seconds
+		self.lastSaveTime = time.monotonic()
+		self.samples, self.failedRanks = [], []
+		self.savedAnsweredClasses = { m : set(classes) for m, classes in answeredClasses.items() }
+		self.executor = ThreadPoolExecutor(max_workers=1) # writes are done in order.
+		os.makedirs(path.parent, exist_ok=True)
+		if not appending or not os.path.exists(path):
+			writeBytesAtomically(path, (json.dumps(header) + '\n').encode())
+
+	def isDue(self):
+		return time.monotonic() - self.lastSaveTime >= self.interval
+
+	def addSample(self, entry):
+		self.samples.append(entry)
+
+	def addFailedRank(self, rank):
+		self.failedRanks.append(rank)
+
+	# Appends a block, all ranks up to 'lastRank' having been ingested or having failed. Classes answered
+	# with each mapping, see ingestSampleAnswers(), are only saved the first time they are answered.
+	def save(self, lastRank, answeredClasses):
+		newClasses = {}
+		for m, classes in answeredClasses.items():
+			newClasses[m] = sorted(classes - self.savedAnsweredClasses[m])
+			self.savedAnsweredClasses[m].update(newClasses[m])
+		block = {'lastRank': lastRank, 'samples': self.samples, 'failedRanks': self.failedRanks, 'answeredClasses': newClasses}
+		self.executor.submit(appendJsonLine, self.path, block)
+		self.samples, self.failedRanks = [], []
+		self.lastSaveTime = time.monotonic()
+
+	def close(self, removing=False):
+		self.executor.shutdown(wait=True)
+		if removing and os.path.exists(self.path):
+			os.remove(self.path)
+
+
+def appendJsonLine(path, content):
+	with open(path, 'a') as file:
+		file.write(json.dumps(content, separators=(',', ':')) + '\n')
+
+
+def writeBytesAtomically(path, content):
+	tempPath = path.with_suffix(path.suffix + '.tmp')
+	with open(tempPath, 'wb') as file:
+		file.write(content)
+	os.replace(tempPath, path)
+
+
+def getCheckpointPath(service, suffix):
+	return loader.checkpointsDir / ('%s%s.jsonl' % (service, suffix))
+
+
+def getCheckpointHeader(stats):
+	return {
+		'service': stats['service'],
+		'top_k': stats['top_k'],
+		'datasetSize': stats['datasetSize'],
+		'mappings': sorted(stats['mappings'].keys()),
+	}
+
+
+# Returns the state saved in the checkpoint journal at the given path, or None if it is missing or does not match
+# the given stats. The state is a dict: 'lastRank', 'samples' the results of all ingested samples, 'failedRanks'
+# the set of ranks which failed and have not been ingested since, and 'answeredClasses' for each mapping.
+def loadCheckpoint(stats, path):
+	try:
+		with open(path, 'r') as file:
+			header = json.loads(file.readline())
+			expected = getCheckpointHeader(stats)
+			for key in expected:
+				if header[key] != expected[key]:
+					print("Checkpoint %s has a different '%s': %s, starting from scratch." % (path, key, header[key]))
+					return None
+			state = {'lastRank': -1, 'samples': [], 'failedRanks': set(), 'answeredClasses': { m : set() for m in stats['mappings'] }}
+			try:
+				for line in file:
+					block = json.loads(line)
+					state['lastRank'] = max(state['lastRank'], block['lastRank'])
+					state['samples'] += block['samples']
+					state['failedRanks'].update(block['failedRanks'])
+					for m, classes in block['answeredClasses'].items():
+						state['answeredClasses'][m].update(classes)
+			except ValueError:
+				print('Checkpoint %s is truncated, its last block has been ignored.' % path) # e.g interrupted run.
+		state['failedRanks'] -= { entry[0] for entry in state['samples'] } # retried successfully.
+		print('Loaded checkpoint: %s' % path)
+		return state
+	except FileNotFoundError:
+		print('No checkpoint found at %s, starting from scratch.' % path)
+		return None
+
+
 # Aggregates stats collected by ingestDataset().
 # - 'recallMap' values for each class: samples number and top_k success rates.
 # - 'answersMap' values for each class: dict containing most common answered source classes
@@ -230,7 +638,8 @@ def generateStatsRecap(stats):
 					'scores': [ round(x, 8) for x in mStats[m]['recalls']['<Macro>'][1:] ]
 				}
 			} for m in mStats
-		}
+		},
+		'performance': stats['performance'].getRecap()
 	}
 
 
@@ -279,23 +688,49 @@ def saveResults(stats, saveUnrecognizedSamples, filterAnswersData, suffix):
 
 
 if __name__ == '__main__':
-	if len(sys.argv) < 2:
-		print("Please give as arg the name of the service to benchmark on all available mappings.\n"
-			"Optionally, the benchmark may only use some selected mappings which must be given as further args."
-			"\n- Supported services: %s\n- Available mappings: %s"
-			% (', '.join(loader.getSupportedServices()), ', '.join(loader.getSupportedMappings())))
-		exit()
-	service = sys.argv[1]
-	mappingsList = sys.argv[2:]
+	parser = argparse.ArgumentParser(description='Benchmarks the given service on all available mappings, '
+		'or only on the given ones. The \'none\' mapping is always used, for reference purposes.',
+		epilog='Supported services: %s. Available mappings: %s.'
+		% (', '.join(loader.getSupportedServices()), ', '.join(loader.getSupportedMappings())))
+	parser.add_argument('service', help='name of the service to benchmark.')
+	parser.add_argument('mappings', nargs='*', help='names of the mappings to benchmark. By default, all are used.')
+	parser.add_argument('--replay', action='store_true',
+		help='replay the service answers recorded by a previous run, without querying the service.')
+	parser.add_argument('--resume', action='store_true',
+		help='resume an interrupted run from its last checkpoint.')
+	parser.add_argument('--workers', type=int, default=8,
+		help='number of concurrent classification requests sent to the service (default: %(default)s).')
+	parser.add_argument('--no-cache', action='store_true',
+		help='query the service for every sample, without using nor saving cached answers.')
+	parser.add_argument('--refresh', action='store_true',
+		help='query the service for every sample, replacing the answers cached by previous runs.')
+	args = parser.parse_args()
+	service, mappingsList = args.service, args.mappings
+	if args.no_cache:
+		cache.configureCache(maxSize=0)
+	else:
+		cache.configureCache(diskDir=loader.cacheDir, refresh=args.refresh) # answers are kept across runs.
 	if service == 'hwrt':
 		# hwrt: train: 151160 samples, test: 17074 (split 90% / 10%). 368 / 378 classes found.
-		# This takes ~ 3m 30s to run:
-		testDataset = loader.loadDataset(service, loader.testDatasetPath_hwrt)
-		benchmark(service, testDataset, mappingsList=mappingsList, saveUnrecognizedSamples=True)
+		# This takes ~ 3m 30s to run serially:
+		testDataset = columnar.loadDataset(service, loader.testDatasetPath_hwrt) # streamed if not converted.
+		benchmark(service, testDataset, mappingsList=mappingsList, saveUnrecognizedSamples=True,
+			replay=args.replay, workersNumber=args.workers, resume=args.resume)
 	elif service == 'detexify':
 		# detexify: 210454 samples, training done on first 20K, testing on last 20K. 1077 classes overall.
-		# This takes ~ 35m to run:
-		testDataset = loader.loadDataset(service, loader.datasetPath_detexify)
-		benchmark(service, testDataset[-20000:], mappingsList=mappingsList, suffix='_last_20K')
+		# This takes ~ 35m to run serially:
+		testDataset = columnar.loadDataset(service, loader.datasetPath_detexify, last=20000)
+		benchmark(service, testDataset, mappingsList=mappingsList, suffix='_last_20K',
+			replay=args.replay, workersNumber=args.workers, resume=args.resume)
+	elif service == 'knn':
+		# knn: local service, indexing hwrt's train dataset. Thus tested on hwrt's test dataset:
+		testDataset = columnar.loadDataset('hwrt', loader.testDatasetPath_hwrt)
+		benchmark(service, testDataset, mappingsList=mappingsList,
+			replay=args.replay, workersNumber=args.workers, resume=args.resume)
+	elif service == 'ensemble':
+		# ensemble of the services of ensemble.ensembleConfig, tested on hwrt's test dataset, whose symbols all services share:
+		testDataset = columnar.loadDataset('hwrt', loader.testDatasetPath_hwrt)
+		benchmark(service, testDataset, mappingsList=mappingsList,
+			replay=args.replay, workersNumber=args.workers, resume=args.resume)
 	else:
 		print('Unsupported service:', service)
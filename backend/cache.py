@@ -0,0 +1,157 @@
+import os, json, time, hashlib, threading
+from collections import OrderedDict
+
+# Backend code:
+import loader, formatter, services
+
+
+# Returns a canonical hash of the given strokes, for the given service. Strokes can be in any
+# supported format, and their time is shifted to start from 0: equal drawings get the same hash.
+# The version of the service is hashed too, for cached answers of another version not to be used.
+def getStrokesHash(service, strokes):
+	points = []
+	timeOffset = None
+	for stroke in strokes:
+		newStroke = []
+		for point in stroke:
+			x, y, t = (point['x'], point['y'], point.get('time', 0)) if type(point) == dict else point[:3]
+			if timeOffset is None:
+				timeOffset = t
+			newStroke.append([float(x), float(y), float(t - timeOffset)]) # same hash for ints and floats.
+		points.append(newStroke)
+	content = service + '\n' + getServiceVersion(service) + '\n' + formatter.compactStrokesString(points)
+	return hashlib.sha1(content.encode()).hexdigest()
+
+
+# Version tag of each service, to be changed when the model behind the service changes, e.g after a retraining:
+serviceVersions = {}
+
+# Version of a service, as cached answers depend on it: its URL for a remote service, its settings for a local one,
+# and its tag in serviceVersions if any.
+def getServiceVersion(service):
+	if service in services.servicesConfig:
+		source = services.servicesConfig[service]['url']
+	else:
+		source = json.dumps(services.localServicesConfig.get(service, {}), sort_keys=True, default=str)
+	return source + '\n' + str(serviceVersions.get(service, ''))
+
+
+# Service answers are stored in a compact form: a list of [dataset_id, symbol_class, score].
+def compactAnswers(answers):
+	return [ [guess.dataset_id, guess.symbol_class, guess.score] for guess in answers ]
+
+
+def expandAnswers(compacted):
+	return [ formatter.createGuess(dataset_id, raw_answer, score) for dataset_id, raw_answer, score in compacted ]
+
+
+# Two-tiers cache of service answers, indexed by strokes hash:
+# - an in-memory LRU tier, bounded by 'maxSize' entries, whose entries expire after 'ttl' seconds.
+# - an optional on-disk tier in 'diskDir', which survives restarts. Its entries expire after 'diskTtl' seconds,
+#   or never if None. With 'refresh', its entries are not read, but replaced by the new answers.
+class AnswersCache:
+	def __init__(self, maxSize=10000, ttl=3600., diskDir=None, diskTtl=None, refresh=False):
+		self.maxSize = maxSize # int
+		self.ttl = ttl # float, in seconds
+		self.diskDir = diskDir # Path or None
+		self.diskTtl = diskTtl # float, in seconds, or None
+		self.refresh = refresh # bool
+		self.entries = OrderedDict() # key -> (expiration time, compacted answers)
+		self.lock = threading.Lock()
+		self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+	def get(self, key):
+		with self.lock:
+			if key in self.entries:
+				expiration, compacted = self.entries[key]
+				if expiration >= time.monotonic():
+					self.entries.move_to_end(key)
+					self.counters['hits'] += 1
+					return expandAnswers(compacted)
+				del self.entries[key]
+		compacted = self._readFromDisk(key)
+		with self.lock:
+			if compacted is None:
+				self.counters['misses'] += 1
+				return None
+			self.counters['disk_hits'] += 1
+			self._store(key, compacted)
+		return expandAnswers(compacted)
+
+	def put(self, key, answers):
+		compacted = compactAnswers(answers)
+		with self.lock:
+			self._store(key, compacted)
+		self._writeToDisk(key, compacted)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def getStats(self):
+		with self.lock:
+			stats = dict(self.counters)
+			stats['size'] = len(self.entries)
+		lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+		stats['hit_rate'] = round((stats['hits'] + stats['disk_hits']) / lookups, 4) if lookups > 0 else 0.
+		return stats
+
+	# Lock must be held:
+	def _store(self, key, compacted):
+		self.entries[key] = (time.monotonic() + self.ttl, compacted)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.maxSize:
+			self.entries.popitem(last=False)
+			self.counters['evictions'] += 1
+
+	def _getDiskPath(self, key):
+		return self.diskDir / key[:2] / ('%s.json' % key)
+
+	def _readFromDisk(self, key):
+		if self.diskDir is None or self.refresh:
+			return None
+		try:
+			path = self._getDiskPath(key)
+			if self.diskTtl is not None and time.time() - os.path.getmtime(path) > self.diskTtl:
+				return None # expired.
+			return json.loads(loader.getFileContent(path))
+		except FileNotFoundError:
+			return None
+		except Exception:
+			print('Invalid cache entry found for key:', key)
+			return None
+
+	def _writeToDisk(self, key, compacted):
+		if self.diskDir is None:
+			return
+		try:
+			path = self._getDiskPath(key)
+			os.makedirs(path.parent, exist_ok=True)
+			tempPath = path.with_suffix('.tmp%d' % threading.get_ident())
+			with open(tempPath, 'w') as file:
+				file.write(json.dumps(compacted, separators=(',', ':')))
+			os.replace(tempPath, path) # atomic, readers never see a partial entry.
+		except Exception:
+			print('Could not write cache entry for key:', key)
+
+
+# Settings of the shared answers cache. Set 'diskDir' to e.g loader.cacheDir to enable the on-disk tier:
+cacheConfig = {
+	'maxSize': 10000,
+	'ttl': 3600.,
+	'diskDir': None,
+	'diskTtl': None,
+	'refresh': False,
+}
+
+_answersCache = AnswersCache(**cacheConfig)
+
+def getAnswersCache():
+	return _answersCache
+
+
+# Updates the settings of the shared answers cache. Its in-memory entries are dropped:
+def configureCache(**settings):
+	global _answersCache
+	cacheConfig.update(settings)
+	_answersCache = AnswersCache(**cacheConfig)
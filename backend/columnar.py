@@ -0,0 +1,284 @@
+import os, sys, json, traceback
+from pathlib import Path
+import numpy as np
+
+# Backend code:
+import loader, formatter
+
+
+# Columnar binary format of a dataset. It is a directory containing:
+# - 'meta.json': format version, service name, arrays sizes and the symbols vocabulary.
+# - 'labels.bin': int32 array, symbol id of each sample in the vocabulary.
+# - 'sampleOffsets.bin': int64 array of size samplesNumber + 1, index of the first stroke of each sample.
+# - 'strokeOffsets.bin': int64 array of size strokesNumber + 1, index of the first point of each stroke.
+# - 'points.bin': float64 array of shape (pointsNumber, 3), each point being (x, y, time).
+# Arrays are raw, thus they can be memory-mapped and shared between processes.
+formatName = 'columnar'
+formatVersion = 1
+
+labelsDtype = np.int32
+offsetsDtype = formatter.offsetsDtype
+pointsDtype = formatter.pointsDtype
+
+
+# Returns the path of the columnar version of the given dataset:
+def getColumnarPath(datasetPath):
+	return Path(datasetPath).with_suffix('.columnar')
+
+
+# Appends the (x, y, time) points of the given strokes to the 'points' list, and the end offset of each
+# stroke to the 'strokeOffsets' list. Strokes can be in any supported format, points missing a time get
+# a null one. Returns the new number of points.
+def appendStrokes(strokes, points, strokeOffsets, pointsNumber):
+	for stroke in strokes:
+		for point in stroke:
+			if type(point) == dict:
+				points.append((point['x'], point['y'], point.get('time', 0)))
+			else:
+				points.append((point[0], point[1], point[2] if len(point) > 2 else 0))
+		pointsNumber += len(stroke)
+		strokeOffsets.append(pointsNumber)
+	return pointsNumber
+
+
+# Writes samples to a columnar dataset, one at a time. Samples are buffered and written
+# in chunks, thus the memory usage does not depend on the dataset size.
+class ColumnarWriter:
+	def __init__(self, dirPath, service, chunkSize=4096):
+		self.dirPath = Path(dirPath)
+		self.service = service # str
+		self.chunkSize = chunkSize # int, in samples
+		self.symbolIds = {} # symbol -> id
+		self.samplesNumber, self.strokesNumber, self.pointsNumber = 0, 0, 0
+		os.makedirs(self.dirPath, exist_ok=True)
+		self.files = { name : open(self.dirPath / ('%s.bin' % name), 'wb')
+			for name in ['labels', 'sampleOffsets', 'strokeOffsets', 'points'] }
+		np.zeros(1, dtype=offsetsDtype).tofile(self.files['sampleOffsets']) # first offsets.
+		np.zeros(1, dtype=offsetsDtype).tofile(self.files['strokeOffsets'])
+		self._resetBuffers()
+
+	def _resetBuffers(self):
+		self.labels, self.sampleOffsets, self.strokeOffsets, self.points = [], [], [], []
+
+	def append(self, symbol, strokes):
+		if symbol not in self.symbolIds:
+			self.symbolIds[symbol] = len(self.symbolIds)
+		self.labels.append(self.symbolIds[symbol])
+		self.pointsNumber = appendStrokes(strokes, self.points, self.strokeOffsets, self.pointsNumber)
+		self.strokesNumber += len(strokes)
+		self.sampleOffsets.append(self.strokesNumber)
+		self.samplesNumber += 1
+		if len(self.labels) >= self.chunkSize:
+			self.flush()
+
+	# Appends several samples at once, given by the arrays (points, strokeOffsets, sampleOffsets) of formatter.strokesListToArrays().
+	# Those arrays are written as is, without decoding any sample.
+	def appendArrays(self, symbols, points, strokeOffsets, sampleOffsets):
+		self.flush() # keeping samples order.
+		for symbol in symbols:
+			if symbol not in self.symbolIds:
+				self.symbolIds[symbol] = len(self.symbolIds)
+		strokeOffsets = strokeOffsets[sampleOffsets[0]:sampleOffsets[-1] + 1]
+		np.array([ self.symbolIds[symbol] for symbol in symbols ], dtype=labelsDtype).tofile(self.files['labels'])
+		(sampleOffsets[1:] - sampleOffsets[0] + self.strokesNumber).astype(offsetsDtype).tofile(self.files['sampleOffsets'])
+		(strokeOffsets[1:] - strokeOffsets[0] + self.pointsNumber).astype(offsetsDtype).tofile(self.files['strokeOffsets'])
+		np.asarray(points[strokeOffsets[0]:strokeOffsets[-1]], dtype=pointsDtype).tofile(self.files['points'])
+		self.samplesNumber += len(symbols)
+		self.strokesNumber += len(strokeOffsets) - 1
+		self.pointsNumber += int(strokeOffsets[-1] - strokeOffsets[0])
+
+	def flush(self):
+		np.array(self.labels, dtype=labelsDtype).tofile(self.files['labels'])
+		np.array(self.sampleOffsets, dtype=offsetsDtype).tofile(self.files['sampleOffsets'])
+		np.array(self.strokeOffsets, dtype=offsetsDtype).tofile(self.files['strokeOffsets'])
+		np.array(self.points, dtype=pointsDtype).reshape(-1, 3).tofile(self.files['points'])
+		self._resetBuffers()
+
+	def close(self):
+		self.flush()
+		for file in self.files.values():
+			file.close()
+		meta = {
+			'format': formatName,
+			'version': formatVersion,
+			'service': self.service,
+			'samplesNumber': self.samplesNumber,
+			'strokesNumber': self.strokesNumber,
+			'pointsNumber': self.pointsNumber,
+			'symbols': list(self.symbolIds.keys()), # ordered by id.
+		}
+		loader.writeContent(self.dirPath / 'meta.json', json.dumps(meta, indent='  '))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+# Memory-mapped columnar dataset. Opening it is near-instant, and samples are only decoded when accessed.
+# Indexing a sample returns a couple (symbol, strokes), strokes being in the hwrt format, like loader.loadDataset()
+# with fullLoading=True. Slicing and select() return views of some samples, without copying their data.
+class ColumnarDataset:
+	def __init__(self, dirPath):
+		self.dirPath = Path(dirPath)
+		meta = json.loads(loader.getFileContent(self.dirPath / 'meta.json'))
+		assert meta['format'] == formatName and meta['version'] == formatVersion, \
+			'Unsupported dataset format in %s' % self.dirPath
+		self.service = meta['service'] # str
+		self.symbols = meta['symbols'] # list, id -> symbol
+		self.labels = self._map('labels', labelsDtype, (meta['samplesNumber'],))
+		self.sampleOffsets = self._map('sampleOffsets', offsetsDtype, (meta['samplesNumber'] + 1,))
+		self.strokeOffsets = self._map('strokeOffsets', offsetsDtype, (meta['strokesNumber'] + 1,))
+		self.points = self._map('points', pointsDtype, (meta['pointsNumber'], 3))
+		self.ranks = np.arange(meta['samplesNumber']) # selected samples.
+
+	# In-memory columnar dataset, from arrays in the same format as the files above:
+	@classmethod
+	def fromArrays(cls, service, symbols, labels, sampleOffsets, strokeOffsets, points):
+		dataset = cls.__new__(cls)
+		dataset.dirPath = None
+		dataset.service, dataset.symbols = service, symbols
+		dataset.labels, dataset.sampleOffsets, dataset.strokeOffsets, dataset.points = \
+			labels, sampleOffsets, strokeOffsets, points
+		dataset.ranks = np.arange(len(labels))
+		return dataset
+
+	def _map(self, name, dtype, shape):
+		if shape[0] == 0: # empty files cannot be memory-mapped.
+			return np.zeros(shape, dtype=dtype)
+		return np.memmap(self.dirPath / ('%s.bin' % name), dtype=dtype, mode='r', shape=shape)
+
+	def __len__(self):
+		return len(self.ranks)
+
+	def __iter__(self):
+		for rank in self.ranks.tolist():
+			yield (self.symbols[self.labels[rank]], self._decodeStrokes(rank))
+
+	def __getitem__(self, index):
+		if type(index) == slice:
+			return self.select(index)
+		rank = int(self.ranks[index])
+		return (self.symbols[self.labels[rank]], self._decodeStrokes(rank))
+
+	# Returns a view of the samples at the given indices, or slice:
+	def select(self, indices):
+		view = ColumnarDataset.__new__(ColumnarDataset)
+		view.__dict__.update(self.__dict__)
+		view.ranks = self.ranks[indices]
+		return view
+
+	def getSymbol(self, index):
+		return self.symbols[self.labels[self.ranks[index]]]
+
+	# Returns the symbol id of each selected sample:
+	def getLabels(self):
+		return self.labels[self.ranks]
+
+	# Returns the points of each stroke of a sample, as (pointsNumber, 3) array views. Nothing is copied.
+	def getStrokesArrays(self, index):
+		return self._getStrokesArrays(int(self.ranks[index]))
+
+	def _getStrokesArrays(self, rank):
+		firstStroke, lastStroke = self.sampleOffsets[rank], self.sampleOffsets[rank + 1]
+		offsets = self.strokeOffsets[firstStroke:lastStroke + 1]
+		return [ self.points[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1) ]
+
+	def _decodeStrokes(self, rank):
+		firstStroke, lastStroke = self.sampleOffsets[rank], self.sampleOffsets[rank + 1]
+		return formatter.arraysToStrokes(self.points, self.strokeOffsets[firstStroke:lastStroke + 1])
+
+	# Returns the (xmin, xmax, ymin, ymax) stats of each selected sample, as an array of shape (len(self), 4).
+	# They are computed in one pass over the points spanned by the selected samples.
+	def getStrokesStats(self):
+		if len(self.ranks) == 0:
+			return np.zeros((0, 4), dtype=pointsDtype)
+		first, last = int(self.ranks.min()), int(self.ranks.max())
+		pointOffsets = formatter.getPointOffsets(self.strokeOffsets, self.sampleOffsets[first:last + 2])
+		return formatter.getBatchPointsStats(self.points, pointOffsets)[self.ranks - first]
+
+
+# Parses the given dataset lines into columnar arrays: (symbols, labels, sampleOffsets, strokeOffsets, points),
+# 'parseSample' returning for each line a couple (symbol, strokes). Used for parallel loading.
+def parseToArrays(lines, parseSample):
+	symbolIds, labels, sampleOffsets, strokeOffsets, points = {}, [], [0], [0], []
+	pointsNumber = 0
+	for line in lines:
+		symbol, strokes = parseSample(line)
+		if symbol not in symbolIds:
+			symbolIds[symbol] = len(symbolIds)
+		labels.append(symbolIds[symbol])
+		pointsNumber = appendStrokes(strokes, points, strokeOffsets, pointsNumber)
+		sampleOffsets.append(len(strokeOffsets) - 1)
+	return (list(symbolIds.keys()), np.array(labels, dtype=labelsDtype), np.array(sampleOffsets, dtype=offsetsDtype),
+		np.array(strokeOffsets, dtype=offsetsDtype), np.array(points, dtype=pointsDtype).reshape(-1, 3))
+
+
+# Merges in order the arrays of several chunks given by parseToArrays(), into a single in-memory dataset:
+def mergeArrays(service, chunks):
+	symbolIds, labels = {}, [np.zeros(0, dtype=labelsDtype)]
+	sampleOffsets, strokeOffsets = [np.zeros(1, dtype=offsetsDtype)], [np.zeros(1, dtype=offsetsDtype)]
+	strokesNumber, pointsNumber = 0, 0
+	for chunkSymbols, chunkLabels, chunkSampleOffsets, chunkStrokeOffsets, chunkPoints in chunks:
+		for symbol in chunkSymbols:
+			if symbol not in symbolIds:
+				symbolIds[symbol] = len(symbolIds)
+		idsMap = np.array([ symbolIds[symbol] for symbol in chunkSymbols ], dtype=labelsDtype)
+		labels.append(idsMap[chunkLabels] if len(chunkLabels) > 0 else chunkLabels)
+		sampleOffsets.append(chunkSampleOffsets[1:] + strokesNumber)
+		strokeOffsets.append(chunkStrokeOffsets[1:] + pointsNumber)
+		strokesNumber += len(chunkStrokeOffsets) - 1
+		pointsNumber += len(chunkPoints)
+	points = np.concatenate([ chunk[4] for chunk in chunks ]) if len(chunks) > 0 else np.zeros((0, 3), dtype=pointsDtype)
+	return ColumnarDataset.fromArrays(service, list(symbolIds.keys()), np.concatenate(labels),
+		np.concatenate(sampleOffsets), np.concatenate(strokeOffsets), points)
+
+
+# Converts the given dataset to the columnar format. Returns the number of converted samples.
+def convertDataset(service, datasetPath, outputPath=None):
+	outputPath = getColumnarPath(datasetPath) if outputPath is None else Path(outputPath)
+	try:
+		print("\n-> Converting the dataset %s to: %s" % (datasetPath, outputPath))
+		with ColumnarWriter(outputPath, service) as writer:
+			for symbol, strokes in loader.iterDataset(service, datasetPath):
+				writer.append(symbol, json.loads(strokes))
+		print('Converted %d samples.' % writer.samplesNumber)
+		return writer.samplesNumber
+	except Exception:
+		print('\nFailure happened while converting a dataset:\n')
+		print(traceback.format_exc())
+		return 0
+
+
+# Loads the columnar version of the given dataset if it exists, or streams it with loader.StreamedDataset() otherwise.
+# - last: if given, only the last samples of the dataset are kept. If there are at most 'maxLoadedLast' of them, they
+#   are loaded in memory instead of being streamed, the dataset being then read only once.
+def loadDataset(service, datasetPath, last=None, maxLoadedLast=100000):
+	columnarPath = getColumnarPath(datasetPath)
+	if (columnarPath / 'meta.json').exists():
+		dataset = ColumnarDataset(columnarPath)
+		if last is not None:
+			dataset = dataset[-last:]
+		print("\n-> Loaded %d samples for service '%s' from %s" % (len(dataset), service, columnarPath))
+		return dataset
+	if last is not None and last <= maxLoadedLast:
+		print("\n-> Loading the last %d samples of the dataset for service '%s' from %s" % (last, service, datasetPath))
+		dataset = loader.loadLastSamples(service, datasetPath, last)
+		print('Loaded %d samples.' % len(dataset))
+		return dataset
+	print("\n-> Streaming the dataset for service '%s' from %s" % (service, datasetPath))
+	return loader.StreamedDataset(service, datasetPath, last=last)
+
+
+if __name__ == '__main__':
+	datasetsPaths = {
+		'hwrt': [loader.testDatasetPath_hwrt, loader.trainDatasetPath_hwrt],
+		'detexify': [loader.datasetPath_detexify],
+	}
+	if len(sys.argv) < 2 or sys.argv[1] not in datasetsPaths:
+		print('Please give as arg the name of the service whose datasets are to be converted to the columnar format.'
+			'\n- Supported services: %s' % ', '.join(datasetsPaths.keys()))
+		exit()
+	for path in datasetsPaths[sys.argv[1]]:
+		convertDataset(sys.argv[1], path)
@@ -0,0 +1,204 @@
+import os, json, hashlib, argparse, traceback
+from pathlib import Path
+import numpy as np
+
+# Backend code:
+import loader, preprocessing, columnar
+
+
+# Duplicates detection among samples, from any dataset:
+# - exact duplicates have the same canonical hash, computed on strokes normalized in the universal box and
+#   rounded, their time being ignored. The same drawing at another scale or position is thus an exact duplicate.
+# - near-duplicates have close signatures: 'signaturePointsNumber' points resampled along the strokes of the
+#   sample normalized in the unit box. Candidates are found by locality-sensitive hashing, with random hyperplanes:
+#   each of the 'tablesNumber' hash tables groups signatures on the same side of its 'bitsNumber' hyperplanes.
+# Memory usage is of a few hundreds of bytes per sample, whatever the samples size.
+dedupIndexDir = loader.cacheDir / 'dedup'
+
+dedupConfig = {
+	'signaturePointsNumber': 24,
+	'tablesNumber': 6,
+	'bitsNumber': 16,
+	'threshold': 0.03, # max mean distance between the points of near-duplicates signatures, in the unit box.
+	'maxBucketCandidates': 64, # only the last samples of each bucket are compared.
+	'seed': 0,
+}
+
+unitBox = (0., 1., 0., 1.)
+
+
+# Canonical hash of a sample, as an int64:
+def getCanonicalHash(points, strokeOffsets):
+	normalized, strokeOffsets = preprocessing.normalize(points, strokeOffsets)
+	content = np.round(normalized[:, :2]).astype(np.int32).tobytes() + np.asarray(strokeOffsets, dtype=np.int64).tobytes()
+	return int.from_bytes(hashlib.blake2b(content, digest_size=8).digest(), 'little', signed=True)
+
+
+# Signature of a sample: its points normalized in the unit box, resampled at regular distances along its
+# strokes, jumps between strokes not counting. Returns a float32 array of size 2 * pointsNumber.
+def getSignature(points, strokeOffsets, pointsNumber=24):
+	if len(points) == 0:
+		return np.full(2 * pointsNumber, 0.5, dtype=np.float32)
+	normalized, strokeOffsets = preprocessing.normalize(points, strokeOffsets, box=unitBox)
+	xy = normalized[:, :2]
+	lengths = np.hypot(*np.diff(xy, axis=0).T)
+	jumps = strokeOffsets[1:-1]
+	lengths[jumps[(jumps > 0) & (jumps < len(points))] - 1] = 0. # jumps between strokes.
+	lengths = np.concatenate(([0.], np.cumsum(lengths)))
+	if lengths[-1] == 0.: # dots only.
+		return np.tile(xy.mean(axis=0), pointsNumber).astype(np.float32)
+	targets = np.linspace(0., lengths[-1], pointsNumber)
+	return np.stack([ np.interp(targets, lengths, xy[:, c]) for c in range(2) ], axis=1).ravel().astype(np.float32)
+
+
+# Persistent index of samples, checking new samples against the already added ones. Each sample has a key, e.g 'hwrt/test-data:42'.
+# Samples whose key was already added are not checked again, duplicates found being kept with their result. Thus checking
+# a dataset again against a saved index gives the same duplicates.
+class DedupIndex:
+	def __init__(self, dirPath=None, signaturePointsNumber=24, tablesNumber=6, bitsNumber=16, threshold=0.03,
+		maxBucketCandidates=64, seed=0):
+		self.dirPath = None if dirPath is None else Path(dirPath)
+		self.signaturePointsNumber = signaturePointsNumber # int
+		self.threshold = threshold # float
+		self.maxBucketCandidates = maxBucketCandidates # int
+		self.settings = {'signaturePointsNumber': signaturePointsNumber, 'tablesNumber': tablesNumber,
+			'bitsNumber': bitsNumber, 'threshold': threshold, 'maxBucketCandidates': maxBucketCandidates, 'seed': seed}
+		rng = np.random.default_rng(seed)
+		self.hyperplanes = rng.normal(size=(tablesNumber, bitsNumber, 2 * signaturePointsNumber)).astype(np.float32)
+		self.bitsWeights = (1 << np.arange(bitsNumber)).astype(np.int64)
+		self.heads = np.full((tablesNumber, 1 << bitsNumber), -1, dtype=np.int32) # last sample of each bucket.
+		self.previous = np.zeros((0, tablesNumber), dtype=np.int32) # previous sample in the same bucket.
+		self.signatures = np.zeros((0, 2 * signaturePointsNumber), dtype=np.float16)
+		self.keys = [] # key of each sample.
+		self.slots = {} # key -> sample.
+		self.duplicates = {} # key -> (kind, duplicateKey), for the added duplicates.
+		self.hashes = {} # canonical hash -> first sample with it.
+		self.size = 0
+		if self.dirPath is not None and (self.dirPath / 'meta.json').exists():
+			self.load()
+
+	def __len__(self):
+		return self.size
+
+	def getBuckets(self, signature):
+		bits = (self.hyperplanes @ (signature - 0.5)) > 0. # centered signatures.
+		return bits @ self.bitsWeights
+
+	# Returns a couple (kind, key): kind being 'exact' or 'near' for a duplicate of the sample 'key', or (None, None):
+	def query(self, points, strokeOffsets):
+		return self._query(getCanonicalHash(points, strokeOffsets), getSignature(points, strokeOffsets, self.signaturePointsNumber))[:2]
+
+	def _query(self, canonicalHash, signature):
+		if canonicalHash in self.hashes:
+			return ('exact', self.keys[self.hashes[canonicalHash]], None)
+		buckets = self.getBuckets(signature)
+		candidates = []
+		for table, bucket in enumerate(buckets.tolist()):
+			sample = int(self.heads[table, bucket])
+			for i in range(self.maxBucketCandidates):
+				if sample < 0:
+					break
+				candidates.append(sample)
+				sample = int(self.previous[sample, table])
+		if len(candidates) > 0:
+			candidates = np.unique(candidates)
+			distances = np.linalg.norm(self.signatures[candidates].astype(np.float32) - signature, axis=1)
+			closest = int(np.argmin(distances))
+			if distances[closest] / np.sqrt(self.signaturePointsNumber) <= self.threshold:
+				return ('near', self.keys[candidates[closest]], buckets)
+		return (None, None, buckets)
+
+	# Adds the sample to the index, unless it is a duplicate. Returns the same as query(). For a key already added,
+	# returns the result of its first addition.
+	def add(self, points, strokeOffsets, key):
+		if key in self.slots:
+			return (None, None)
+		if key in self.duplicates:
+			return self.duplicates[key]
+		canonicalHash = getCanonicalHash(points, strokeOffsets)
+		signature = getSignature(points, strokeOffsets, self.signaturePointsNumber)
+		kind, duplicateKey, buckets = self._query(canonicalHash, signature)
+		if kind is None:
+			self._insert(canonicalHash, signature, buckets, key)
+		else:
+			self.duplicates[key] = (kind, duplicateKey)
+		return (kind, duplicateKey)
+
+	def _insert(self, canonicalHash, signature, buckets, key):
+		if self.size == len(self.signatures): # amortized growth.
+			capacity = max(1024, 2 * self.size)
+			self.signatures = np.resize(self.signatures, (capacity, self.signatures.shape[1]))
+			self.previous = np.resize(self.previous, (capacity, self.previous.shape[1]))
+		tables = np.arange(len(buckets))
+		self.signatures[self.size] = signature
+		self.previous[self.size] = self.heads[tables, buckets]
+		self.heads[tables, buckets] = self.size
+		self.hashes[canonicalHash] = self.size
+		self.slots[key] = self.size
+		self.keys.append(key)
+		self.size += 1
+
+	def save(self):
+		os.makedirs(self.dirPath, exist_ok=True)
+		np.save(self.dirPath / 'signatures.npy', self.signatures[:self.size])
+		np.save(self.dirPath / 'previous.npy', self.previous[:self.size])
+		np.save(self.dirPath / 'heads.npy', self.heads)
+		np.save(self.dirPath / 'hashes.npy', np.array(list(self.hashes.items()), dtype=np.int64).reshape(-1, 2))
+		loader.writeContent(self.dirPath / 'keys.txt', '\n'.join(self.keys))
+		loader.writeContent(self.dirPath / 'duplicates.json', json.dumps(self.duplicates, separators=(',', ':')))
+		loader.writeContent(self.dirPath / 'meta.json', json.dumps({'size': self.size, 'settings': self.settings}, indent='  '))
+
+	def load(self):
+		meta = json.loads(loader.getFileContent(self.dirPath / 'meta.json'))
+		assert meta['settings'] == self.settings, 'Dedup index at %s built with other settings.' % self.dirPath
+		self.size = meta['size']
+		self.signatures = np.load(self.dirPath / 'signatures.npy')
+		self.previous = np.load(self.dirPath / 'previous.npy')
+		self.heads = np.load(self.dirPath / 'heads.npy')
+		self.hashes = dict(np.load(self.dirPath / 'hashes.npy').tolist())
+		self.keys = loader.getFileContent(self.dirPath / 'keys.txt').split('\n') if self.size > 0 else []
+		self.slots = { key : sample for sample, key in enumerate(self.keys) }
+		if (self.dirPath / 'duplicates.json').exists():
+			self.duplicates = { key : tuple(duplicate) for key, duplicate in json.loads(loader.getFileContent(self.dirPath / 'duplicates.json')).items() }
+		print('Loaded dedup index of %d samples from: %s' % (self.size, self.dirPath))
+
+
+# Adds the samples of a dataset to the index, shard by shard. Samples keys are 'prefix:rank'.
+# Returns the list of duplicates found: (key, kind, duplicateKey).
+def indexDataset(index, dataset, prefix, shardSize=4096):
+	duplicates, rank = [], 0
+	for symbols, (points, strokeOffsets, sampleOffsets) in preprocessing.iterShards(dataset, shardSize):
+		for i in range(len(symbols)):
+			offsets = strokeOffsets[sampleOffsets[i]:sampleOffsets[i + 1] + 1]
+			key = '%s:%d' % (prefix, rank)
+			kind, duplicateKey = index.add(points[offsets[0]:offsets[-1]], offsets - offsets[0], key)
+			if kind is not None:
+				duplicates.append((key, kind, duplicateKey))
+			rank += 1
+	return duplicates
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Finds exact and near duplicates in the datasets of the given services.')
+	parser.add_argument('services', nargs='+', help="services whose datasets are checked, in order, e.g 'hwrt detexify'.")
+	parser.add_argument('--output', default=str(dedupIndexDir), help='directory of the persistent index.')
+	args = parser.parse_args()
+	try:
+		os.makedirs(args.output, exist_ok=True)
+		index = DedupIndex(args.output, **dedupConfig)
+		for service in args.services:
+			datasetPaths = loader.getDatasetPaths(service)
+			if len(datasetPaths) == 0:
+				continue
+			duplicates = []
+			for datasetPath in datasetPaths: # whole dataset, e.g both train and test splits.
+				prefix = '%s/%s' % (service, Path(datasetPath).stem)
+				duplicates += indexDataset(index, columnar.loadDataset(service, datasetPath), prefix)
+			exactNumber = sum(1 for key, kind, duplicateKey in duplicates if kind == 'exact')
+			print('Found %d exact and %d near duplicates.' % (exactNumber, len(duplicates) - exactNumber))
+			with open(Path(args.output) / ('duplicates-%s.json' % service), 'w') as file:
+				json.dump(duplicates, file)
+		index.save()
+	except Exception:
+		print('\nFailure happened while looking for duplicates:\n')
+		print(traceback.format_exc())
@@ -0,0 +1,161 @@
+import time, threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import numpy as np
+
+# Backend code:
+import loader, formatter, services
+
+
+# Ensemble classification: a drawing is sent concurrently to several services, whose answers are projected with
+# the requested mapping, then merged by rank fusion, since their scores cannot be compared (hwrt gives probabilities,
+# detexify and knn distances). Only the 'depth' best classes of each service are fused, with the 'fusion' method:
+# - 'rrf': reciprocal rank fusion, a class getting weight / (rrfConstant + rank) from each service, ranks starting at 1.
+# - 'borda': Borda count, a class getting weight * (depth + 1 - rank) from each service.
+# Fused scores are summed over the services, thus higher scores are better. A service not answering before its
+# deadline, in seconds from the request start, is dropped from the fusion. Services being queried in parallel,
+# the latency is that of the slowest service within its deadline. Each service has its own pool of 'workersNumber'
+# threads, for a stalled service not to hold the threads the others need. Services known to be down, see
+# services.ServiceHealth, are skipped.
+ensembleConfig = {
+	'services': ['hwrt', 'detexify'],
+	'fusion': 'rrf',
+	'rrfConstant': 60,
+	'depth': 50,
+	'weights': {'hwrt': 1., 'detexify': 1., 'knn': 1.},
+	'deadlines': {'hwrt': 2., 'detexify': 2., 'knn': 2.},
+	'workersNumber': 16, # max number of requests in flight to each service.
+}
+
+_executorsLoader = {}
+_executorsLock = threading.Lock()
+
+# Returns the pool of threads sending the requests of the ensembles to the given service:
+def getExecutor(service):
+	if service not in _executorsLoader:
+		with _executorsLock:
+			if service not in _executorsLoader:
+				_executorsLoader[service] = ThreadPoolExecutor(max_workers=ensembleConfig['workersNumber'])
+	return _executorsLoader[service]
+
+
+# Whether the service of a classification request is an ensemble: either 'ensemble', or a list of services.
+def isEnsemble(service):
+	return service == 'ensemble' or isinstance(service, list)
+
+
+# Returns the services of the given ensemble. Raises a ValueError for unsupported ones.
+def getMembers(service):
+	members = ensembleConfig['services'] if service == 'ensemble' else service
+	for member in members:
+		if isEnsemble(member) or member not in loader.getSupportedServices():
+			raise ValueError('Unsupported ensemble member: %s' % member)
+	return members
+
+
+def getDeadline(service):
+	return ensembleConfig['deadlines'].get(service, 2.)
+
+
+# Whether the given service is known to be down, its requests then failing at once:
+def isMemberDown(service):
+	return service in services.servicesConfig and services.getHealth(service).isOpen()
+
+
+# Status of an ensemble request, given the status of each service: 200 if at least one answered,
+# 504 if all were dropped for being too slow, else the status of the first failure.
+def getEnsembleStatus(statuses):
+	if 200 in statuses:
+		return 200
+	if all(status == 504 for status in statuses):
+		return 504
+	return next(status for status in statuses if status != 504)
+
+
+# Sends the given strokes to each service of the ensemble concurrently. Returns a tuple (memberAnswers, status),
+# memberAnswers being a dict: service -> vanilla answers, for the services having answered before their deadline,
+# in the ensemble order. If a 'timings' dict is given, its 'request' phase is set to the wall time of the requests,
+# unless all answers were cached. Without 'deadlines', all services are waited for, e.g for reproducible benchmarks.
+# Requests still waiting for a thread at their deadline are cancelled, and those already sent are left to complete,
+# their answers being cached.
+def classifyVanillaRequests(strokes, members=None, pipeline=None, timings=None, deadlines=True):
+	import server # lazy import, server importing this module.
+	members = ensembleConfig['services'] if members is None else members
+	strokes, status = server.preprocessRequestStrokes(strokes, pipeline) # same strokes format for all services.
+	if status != 200:
+		return ({}, status)
+	start = time.perf_counter()
+	requests = []
+	for member in members:
+		memberTimings = {}
+		future = None if isMemberDown(member) else \
+			getExecutor(member).submit(server.classifyVanillaRequest, member, strokes, memberTimings)
+		requests.append((member, memberTimings, future))
+	memberAnswers, statuses = {}, []
+	for member, memberTimings, future in requests:
+		if future is None:
+			statuses.append(503) # skipped.
+			continue
+		try:
+			timeout = max(0., start + getDeadline(member) - time.perf_counter()) if deadlines else None
+			answers, status = future.result(timeout=timeout)
+		except TimeoutError:
+			future.cancel() # only if not sent yet.
+			print("\n-> '%s' service dropped from the ensemble, no answer within %.2fs.\n" % (member, getDeadline(member)))
+			answers, status = [], 504
+		if status == 200:
+			memberAnswers[member] = answers
+		statuses.append(status)
+	if timings is not None and any(len(memberTimings) > 0 for member, memberTimings, future in requests):
+		timings['request'] = time.perf_counter() - start
+	status = getEnsembleStatus(statuses)
+	return (memberAnswers if status == 200 else {}, status)
+
+
+# Fuses the given rankings, a list of couples (service, classes best first), with the method of ensembleConfig.
+# Returns a list of couples (class, fused score), by decreasing score. Ties are broken by the first occurrence
+# of each class, services being taken in the given order. Classes can be symbols or ids.
+def fuseRankings(rankings):
+	fusion, depth = ensembleConfig['fusion'], ensembleConfig['depth']
+	if fusion not in ['rrf', 'borda']:
+		raise ValueError('Unsupported fusion method: %s' % fusion)
+	fusedScores = {} # keeping the first occurrences order.
+	for service, ranking in rankings:
+		weight = ensembleConfig['weights'].get(service, 1.)
+		for rank, symbol_class in enumerate(ranking[:depth], 1):
+			if fusion == 'rrf':
+				score = weight / (ensembleConfig['rrfConstant'] + rank)
+			else:
+				score = weight * (depth + 1 - rank)
+			fusedScores[symbol_class] = fusedScores.get(symbol_class, 0.) + score
+	return sorted(fusedScores.items(), key=lambda item : item[1], reverse=True) # stable sort.
+
+
+# Projects the answers of each service with the given mapping, and fuses them. Returns a list of formatter.Guess,
+# whose raw answers are the guesses of each service for that class. Optional arg: 'bound', as in aggregateAnswers().
+def fuseAnswers(memberAnswers, mapping, bound=0):
+	rankings, memberGuesses = [], []
+	for service, answers in memberAnswers.items():
+		aggregated = formatter.aggregateAnswers(service, mapping, answers)[:ensembleConfig['depth']]
+		rankings.append((service, [ guess.symbol_class for guess in aggregated ]))
+		memberGuesses.append({ guess.symbol_class : guess for guess in aggregated })
+	fused = []
+	for symbol_class, score in fuseRankings(rankings):
+		rawAnswers = [ guesses[symbol_class] for guesses in memberGuesses if symbol_class in guesses ]
+		fused.append(formatter.Guess(rawAnswers[0].dataset_id, symbol_class, score, rawAnswers))
+	return fused[:bound] if bound > 0 else fused
+
+
+# Same as fuseAnswers() with all mappings at once, for the benchmark: answers of each service are aggregated
+# by compiledMappings, see mappings.CompiledMappings.aggregateIds(). Returns for each mapping, in the
+# mappings order, the array of the fused classes ids, best first.
+def fuseAggregatedIds(compiledMappings, memberAnswers):
+	memberIds = []
+	for service, answers in memberAnswers.items():
+		ids = compiledMappings.getIds([ guess.symbol_class for guess in answers ])
+		scores = np.array([ guess.score for guess in answers ], dtype=np.float64)
+		memberIds.append((service, compiledMappings.aggregateIds(ids, scores, formatter.isScoreSummed(service))))
+	results = []
+	for index in range(len(compiledMappings.mappingNames)):
+		fused = fuseRankings([ (service, aggregatedIds[index].tolist()) for service, aggregatedIds in memberIds ])
+		results.append(np.array([ classId for classId, score in fused ], dtype=np.int32))
+	return results
@@ -1,5 +1,5 @@
-import traceback, json, copy, math
-from collections import OrderedDict
+import traceback, json, math
+import numpy as np
 
 # Backend code:
 import loader, mappings
@@ -43,7 +43,7 @@ def reshiftTime(strokesFormat, strokes):
 
 
 def getStrokesStats(strokesFormat, strokes):
-	(xKey, yKey) = ('x', 'y') if strokesFormat == 'hwrt' else (1, 2)
+	(xKey, yKey) = ('x', 'y') if strokesFormat == 'hwrt' else (0, 1)
 	xmin, xmax, ymin, ymax = math.inf, -math.inf, math.inf, -math.inf
 	for stroke in strokes:
 		for point in stroke:
@@ -75,6 +75,98 @@ def formatStrokesTo(strokesFormat, strokes):
 		return strokes
 
 
+# NumPy representation of strokes: a float64 'points' array of shape (pointsNumber, 3), each point being (x, y, time),
+# and an int64 'strokeOffsets' array of size strokesNumber + 1, index of the first point of each stroke. Several samples
+# are stored the same way, with an additional 'sampleOffsets' array of size samplesNumber + 1, index of the first stroke
+# of each sample: this is the layout of columnar datasets. Points missing a time get a null one.
+pointsDtype = np.float64
+offsetsDtype = np.int64
+
+
+# Returns the couple (points, strokeOffsets) of the given strokes, in any supported format:
+def strokesToArrays(strokes):
+	points = [ (point['x'], point['y'], point.get('time', 0)) if type(point) == dict
+		else (point[0], point[1], point[2] if len(point) > 2 else 0) for stroke in strokes for point in stroke ]
+	strokeOffsets = np.zeros(len(strokes) + 1, dtype=offsetsDtype)
+	np.cumsum([ len(stroke) for stroke in strokes ], out=strokeOffsets[1:])
+	return (np.array(points, dtype=pointsDtype).reshape(-1, 3), strokeOffsets)
+
+
+# Inverse of strokesToArrays(), with strokes in the hwrt format, which formatRequest() expects for every service.
+# Offsets may not start from 0:
+def arraysToStrokes(points, strokeOffsets):
+	pointsList = points[strokeOffsets[0]:strokeOffsets[-1]].tolist() # much faster than iterating on the array.
+	bounds = (strokeOffsets - strokeOffsets[0]).tolist()
+	return [ [ {'x': x, 'y': y, 'time': time} for x, y, time in pointsList[bounds[i]:bounds[i + 1]] ]
+		for i in range(len(bounds) - 1) ]
+
+
+# Same as getStrokesStats(), on a points array:
+def getPointsStats(points):
+	if len(points) == 0:
+		return (math.inf, -math.inf, math.inf, -math.inf)
+	(xmin, ymin), (xmax, ymax) = points[:, :2].min(axis=0).tolist(), points[:, :2].max(axis=0).tolist()
+	return (xmin, xmax, ymin, ymax)
+
+
+# Same as reshiftTime(), on a points array. Points are modified:
+def reshiftPointsTime(points):
+	if len(points) > 0:
+		points[:, 2] -= points[0, 2]
+
+
+# Returns the index of the first point of each sample, given their stroke offsets:
+def getPointOffsets(strokeOffsets, sampleOffsets):
+	return strokeOffsets[sampleOffsets]
+
+
+# Batched version of getPointsStats(): returns an array of shape (samplesNumber, 4), each row being
+# (xmin, xmax, ymin, ymax). 'pointOffsets' gives the first point of each sample, see getPointOffsets().
+# Only the points of the given samples are read, thus this works on a shard of a memory-mapped dataset.
+def getBatchPointsStats(points, pointOffsets):
+	pointOffsets = np.asarray(pointOffsets)
+	stats = np.tile(np.array([math.inf, -math.inf, math.inf, -math.inf]), (len(pointOffsets) - 1, 1))
+	counts = np.diff(pointOffsets)
+	nonEmpty = counts > 0
+	if nonEmpty.any(): # empty samples contain no point, thus the others are delimited by their first point:
+		shard = points[pointOffsets[0]:pointOffsets[-1], :2]
+		starts = pointOffsets[:-1][nonEmpty] - pointOffsets[0]
+		mins, maxs = np.minimum.reduceat(shard, starts, axis=0), np.maximum.reduceat(shard, starts, axis=0)
+		stats[nonEmpty] = np.stack([mins[:, 0], maxs[:, 0], mins[:, 1], maxs[:, 1]], axis=1)
+	return stats
+
+
+# Batched version of reshiftPointsTime(), each sample time starting from 0. Points are modified:
+def reshiftBatchPointsTime(points, pointOffsets):
+	pointOffsets = np.asarray(pointOffsets)
+	counts = np.diff(pointOffsets)
+	nonEmpty = counts > 0
+	shard = points[pointOffsets[0]:pointOffsets[-1]]
+	starts = pointOffsets[:-1][nonEmpty] - pointOffsets[0]
+	shard[:, 2] -= np.repeat(shard[starts, 2], counts[nonEmpty])
+
+
+# Batched version of strokesToArrays(): returns (points, strokeOffsets, sampleOffsets) for the given strokes list.
+def strokesListToArrays(strokesList):
+	points, strokesNumbers = [], []
+	for strokes in strokesList:
+		for stroke in strokes:
+			points.extend( (point['x'], point['y'], point.get('time', 0)) if type(point) == dict
+				else (point[0], point[1], point[2] if len(point) > 2 else 0) for point in stroke )
+			strokesNumbers.append(len(stroke))
+	strokeOffsets = np.zeros(len(strokesNumbers) + 1, dtype=offsetsDtype)
+	np.cumsum(strokesNumbers, out=strokeOffsets[1:])
+	sampleOffsets = np.zeros(len(strokesList) + 1, dtype=offsetsDtype)
+	np.cumsum([ len(strokes) for strokes in strokesList ], out=sampleOffsets[1:])
+	return (np.array(points, dtype=pointsDtype).reshape(-1, 3), strokeOffsets, sampleOffsets)
+
+
+# Batched version of arraysToStrokes(), inverse of strokesListToArrays():
+def arraysToStrokesList(points, strokeOffsets, sampleOffsets):
+	return [ arraysToStrokes(points, strokeOffsets[sampleOffsets[i]:sampleOffsets[i + 1] + 1])
+		for i in range(len(sampleOffsets) - 1) ]
+
+
 # Formatting a classification request, to be sent to the given service.
 # Note: no need to use formatStrokesTo(), for strokes should already be in correct format.
 def formatRequest(service, strokes):
@@ -88,18 +180,43 @@ def formatRequest(service, strokes):
 		return {}
 
 
+# Compact representation of a guess, converted to its JSON form by guessToJson() only when answering a request.
+# 'raw_answers' lists the guesses aggregated into this one, and is None for a guess straight from a service,
+# which is then its own raw answer. Guesses from a service are never modified once created.
+class Guess:
+	__slots__ = ('dataset_id', 'symbol_class', 'score', 'raw_answers')
+
+	def __init__(self, dataset_id, symbol_class, score, raw_answers=None):
+		self.dataset_id = dataset_id # int
+		self.symbol_class = symbol_class # str
+		self.score = score # float
+		self.raw_answers = raw_answers # list of Guess, or None
+
+	def getRawAnswers(self):
+		return [self] if self.raw_answers is None else self.raw_answers
+
+
 def createGuess(dataset_id, raw_answer, score):
-	symbolUnicode = loader.getSymbolUnicode(raw_answer)
+	return Guess(dataset_id, raw_answer, score)
+
+
+# JSON form of a guess. If 'pretty' is True, its score is formatted with formatScore():
+def guessToJson(service, guess, pretty=False):
 	return {
-		'dataset_id': dataset_id,
-		'symbol_class': raw_answer,
-		'unicode': symbolUnicode,
-		'score': score,
-		'raw_answers': [{'symbol_class': raw_answer, 'unicode': symbolUnicode, 'score': score}],
+		'dataset_id': guess.dataset_id,
+		'symbol_class': guess.symbol_class,
+		'unicode': loader.getSymbolUnicode(guess.symbol_class),
+		'score': formatScore(service, guess.score) if pretty else guess.score,
+		'raw_answers': [ {'symbol_class': raw.symbol_class, 'unicode': loader.getSymbolUnicode(raw.symbol_class),
+			'score': raw.score} for raw in guess.getRawAnswers() ],
 		'package': '' # default
 	}
 
 
+def guessesToJson(service, guesses, pretty=False):
+	return [ guessToJson(service, guess, pretty) for guess in guesses ]
+
+
 # Extracting data from the given service answer:
 def extractServiceAnswer(service, answer):
 	try:
@@ -124,6 +241,13 @@ def extractServiceAnswer(service, answer):
 					raw_answer = extractLatexCommand_detexify(symbol['id']),
 					score = symbol['score']
 				))
+		elif service == 'knn':
+			for symbol in answer:
+				formattedAnswer.append(createGuess(
+					dataset_id = -1,
+					raw_answer = symbol['symbol'],
+					score = symbol['score']
+				))
 		else:
 			print('Unsupported service:', service)
 		return formattedAnswer
@@ -132,49 +256,61 @@ def extractServiceAnswer(service, answer):
 		return []
 
 
-# Regrouping answers according to the given mapping, scores update, and unicode fetching.
-# Optional args: 'bound' to limit bandwidth usage by bounding the number of returned results,
-# and 'pretty' to format classes scores as strings using formatScore():
-def aggregateAnswers(service, mapping, answers, bound=0, pretty=False):
+# Regrouping answers according to the given mapping, and scores update. Optional arg: 'bound' to
+# limit bandwidth usage by bounding the number of returned results. Use guessesToJson() to get the
+# answer of a request, with optionally 'pretty' classes scores. Given answers are left unchanged:
+# a guess whose class is unchanged by the mapping is returned as is, and only guesses whose class
+# or score changed are allocated.
+def aggregateAnswers(service, mapping, answers, bound=0):
 	try:
-		aggregated = OrderedDict() # keeping the same order for scores!
+		if service not in loader.getSupportedServices():
+			print('Unsupported service:', service)
+			return []
+		isSummed = isScoreSummed(service) # else keeping the min distance.
+		projection = mappings.getMapping(mapping).projection
+		aggregated = {} # keeping the same order for scores!
 		for guess in answers:
-			symbol_class = mappings.getProjectedSymbol(guess['symbol_class'], mapping)
-			if not symbol_class in aggregated:
-				guess = copy.deepcopy(guess) # preventing side effects.
-				guess['symbol_class'] = symbol_class
-				guess['unicode'] = loader.getSymbolUnicode(symbol_class)
+			symbol_class = projection.get(guess.symbol_class, guess.symbol_class)
+			classGuess = aggregated.get(symbol_class)
+			if classGuess is None:
+				if symbol_class != guess.symbol_class:
+					guess = Guess(guess.dataset_id, symbol_class, guess.score, [guess])
 				aggregated[symbol_class] = guess
+				continue
+			if classGuess.raw_answers is None: # guess from the service, not to be modified.
+				classGuess = Guess(classGuess.dataset_id, symbol_class, classGuess.score, [classGuess])
+				aggregated[symbol_class] = classGuess
+			classGuess.raw_answers.append(guess)
+			# Updating class score:
+			if isSummed:
+				classGuess.score += guess.score
 			else:
-				aggregated[symbol_class]['raw_answers'].append(guess['raw_answers'][0]) # theres only one raw answer here.
-				# Updating class score:
-				if service == 'hwrt':
-					aggregated[symbol_class]['score'] += guess['score']
-				elif service == 'detexify':
-					aggregated[symbol_class]['score'] = min(aggregated[symbol_class]['score'], guess['score']) # min distance
-				else:
-					print('Unsupported service:', service)
-					return []
+				classGuess.score = min(classGuess.score, guess.score) # min distance
 		aggregated = list(aggregated.values())
-		if service == 'hwrt': # order may have changed after projection since scores are summed.
-			aggregated = sorted(aggregated, key=lambda guess : guess['score'], reverse=True)
+		if isSummed: # order may have changed after projection since scores are summed.
+			aggregated = sorted(aggregated, key=lambda guess : guess.score, reverse=True)
 		if bound > 0:
 			aggregated = aggregated[:bound] # done after each classes score has been aggregated.
-		if pretty:
-			for guess in aggregated:
-				guess['score'] = formatScore(service, guess['score'])
 		return aggregated
 	except:
 		print('Unknown error happened while aggregating some answers.\n\n' + traceback.format_exc())
 		return []
 
 
+# Whether the scores of a service are probabilities, to be summed when aggregated.
+# Otherwise they are distances (detexify, knn), the min one being kept.
+def isScoreSummed(service):
+	return service == 'hwrt'
+
+
 # Truncating scores to be nicely rendered - a string is returned!
 def formatScore(service, score):
 	if service == 'hwrt':
 		return "%.1f %%" % (100. * score)
-	elif service == 'detexify':
+	elif service in ['detexify', 'knn']:
 		return "%.3f" % score
+	elif service == 'ensemble':
+		return "%.4f" % score
 	else:
 		print('Unsupported service:', service)
 		return str(score)
@@ -198,6 +334,19 @@ if __name__ == '__main__':
 	if strokes != inputStrokes:
 		print('Error found in formatStrokesTo()')
 
+	points, strokeOffsets = strokesToArrays(inputStrokes)
+	if arraysToStrokes(points, strokeOffsets) != inputStrokes:
+		print('Error found in arraysToStrokes()')
+	if getPointsStats(points) != getStrokesStats('hwrt', inputStrokes):
+		print('Error found in getPointsStats()')
+	points, strokeOffsets, sampleOffsets = strokesListToArrays([inputStrokes, [], inputStrokes])
+	if arraysToStrokesList(points, strokeOffsets, sampleOffsets) != [inputStrokes, [], inputStrokes]:
+		print('Error found in arraysToStrokesList()')
+	reshiftBatchPointsTime(points, getPointOffsets(strokeOffsets, sampleOffsets))
+	batchStats = getBatchPointsStats(points, getPointOffsets(strokeOffsets, sampleOffsets))
+	if points[:, 2].tolist() != [0, 1, 2] * 2 or batchStats[1, 0] != math.inf or batchStats[2, 1] != 60:
+		print('Error found in batched kernels')
+
 	# Tests which must be passed by Detexify's extractor on both the old
 	# and new format. Each test is made of a pair (string, answer):
 	extractionTests_detexify = [
@@ -0,0 +1,310 @@
+import json, time, asyncio, argparse, traceback, contextlib, functools
+import aiohttp
+from aiohttp import web
+
+# Backend code:
+import formatter, services, cache, server, ensemble
+
+
+# Asynchronous serving mode of the classification routes, with the same JSON contract as server.py. Requests to the
+# services are sent by an async HTTP client from a single event loop, thus a process can keep many of them in flight
+# without a thread each. Backpressure: at most 'maxConcurrency' calls to the services are in flight, requests then
+# wait for a free slot, and once 'maxPending' requests are waiting, new ones get a 503 answer at once.
+# All other routes are forwarded to the Flask server at 'backendUrl', which must thus be running too. They are
+# not bounded by those slots, for cheap requests such as static files not to wait behind classifications.
+# Blocking work (local services, preprocessing, mappings, disk tier of the answers cache) is run in threads,
+# for the event loop to keep serving other requests meanwhile.
+gatewayConfig = {
+	'port': 5051,
+	'backendUrl': 'http://localhost:5050',
+	'maxConcurrency': 64,
+	'maxPending': 1024,
+}
+
+forwardedHeaders = ['Content-Type', 'Content-Encoding', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified',
+	'Cache-Control', 'Vary']
+hopHeaders = {'host', 'connection', 'keep-alive', 'transfer-encoding', 'content-length'} # set again by the client.
+
+
+class OverloadedError(Exception):
+	pass
+
+
+# Same serialization as Flask's jsonify(), for answers to be identical:
+def jsonResponse(data, status=200):
+	return web.Response(text=json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n',
+		content_type='application/json', status=status)
+
+
+def handleError(errorMessage, statusCode):
+	''' Same as server.handleError(). '''
+	errorMessage += '\n\n' + traceback.format_exc()
+	print(errorMessage)
+	return web.Response(text=errorMessage, content_type='text/plain', charset='utf-8', status=statusCode)
+
+
+class Gateway:
+	def __init__(self, backendUrl, maxConcurrency=64, maxPending=1024):
+		self.backendUrl = backendUrl # str
+		self.maxConcurrency = maxConcurrency # int
+		self.maxPending = maxPending # int
+		self.stats = {'inFlight': 0, 'pending': 0, 'rejected': 0}
+		self.semaphore = None
+		self.session = None # forwarding session, answers being kept as is (e.g still compressed).
+		self.servicesSession = None
+
+	async def start(self, app):
+		self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+		self.session = aiohttp.ClientSession(auto_decompress=False)
+		self.servicesSession = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.maxConcurrency))
+
+	async def close(self, app):
+		await self.session.close()
+		await self.servicesSession.close()
+
+	# Slot for a call to a service, waited for if all are taken. Raises OverloadedError if too many requests are waiting.
+	@contextlib.asynccontextmanager
+	async def slot(self):
+		if self.semaphore.locked() and self.stats['pending'] >= self.maxPending:
+			self.stats['rejected'] += 1
+			raise OverloadedError()
+		self.stats['pending'] += 1
+		try:
+			await self.semaphore.acquire()
+		finally:
+			self.stats['pending'] -= 1
+		self.stats['inFlight'] += 1
+		try:
+			yield
+		finally:
+			self.stats['inFlight'] -= 1
+			self.semaphore.release()
+
+	# Runs a blocking function in a thread, for the event loop not to wait for it:
+	async def runBlocking(self, function, *args, **kwargs):
+		return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+	# Runs an operation of the answers cache, in a thread if it reads or writes its on-disk tier:
+	async def runCacheOperation(self, answersCache, function, *args):
+		if answersCache.diskDir is None:
+			return function(*args)
+		return await self.runBlocking(function, *args)
+
+	# Same as server.preprocessRequestStrokes(), run in a thread when there is a pipeline:
+	async def preprocessRequestStrokes(self, strokes, pipeline):
+		if pipeline is None or pipeline == 'none':
+			return (strokes, 200)
+		return await self.runBlocking(server.preprocessRequestStrokes, strokes, pipeline)
+
+	# Same as services.ServiceClient.classify(), with the same settings and health tracking. Local services are run in a thread.
+	async def requestService(self, service, strokes):
+		if service not in services.servicesConfig:
+			client = services.getClient(service)
+			if client is None:
+				raise ValueError('Unsupported service: %s' % service)
+			return await self.runBlocking(client.classify, strokes)
+		health = services.getHealth(service)
+		if not health.allowRequest():
+			raise services.CircuitOpenError(service)
+		start = time.perf_counter()
+		try:
+			answer = await self.sendServiceRequest(service, strokes)
+		except Exception as e:
+			if services.isServiceFailure(e.status if isinstance(e, aiohttp.ClientResponseError) else None):
+				health.recordFailure(e)
+			else:
+				health.recordSuccess()
+			raise
+		health.recordSuccess(time.perf_counter() - start)
+		return answer
+
+	async def sendServiceRequest(self, service, strokes):
+		config = services.servicesConfig[service]
+		formattedRequest = formatter.formatRequest(service, strokes)
+		payload = {'json': formattedRequest} if config['sendAsJson'] else {'data': formattedRequest}
+		timeout = aiohttp.ClientTimeout(sock_connect=config['connectTimeout'], sock_read=config['readTimeout'])
+		for retry in range(config['retries'] + 1):
+			if retry > 1: # same backoff as urllib3, the first retry being immediate.
+				await asyncio.sleep(config['backoffFactor'] * 2 ** (retry - 1))
+			try:
+				async with self.servicesSession.post(config['url'], timeout=timeout, **payload) as response:
+					if response.status in (502, 503, 504) and retry < config['retries']:
+						continue
+					response.raise_for_status()
+					return json.loads(await response.read())
+			except aiohttp.ClientError as e:
+				if not isConnectError(e) or retry >= config['retries']:
+					raise
+
+	# Same as server.classifyVanillaRequest():
+	async def classifyVanillaRequest(self, service, strokes):
+		try:
+			answersCache = cache.getAnswersCache()
+			strokesHash = cache.getStrokesHash(service, strokes)
+			answers = await self.runCacheOperation(answersCache, answersCache.get, strokesHash)
+			if answers is None:
+				async with self.slot():
+					rawAnswer = await self.requestService(service, strokes)
+				answers = formatter.extractServiceAnswer(service, rawAnswer)
+				if answers != []: # not caching invalid answers.
+					await self.runCacheOperation(answersCache, answersCache.put, strokesHash, answers)
+			return (answers, 200)
+		except (OverloadedError, services.CircuitOpenError, services.ServiceUnavailableError):
+			return ([], 503)
+		except Exception as e:
+			print("\n-> '%s' service seems not available.\n" % service)
+			return ([], 500)
+
+	# Same as server.classifyRequest():
+	async def classifyRequest(self, service, mapping, strokes, bound=0, pretty=False, pipeline=None):
+		if ensemble.isEnsemble(service):
+			return await self.classifyEnsembleRequest(service, mapping, strokes, bound, pretty, pipeline)
+		strokes, status = await self.preprocessRequestStrokes(strokes, pipeline)
+		if status != 200:
+			return ([], status)
+		vanillaAnswers, status = await self.classifyVanillaRequest(service, strokes)
+		if status != 200:
+			return ([], status)
+		answers = await self.runBlocking(formatter.aggregateAnswers, service, mapping, vanillaAnswers, bound=bound)
+		return (formatter.guessesToJson(service, answers, pretty=pretty), 200)
+
+	# Same as server.classifyEnsembleRequest(). Requests of the services dropped at their deadline are cancelled.
+	async def classifyEnsembleRequest(self, service, mapping, strokes, bound=0, pretty=False, pipeline=None):
+		try:
+			members = ensemble.getMembers(service)
+		except ValueError as e:
+			print(e)
+			return ([], 400)
+		strokes, status = await self.preprocessRequestStrokes(strokes, pipeline)
+		if status != 200:
+			return ([], status)
+		results = await asyncio.gather(*[ self.classifyMemberRequest(member, strokes) for member in members ])
+		status = ensemble.getEnsembleStatus([ status for answers, status in results ])
+		if status != 200:
+			return ([], status)
+		memberAnswers = { member : answers for member, (answers, status) in zip(members, results) if status == 200 }
+		answers = await self.runBlocking(ensemble.fuseAnswers, memberAnswers, mapping, bound=bound)
+		return (formatter.guessesToJson('ensemble', answers, pretty=pretty), 200)
+
+	async def classifyMemberRequest(self, service, strokes):
+		if ensemble.isMemberDown(service):
+			return ([], 503)
+		try:
+			return await asyncio.wait_for(self.classifyVanillaRequest(service, strokes), ensemble.getDeadline(service))
+		except asyncio.TimeoutError:
+			print("\n-> '%s' service dropped from the ensemble, no answer within %.2fs.\n" % (service, ensemble.getDeadline(service)))
+			return ([], 504)
+
+	async def serveClassifyRequest(self, request):
+		try:
+			receivedInput = await extractRequestData(request)
+			service = receivedInput['service']
+			strokes = receivedInput['strokes']
+			mapping = receivedInput['mapping'] if 'mapping' in receivedInput else 'none'
+			bound = receivedInput['bound'] if 'bound' in receivedInput else 0
+			pretty = receivedInput['pretty'] if 'pretty' in receivedInput else False
+			pipeline = receivedInput['preprocessing'] if 'preprocessing' in receivedInput else None
+			answers, status = await self.classifyRequest(service, mapping, strokes, bound=bound, pretty=pretty, pipeline=pipeline)
+			if status != 200:
+				return handleError('Failure from classifyRequest().', status)
+			return jsonResponse(answers)
+		except Exception as e:
+			return handleError('Unknown error in serveClassifyRequest().', 500)
+
+	# Same as server.serveClassifyBatchRequest(), samples being classified concurrently:
+	async def serveClassifyBatchRequest(self, request):
+		try:
+			receivedInput = await extractRequestData(request)
+			service = receivedInput['service']
+			samples = receivedInput['samples']
+			pretty = receivedInput['pretty'] if 'pretty' in receivedInput else False
+			return jsonResponse(await asyncio.gather(*[ self.classifySample(service, sample, pretty) for sample in samples ]))
+		except Exception as e:
+			return handleError('Unknown error in serveClassifyBatchRequest().', 500)
+
+	async def classifySample(self, service, sample, pretty):
+		try:
+			strokes = sample['strokes']
+			mapping = sample['mapping'] if 'mapping' in sample else 'none'
+			bound = sample['bound'] if 'bound' in sample else 0
+			pipeline = sample['preprocessing'] if 'preprocessing' in sample else None
+		except Exception as e:
+			return {'status': 400, 'error': "Invalid sample, 'strokes' are required."}
+		answers, status = await self.classifyRequest(service, mapping, strokes, bound=bound, pretty=pretty, pipeline=pipeline)
+		if status != 200:
+			return {'status': status, 'error': "Classification failed for service '%s'." % service}
+		return {'status': 200, 'answers': answers}
+
+	async def serveGatewayStats(self, request):
+		return jsonResponse(dict(self.stats, maxConcurrency=self.maxConcurrency, maxPending=self.maxPending))
+
+	async def serveForwardedRequest(self, request):
+		return await self.redirectCrossOrigin(self.backendUrl + request.path_qs, request)
+
+	# Same as server.redirectCrossOrigin(), answers being kept as is (e.g still compressed):
+	async def redirectCrossOrigin(self, url, request):
+		try:
+			if request.method not in ['GET', 'HEAD', 'POST']:
+				return handleError('Unsupported HTTP method: ' + request.method, 405)
+			headers = { key : value for key, value in request.headers.items() if key.lower() not in hopHeaders }
+			async with self.session.request(request.method, url, headers=headers, data=await request.read()) as response:
+				content = await response.read()
+			return web.Response(body=content, status=response.status,
+				headers={ key : response.headers[key] for key in forwardedHeaders if key in response.headers })
+		except Exception as e:
+			return handleError('Failed to send a HTTP request to: ' + url, 502)
+
+
+# Whether a request to a service failed while connecting, such errors being the only ones retried, as with urllib3.
+# Connect timeouts are a ServerTimeoutError, as read timeouts: they are told apart by their message, aiohttp 3.8
+# having no dedicated error.
+def isConnectError(error):
+	return isinstance(error, aiohttp.ClientConnectorError) or (isinstance(error, aiohttp.ServerTimeoutError)
+		and str(error).startswith('Connection timeout'))
+
+
+async def extractRequestData(request):
+	''' Same as server.extractRequestData(). '''
+	if request.content_type in ['application/json', 'application/x-www-form-urlencoded', 'text/plain', 'text/html']:
+		return json.loads(await request.text())
+	print('Unsupported content-type in request data extraction:', request.content_type)
+	return None
+
+
+# Same as flask_cors defaults: all origins allowed, on all routes.
+@web.middleware
+async def corsMiddleware(request, handler):
+	if request.method == 'OPTIONS' and 'Access-Control-Request-Method' in request.headers:
+		response = web.Response()
+		response.headers['Access-Control-Allow-Methods'] = request.headers['Access-Control-Request-Method']
+		if 'Access-Control-Request-Headers' in request.headers:
+			response.headers['Access-Control-Allow-Headers'] = request.headers['Access-Control-Request-Headers']
+	else:
+		response = await handler(request)
+	response.headers['Access-Control-Allow-Origin'] = '*'
+	return response
+
+
+def createGatewayApp(backendUrl, maxConcurrency=64, maxPending=1024, **settings):
+	gateway = Gateway(backendUrl, maxConcurrency, maxPending)
+	app = web.Application(middlewares=[corsMiddleware], client_max_size=64 * 1024 ** 2)
+	app.on_startup.append(gateway.start)
+	app.on_cleanup.append(gateway.close)
+	app.router.add_post('/classify', gateway.serveClassifyRequest)
+	app.router.add_post('/classify/batch', gateway.serveClassifyBatchRequest)
+	app.router.add_get('/gateway-stats', gateway.serveGatewayStats)
+	app.router.add_route('*', '/{path:.*}', gateway.serveForwardedRequest)
+	return app
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Runs the asynchronous classification gateway, in front of the Flask server.')
+	parser.add_argument('--port', type=int, default=gatewayConfig['port'])
+	parser.add_argument('--backend-url', default=gatewayConfig['backendUrl'], help='URL of the Flask server.')
+	parser.add_argument('--max-concurrency', type=int, default=gatewayConfig['maxConcurrency'],
+		help='max number of calls to the services in flight.')
+	parser.add_argument('--max-pending', type=int, default=gatewayConfig['maxPending'],
+		help='max number of requests waiting for a call slot, beyond which requests are rejected with a 503 status.')
+	args = parser.parse_args()
+	services.startHealthChecks()
+	web.run_app(createGatewayApp(args.backend_url, args.max_concurrency, args.max_pending), host='0.0.0.0', port=args.port)
@@ -0,0 +1,194 @@
+import os, sys, time, heapq, threading, traceback
+from pathlib import Path
+import numpy as np
+
+# Backend code:
+import loader, formatter, services, preprocessing, columnar, dedup
+
+
+# Local classification service: a k-nearest neighbours classifier, running inside the backend process.
+# Each training sample is stored as a signature: 'pointsNumber' points resampled along its strokes, normalized
+# in the unit box (see dedup.getSignature()). A drawing is compared to every signature, either point to point
+# ('euclidean' metric) or with dynamic time warping in a window of 'window' points ('dtw' metric). DTW distances
+# are only computed for the candidates whose LB_Keogh lower bound may beat the current k-th nearest neighbour.
+# Distances are means of the distances between matched points, in the unit box. Classes are scored by the
+# distance of their nearest neighbour, thus like detexify, lower scores are better.
+knnIndexPath = loader.cacheDir / 'knn-index.npz'
+
+
+class KnnIndex:
+	def __init__(self, signatures, labels, symbols):
+		self.signatures = signatures # float32 array of shape (samplesNumber, pointsNumber, 2)
+		self.labels = labels # int32 array, symbol id of each sample
+		self.symbols = symbols # list, id -> symbol
+
+	def __len__(self):
+		return len(self.labels)
+
+	def save(self, path):
+		os.makedirs(Path(path).parent, exist_ok=True)
+		np.savez(path, signatures=self.signatures, labels=self.labels, symbols=np.array(self.symbols))
+		print('Saved kNN index of %d samples to: %s' % (len(self), path))
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as content:
+			index = cls(content['signatures'], content['labels'], content['symbols'].tolist())
+		print('Loaded kNN index of %d samples from: %s' % (len(index), path))
+		return index
+
+	# Returns the k nearest samples of the query signature, as a list of couples (distance, sample index), sorted by distance.
+	# With DTW, candidates are processed by blocks of doubling size, small blocks being enough when pruning is efficient.
+	def search(self, query, k=30, metric='dtw', window=3, blockSize=256, maxBlockSize=8192):
+		k = min(k, len(self))
+		if metric == 'euclidean':
+			distances = np.linalg.norm(self.signatures - query, axis=2).mean(axis=1)
+			nearest = np.argpartition(distances, k - 1)[:k] if k < len(self) else np.arange(len(self))
+			return sorted(zip(distances[nearest].tolist(), nearest.tolist()))
+		lowerBounds = getKeoghLowerBounds(query, self.signatures, window)
+		order = np.argsort(lowerBounds)
+		heap = [] # max-heap of the k nearest samples so far: (-distance, sample index).
+		first = 0
+		while first < len(order):
+			block = order[first:first + blockSize]
+			first += blockSize
+			blockSize = min(2 * blockSize, maxBlockSize)
+			if len(heap) == k and lowerBounds[block[0]] >= -heap[0][0]:
+				break # no remaining sample can be nearer than the k-th nearest one.
+			block = block[lowerBounds[block] < -heap[0][0]] if len(heap) == k else block
+			distances = getDtwDistances(query, self.signatures[block], window)
+			for distance, sample in zip(distances.tolist(), block.tolist()):
+				if len(heap) < k:
+					heapq.heappush(heap, (-distance, sample))
+				elif distance < -heap[0][0]:
+					heapq.heapreplace(heap, (-distance, sample))
+		return sorted((-distance, sample) for distance, sample in heap)
+
+
+# LB_Keogh lower bounds of the DTW distances between the query and each candidate: every candidate point
+# is at least at the distance of the bounding box of the query points it can be matched with.
+def getKeoghLowerBounds(query, candidates, window):
+	pointsNumber = len(query)
+	upper = np.stack([ query[max(0, i - window):i + window + 1].max(axis=0) for i in range(pointsNumber) ])
+	lower = np.stack([ query[max(0, i - window):i + window + 1].min(axis=0) for i in range(pointsNumber) ])
+	gaps = candidates - np.clip(candidates, lower, upper)
+	return np.linalg.norm(gaps, axis=2).mean(axis=1)
+
+
+# DTW distances between the query and a block of candidates, the warping path staying in the given window.
+# Computed for all candidates at once, by dynamic programming on the rows of the table. Candidates are the
+# last axis, for operations to be done on contiguous arrays. Only the last row of the table is kept.
+def getDtwDistances(query, candidates, window):
+	pointsNumber = len(query)
+	candidates = np.ascontiguousarray(candidates.transpose(1, 2, 0)) # (points, coordinates, candidates)
+	previous = np.full((pointsNumber + 1, candidates.shape[2]), np.inf, dtype=np.float32)
+	previous[0] = 0.
+	for i in range(1, pointsNumber + 1):
+		first, last = max(1, i - window), min(pointsNumber, i + window)
+		gaps = candidates[first - 1:last] - query[i - 1][None, :, None]
+		costs = np.sqrt(gaps[:, 0] ** 2 + gaps[:, 1] ** 2)
+		bests = np.minimum(previous[first - 1:last], previous[first:last + 1]) # diagonal and vertical moves.
+		row = np.full_like(previous, np.inf)
+		row[first] = costs[0] + bests[0]
+		for j in range(first + 1, last + 1): # horizontal moves.
+			row[j] = costs[j - first] + np.minimum(bests[j - first], row[j - 1])
+		previous = row
+	return previous[pointsNumber] / pointsNumber
+
+
+# Builds the index of the given dataset. Samples are read by shards, thus this works on datasets of any size.
+# If 'symbolsSet' is given, only the samples of those symbols are indexed.
+def buildIndex(service, datasetPath, pointsNumber=32, symbolsSet=None):
+	print("\n-> Building the kNN index of the dataset for service '%s' from %s" % (service, datasetPath))
+	dataset = columnar.loadDataset(service, datasetPath)
+	signatures, labels, symbolIds = [], [], {}
+	for symbols, (points, strokeOffsets, sampleOffsets) in preprocessing.iterShards(dataset, 4096):
+		for i, symbol in enumerate(symbols):
+			offsets = strokeOffsets[sampleOffsets[i]:sampleOffsets[i + 1] + 1]
+			if offsets[-1] == offsets[0] or (symbolsSet is not None and symbol not in symbolsSet):
+				continue # empty sample, or unsupported symbol.
+			signatures.append(dedup.getSignature(points[offsets[0]:offsets[-1]], offsets - offsets[0], pointsNumber))
+			if symbol not in symbolIds:
+				symbolIds[symbol] = len(symbolIds)
+			labels.append(symbolIds[symbol])
+	signatures = np.array(signatures, dtype=np.float32).reshape(-1, pointsNumber, 2)
+	return KnnIndex(signatures, np.array(labels, dtype=np.int32), list(symbolIds.keys()))
+
+
+# Client of the local kNN service, with the same interface as services.ServiceClient. Its index is loaded from
+# 'indexPath' on the first classification, under the client's own lock. Building the index from the training
+# dataset of 'datasetService' taking minutes, this is never done on a request: it must be built beforehand,
+# with 'python3 knn.py'. Until then, classifying raises a services.ServiceUnavailableError.
+class KnnClient:
+	def __init__(self, service, indexPath=knnIndexPath, datasetService='hwrt',
+		pointsNumber=32, metric='dtw', window=3, neighboursNumber=30):
+		self.service = service # str
+		self.indexPath = indexPath # path
+		self.datasetService = datasetService # 'hwrt' or 'detexify'
+		self.pointsNumber = pointsNumber # int
+		self.metric = metric # 'dtw' or 'euclidean'
+		self.window = window # int, in points
+		self.neighboursNumber = neighboursNumber # int
+		self.index = None
+		self.indexLock = threading.Lock()
+		self.staleIndexTime = None # modification time of the index file if built with other settings, not to load it again.
+
+	def isReady(self):
+		return self.index is not None or Path(self.indexPath).exists()
+
+	def getIndex(self):
+		if self.index is None:
+			with self.indexLock:
+				if self.index is None:
+					if not Path(self.indexPath).exists():
+						raise services.ServiceUnavailableError('no kNN index at %s, build it with: python3 knn.py %s'
+							% (self.indexPath, self.datasetService))
+					indexTime = os.path.getmtime(self.indexPath)
+					index = KnnIndex.load(self.indexPath) if indexTime != self.staleIndexTime else None
+					if index is None or index.signatures.shape[1] != self.pointsNumber:
+						self.staleIndexTime = indexTime
+						raise services.ServiceUnavailableError('kNN index at %s built with other settings, rebuild it with: python3 knn.py %s'
+							% (self.indexPath, self.datasetService))
+					self.index = index
+		return self.index
+
+	# Classifies the given strokes, in any supported format. Returns for each class among the nearest
+	# neighbours a dict {'symbol', 'score'}, the score being the distance of its nearest neighbour.
+	# If a 'timings' dict is given, the durations of the 'formatting' and 'request' (here the search) phases are set in it.
+	def classify(self, strokes, timings=None):
+		index = self.getIndex()
+		start = time.perf_counter()
+		points, strokeOffsets = formatter.strokesToArrays(strokes)
+		if len(points) == 0 or len(index) == 0:
+			return []
+		query = dedup.getSignature(points, strokeOffsets, self.pointsNumber).reshape(-1, 2)
+		searchStart = time.perf_counter()
+		neighbours = index.search(query, self.neighboursNumber, self.metric, self.window)
+		if timings is not None:
+			timings['formatting'] = searchStart - start
+			timings['request'] = time.perf_counter() - searchStart
+		answer, answeredLabels = [], set()
+		for distance, sample in neighbours:
+			label = int(index.labels[sample])
+			if label not in answeredLabels: # neighbours are sorted, thus the first one of a class is its nearest.
+				answeredLabels.add(label)
+				answer.append({'symbol': index.symbols[label], 'score': distance})
+		return answer
+
+	def close(self):
+		pass
+
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] not in ['hwrt', 'detexify']:
+		print('Please give as args the service whose dataset is to be indexed (hwrt or detexify), and optionally the dataset path.')
+		exit()
+	try:
+		config = services.localServicesConfig['knn'] # index built with the settings of the service.
+		service = sys.argv[1] if len(sys.argv) > 1 else config['datasetService']
+		datasetPath = sys.argv[2] if len(sys.argv) > 2 else loader.getDatasetPaths(service)[0]
+		index = buildIndex(service, datasetPath, config['pointsNumber'], loader.getSymbolsSet(service))
+		index.save(config.get('indexPath', knnIndexPath))
+	except Exception:
+		print('\nFailure happened while building the kNN index:\n')
+		print(traceback.format_exc())
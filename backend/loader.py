@@ -1,4 +1,5 @@
-import os, traceback, json
+import os, traceback, json, random, mmap, itertools, multiprocessing
+from collections import deque
 from pathlib import Path
 
 # Backend code:
@@ -12,6 +13,9 @@ answersDir = Path('answers/')
 frequenciesDir = Path('frequencies/')
 recapDir = Path('recap/')
 unrecognizedDir = Path('unrecognized/')
+cacheDir = Path('cache/')
+recordsDir = Path('records/')
+checkpointsDir = Path('checkpoints/')
 
 symbolsListsDir = symbolsDir / 'services'
 mappingsDir = symbolsDir / 'mappings'
@@ -50,13 +54,16 @@ _latexToUnicodeMap = {}
 
 # Returns a map to convert latex commands to unicode values:
 def getLatexToUnicodeMap():
+	global _latexToUnicodeMap
 	try:
 		if _latexToUnicodeMap != {}:
 			return _latexToUnicodeMap
+		latexToUnicodeMap = {} # filled before being shared, for other threads to never see it partially loaded.
 		lines = getFileLines(latexToUnicodePath)[1:]
 		for line in lines:
 			latex, unic = line.split('\t')
-			_latexToUnicodeMap[latex] = unic
+			latexToUnicodeMap[latex] = unic
+		_latexToUnicodeMap = latexToUnicodeMap
 		print('Loaded LaTeX -> unicode map.')
 	except:
 		print('Could not load the LaTeX -> unicode map from %s' % latexToUnicodePath)
@@ -71,7 +78,7 @@ def getSymbolUnicode(symbol):
 
 
 def getSupportedServices():
-	return ['hwrt', 'detexify'] # hardcoded for now, later files in ../symbols/services/ could be listed.
+	return ['hwrt', 'detexify', 'knn', 'ensemble'] # hardcoded for now, later files in ../symbols/services/ could be listed.
 
 
 def getSupportedMappings():
@@ -82,9 +89,23 @@ def getSupportedMappings():
 
 _symbolsLoader = {}
 
+# Returns the names of the symbols lists of ../symbols/services/ holding the symbols supported by the given service.
+# An ensemble supports the symbols of all its services, and a local service those of the dataset it is built from.
+def getSymbolsListsNames(service):
+	import ensemble, services # lazy imports, those modules importing this one, at least indirectly.
+	if service == 'ensemble':
+		return sorted({ name for member in ensemble.ensembleConfig['services'] for name in getSymbolsListsNames(member) })
+	if service in services.localServicesConfig:
+		return [services.localServicesConfig[service]['datasetService']]
+	return [service]
+
+
 # Returns a set of the supported symbols by the given service.
 # This must not rely on getSymbolsDatasetMap(), for symbols list files must follow the same pattern.
 def getSymbolsSet(service):
+	names = getSymbolsListsNames(service)
+	if names != [service]:
+		return set().union(*[ getSymbolsSet(name) for name in names ])
 	try:
 		if service in _symbolsLoader:
 			return _symbolsLoader[service]
@@ -98,6 +119,13 @@ def getSymbolsSet(service):
 		return set()
 
 
+# Forgets the loaded symbols lists and LaTeX -> unicode map, for them to be reloaded from their files on next use:
+def forgetSymbolsData():
+	global _latexToUnicodeMap
+	_latexToUnicodeMap = {}
+	_symbolsLoader.clear()
+
+
 # Returns a sorted list of the supported symbols by the given service:
 def getSymbolsSorted(service):
 	return sorted(getSymbolsSet(service))
@@ -134,48 +162,325 @@ def getSymbolName(symbolMap, key):
 # By default, a dataset will be partially loaded: strokes will be kept as strings. This is done
 # in order to do quick searches in a dataset without using lots of memory. To do a full loading,
 # either use fullLoading=True, or use json.loads() on each string-strokes of the result when needed.
-def loadDataset(service, datasetPath, fullLoading=False):
+# If processesNumber > 1, the dataset is parsed in parallel, see loadDatasetParallel().
+# See iterDataset() for the other args.
+def loadDataset(service, datasetPath, fullLoading=False, processesNumber=1, **kwargs):
+	print("\n-> Loading the dataset for service '%s' from %s" % (service, datasetPath))
+	if processesNumber > 1:
+		dataset = loadDatasetParallel(service, datasetPath, fullLoading, processesNumber, **kwargs)
+	else:
+		try:
+			dataset = list(iterDataset(service, datasetPath, fullLoading=fullLoading, **kwargs))
+		except Exception:
+			print('\nFailure happened while trying to load a dataset:\n')
+			print(traceback.format_exc())
+			return []
+	print('Loaded %d samples.' % len(dataset))
+	return dataset
+
+
+# Parses a dataset with several processes. The block of samples of the dataset file is split into byte ranges
+# aligned on lines, which are parsed in parallel and merged back in the original order. Same args as loadDataset().
+# With fullLoading=True, parsed strokes are sent back by the processes as columnar arrays, for unpickling
+# millions of points not to be done serially. The result is then an in-memory columnar.ColumnarDataset,
+# whose samples are the same as those of loadDataset(), but only decoded when accessed.
+def loadDatasetParallel(service, datasetPath, fullLoading=False, processesNumber=None,
+	skip=0, limit=None, last=None, symbolsSet=None):
 	try:
-		print("\n-> Loading the dataset for service '%s' from %s" % (service, datasetPath))
-		dataset = []
-		with open(datasetPath, 'r') as file:
-			lines = iter(file.readline, '') # faster and uses less RAM than with getFileLines() or csv.reader()
-			if service == 'hwrt':
-				symbolMap = getSymbolsDatasetMap(service)
-				next(lines) # skipping the header
-				for line in lines:
-					if line == '\n': # skipping empty lines.
-						continue
-					splitted = line.split(';')
-					symbol = getSymbolName(symbolMap, splitted[0])
-					strokes = json.loads(splitted[2]) if fullLoading else splitted[2]
-					dataset.append((symbol, strokes))
-			elif service == 'detexify':
-				isData = False
-				for line in lines:
-					if '\\.' in line: # reached the end.
-						break
-					elif isData:
-						if line == '\n': # skipping empty lines.
-							continue
-						splitted = line.split('\t')
-						symbol = formatter.extractLatexCommand_detexify(splitted[1])
-						strokes = splitted[2]
-						if fullLoading:
-							strokes = formatter.formatStrokesTo('hwrt', json.loads(strokes))
-						dataset.append((symbol, strokes))
-					elif 'COPY samples' in line: # start of actual data.
-						isData = True
-			else:
-				print('Unsupported service:', service)
-			print('Loaded %d samples.' % len(dataset))
-			return dataset
+		processesNumber = os.cpu_count() if processesNumber is None else processesNumber
+		start, end = getSamplesByteRange(service, datasetPath)
+		chunksNumber = 4 * processesNumber # smaller chunks, for the load to be balanced.
+		with open(datasetPath, 'rb') as file:
+			bounds = [start]
+			for i in range(1, chunksNumber):
+				file.seek(max(bounds[-1], start + (end - start) * i // chunksNumber))
+				file.readline() # aligning the bound on the next line.
+				bounds.append(min(file.tell(), end))
+			bounds.append(end)
+		chunks = [ (service, datasetPath, bounds[i], bounds[i+1], fullLoading) for i in range(chunksNumber) ]
+		with multiprocessing.Pool(processesNumber) as pool:
+			chunks = pool.map(_parseSamplesChunk, chunks) # order is kept.
+		if fullLoading:
+			import columnar # not imported globally, since it relies on this module.
+			dataset = columnar.mergeArrays(service, chunks)
+		else:
+			dataset = list(itertools.chain.from_iterable(chunks))
+		if last is not None:
+			skip += max(0, len(dataset) - last)
+		dataset = dataset[skip:] if limit is None else dataset[skip:skip + limit]
+		if symbolsSet is not None:
+			dataset = [ sample for sample in dataset if sample[0] in symbolsSet ] if not fullLoading else \
+				dataset.select([ i for i in range(len(dataset)) if dataset.getSymbol(i) in symbolsSet ])
+		return dataset
 	except Exception:
 		print('\nFailure happened while trying to load a dataset:\n')
 		print(traceback.format_exc())
 		return []
 
 
+# Returns the byte offsets of the start and the end of the block of samples of a dataset file:
+def getSamplesByteRange(service, datasetPath):
+	with open(datasetPath, 'rb') as file:
+		if service == 'hwrt':
+			file.readline() # skipping the header
+			return (file.tell(), os.path.getsize(datasetPath))
+		elif service == 'detexify':
+			with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+				start = content.find(b'COPY samples') # start of actual data.
+				start = content.find(b'\n', start) + 1
+				end = content.find(b'\\.', start) # reached the end.
+				end = content.rfind(b'\n', start, end) + 1 if end >= 0 else len(content)
+				return (start, max(start, end))
+		else:
+			raise ValueError('Unsupported service: %s' % service)
+
+
+# Parses the samples in the given byte range of a dataset file. Used by the processes of loadDatasetParallel().
+def _parseSamplesChunk(chunk):
+	service, datasetPath, start, end, fullLoading = chunk
+	with open(datasetPath, 'rb') as file:
+		file.seek(start)
+		lines = file.read(end - start).decode().split('\n')
+	lines = [ line + '\n' for line in lines if line != '' ] # skipping empty lines.
+	parseSample = getSampleParser(service, fullLoading)
+	if fullLoading:
+		import columnar
+		return columnar.parseToArrays(lines, parseSample)
+	return [ parseSample(line) for line in lines ]
+
+
+# Yields the samples of a dataset one at a time, as they are parsed. Same format as loadDataset().
+# - skip, limit: number of samples to skip from the start, and max number of samples to yield.
+# - last: if given, only the last samples of the dataset are considered, skip and limit being then
+#   relative to those. This requires a first quick pass on the dataset, to count its samples.
+# - symbolsSet: if given, only samples whose symbol belongs to this set are yielded. This filter is
+#   applied after the previous ones, e.g with mappings.getSymbolCandidatesSet().
+# Errors are raised to the caller, for a failure not to be mistaken for the end of the dataset.
+def iterDataset(service, datasetPath, fullLoading=False, skip=0, limit=None, last=None, symbolsSet=None):
+	if last is not None:
+		skip += max(0, countSamples(service, datasetPath) - last)
+	parseSample = getSampleParser(service, fullLoading)
+	position = 0
+	for line in iterSamplesLines(service, datasetPath):
+		if limit is not None and position >= skip + limit:
+			break
+		if position >= skip:
+			sample = parseSample(line)
+			if symbolsSet is None or sample[0] in symbolsSet:
+				yield sample
+		position += 1
+
+
+# Returns the last samples of a dataset, as a list. Same format as loadDataset(). Unlike iterDataset() with 'last',
+# the dataset is read once: the lines of the last samples are kept while reading, and only those are parsed.
+def loadLastSamples(service, datasetPath, last, fullLoading=False):
+	parseSample = getSampleParser(service, fullLoading)
+	lines = deque(iterSamplesLines(service, datasetPath), maxlen=last) if last > 0 else []
+	return [ parseSample(line) for line in lines ]
+
+
+# Returns a function parsing a line of a dataset of the given service into a sample:
+def getSampleParser(service, fullLoading=False):
+	if service == 'hwrt':
+		symbolMap = getSymbolsDatasetMap(service)
+		return lambda line : parseSample_hwrt(line, symbolMap, fullLoading)
+	elif service == 'detexify':
+		return lambda line : parseSample_detexify(line, fullLoading)
+	raise ValueError('Unsupported service: %s' % service)
+
+
+# Yields the lines of a dataset which contain a sample, without parsing them:
+def iterSamplesLines(service, datasetPath):
+	with open(datasetPath, 'r') as file:
+		lines = iter(file.readline, '') # faster and uses less RAM than with getFileLines() or csv.reader()
+		if service == 'hwrt':
+			next(lines) # skipping the header
+			for line in lines:
+				if line == '\n': # skipping empty lines.
+					continue
+				yield line
+		elif service == 'detexify':
+			isData = False
+			for line in lines:
+				if '\\.' in line: # reached the end.
+					break
+				elif isData:
+					if line == '\n': # skipping empty lines.
+						continue
+					yield line
+				elif 'COPY samples' in line: # start of actual data.
+					isData = True
+		else:
+			print('Unsupported service:', service)
+
+
+def countSamples(service, datasetPath):
+	return sum(1 for line in iterSamplesLines(service, datasetPath))
+
+
+def parseSample_hwrt(line, symbolMap, fullLoading=False):
+	splitted = line.split(';')
+	symbol = getSymbolName(symbolMap, splitted[0])
+	strokes = json.loads(splitted[2]) if fullLoading else splitted[2]
+	return (symbol, strokes)
+
+
+def parseSample_detexify(line, fullLoading=False):
+	splitted = line.split('\t')
+	symbol = formatter.extractLatexCommand_detexify(splitted[1])
+	strokes = splitted[2]
+	if fullLoading:
+		strokes = formatter.formatStrokesTo('hwrt', json.loads(strokes))
+	return (symbol, strokes)
+
+
+# Re-iterable dataset, whose samples are parsed again by iterDataset() at each iteration.
+# Memory usage is then constant, for consumers which only need sequential passes.
+# With 'last', the samples of the dataset are only counted on the first iteration.
+class StreamedDataset:
+	def __init__(self, service, datasetPath, **kwargs):
+		self.service = service # str
+		self.datasetPath = datasetPath # Path
+		self.kwargs = kwargs # see iterDataset()
+		self.length = None
+		self.samplesNumber = None # of the whole dataset, counted if 'last' is given.
+
+	def __iter__(self):
+		kwargs = dict(self.kwargs)
+		last = kwargs.pop('last', None)
+		if last is not None:
+			if self.samplesNumber is None:
+				self.samplesNumber = countSamples(self.service, self.datasetPath)
+			kwargs['skip'] = kwargs.get('skip', 0) + max(0, self.samplesNumber - last)
+		return iterDataset(self.service, self.datasetPath, **kwargs)
+
+	def __len__(self):
+		if self.length is None:
+			self.length = sum(1 for sample in self)
+		return self.length
+
+
+def getDefaultDatasetPath(service):
+	if service == 'hwrt':
+		return testDatasetPath_hwrt
+	elif service == 'detexify':
+		return datasetPath_detexify
+	print('Unsupported service:', service)
+	return None
+
+
+# Returns the paths of all the dataset files of the given service, e.g train and test splits:
+def getDatasetPaths(service):
+	if service == 'hwrt':
+		return [trainDatasetPath_hwrt, testDatasetPath_hwrt]
+	elif service == 'detexify':
+		return [datasetPath_detexify]
+	print('Unsupported service:', service)
+	return []
+
+
+_symbolIndexesLoader = {}
+
+# Returns an index of the given dataset file: a dict mapping each symbol to the byte offsets of its samples lines.
+# It is saved next to the dataset file, and rebuilt only when the latter changes (size or modification time).
+def getSymbolIndex(service, datasetPath):
+	datasetPath = Path(datasetPath)
+	indexPath = datasetPath.with_name(datasetPath.name + '.index.json')
+	fileStat = os.stat(datasetPath)
+	signature = [fileStat.st_size, fileStat.st_mtime]
+	if datasetPath in _symbolIndexesLoader and _symbolIndexesLoader[datasetPath]['signature'] == signature:
+		return _symbolIndexesLoader[datasetPath]['symbols']
+	try:
+		index = json.loads(getFileContent(indexPath))
+		assert index['signature'] == signature, 'Outdated index.'
+	except Exception:
+		index = {'signature': signature, 'symbols': buildSymbolIndex(service, datasetPath)}
+		writeContent(indexPath, json.dumps(index, separators=(',', ':')))
+	_symbolIndexesLoader[datasetPath] = index
+	return index['symbols']
+
+
+def buildSymbolIndex(service, datasetPath):
+	print("\n-> Building the symbol index of the dataset for service '%s' from %s" % (service, datasetPath))
+	if service == 'hwrt':
+		symbolMap = getSymbolsDatasetMap(service)
+		getSymbol = lambda line : getSymbolName(symbolMap, line.split(b';', 1)[0].decode())
+	elif service == 'detexify':
+		getSymbol = lambda line : formatter.extractLatexCommand_detexify(line.split(b'\t', 2)[1].decode())
+	else:
+		raise ValueError('Unsupported service: %s' % service)
+	start, end = getSamplesByteRange(service, datasetPath)
+	symbols = {}
+	with open(datasetPath, 'rb') as file:
+		file.seek(start)
+		offset = start
+		while offset < end:
+			line = file.readline()
+			if line.strip() != b'': # skipping empty lines.
+				symbol = getSymbol(line)
+				if symbol not in symbols:
+					symbols[symbol] = []
+				symbols[symbol].append(offset)
+			offset += len(line)
+	print('Indexed %d symbols.' % len(symbols))
+	return symbols
+
+
+# Returns the offsets of the samples of the given symbol. If a mapping is given, the
+# samples of all the symbols projected to the given one (i.e its class) are returned.
+def getSymbolOffsets(service, symbol, datasetPath, mapping='none'):
+	index = getSymbolIndex(service, datasetPath)
+	if mapping == 'none':
+		return index.get(symbol, [])
+	import mappings # not imported globally, since it relies on this module.
+	offsets = []
+	for key in index:
+		if mappings.getProjectedSymbol(key, mapping) == symbol:
+			offsets.extend(index[key])
+	return sorted(offsets) # keeping the dataset order.
+
+
+# Reads the samples at the given offsets, in the same format as loadDataset().
+def readSamples(service, datasetPath, offsets, fullLoading=False):
+	if service == 'hwrt':
+		symbolMap = getSymbolsDatasetMap(service)
+		parseSample = lambda line : parseSample_hwrt(line, symbolMap, fullLoading)
+	else:
+		parseSample = lambda line : parseSample_detexify(line, fullLoading)
+	samples = []
+	with open(datasetPath, 'rb') as file:
+		for offset in offsets:
+			file.seek(offset)
+			samples.append(parseSample(file.readline().decode()))
+	return samples
+
+
+# Returns up to 'limit' samples (all if None) of the given symbol, or class if a mapping is given,
+# without scanning the dataset file. By default, the dataset used is getDefaultDatasetPath(service).
+def getSamples(service, symbol, limit=None, datasetPath=None, mapping='none', fullLoading=False):
+	datasetPath = getDefaultDatasetPath(service) if datasetPath is None else datasetPath
+	offsets = getSymbolOffsets(service, symbol, datasetPath, mapping)
+	return readSamples(service, datasetPath, offsets[:limit], fullLoading)
+
+
+# Returns up to 'perClass' randomly chosen samples for each symbol, or class if a mapping is given.
+# Samples are grouped by class, classes being sorted. Results only depend on the given seed.
+def getStratifiedSamples(service, perClass, datasetPath=None, mapping='none', seed=0, fullLoading=False):
+	datasetPath = getDefaultDatasetPath(service) if datasetPath is None else datasetPath
+	index = getSymbolIndex(service, datasetPath)
+	if mapping == 'none':
+		classes = index.keys()
+	else:
+		import mappings
+		classes = set([ mappings.getProjectedSymbol(key, mapping) for key in index ])
+	rng = random.Random(seed)
+	offsets = []
+	for symbolClass in sorted(classes):
+		classOffsets = getSymbolOffsets(service, symbolClass, datasetPath, mapping)
+		offsets.extend(sorted(rng.sample(classOffsets, min(perClass, len(classOffsets)))))
+	return readSamples(service, datasetPath, offsets, fullLoading)
+
+
 if __name__ == '__main__':
 	testDataset = loadDataset('hwrt', testDatasetPath_hwrt)
 	firstSymbol, strokesString = testDataset[0]
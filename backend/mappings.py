@@ -1,4 +1,5 @@
 import json
+import numpy as np
 
 # Backend code:
 import loader, formatter
@@ -31,6 +32,13 @@ def getMapping(mappingName):
 	return _mappingsLoader[mappingName]
 
 
+# Forgets the loaded mappings, for them to be reloaded from their files on next use:
+def forgetMappings():
+	for mappingName in list(_mappingsLoader.keys()):
+		if mappingName != 'none': # default mapping, not loaded from a file.
+			_mappingsLoader.pop(mappingName, None)
+
+
 def getEquivalenceClasses(mappingPath):
 	return json.loads(loader.getFileContent(mappingPath))
 
@@ -61,7 +69,7 @@ def getProjectedSymbolsSet(symbols, mappingName):
 
 
 def getProjectedSymbol(symbol, mappingName):
-	return list(getProjectedSymbolsSet([symbol], mappingName))[0]
+	return getMapping(mappingName).projection.get(symbol, symbol)
 
 
 def getServiceProjectedSymbolsSet(service, mappingName):
@@ -86,6 +94,75 @@ def getSymbolCandidatesSet(service, mappingNamesList):
 	return symbolCandidatesSet
 
 
+# Compiled form of several mappings, to project many symbols with all of them at once. Symbols are given integer
+# ids in a shared vocabulary, and each mapping is compiled to an array giving the projected id of each symbol id.
+# Projecting a list of symbols with every mapping is then a single gather. Symbols unknown to the vocabulary
+# are added on the fly, and projected to themselves like getProjectedSymbol() does.
+class CompiledMappings:
+	def __init__(self, mappingNames, symbols=[]):
+		self.mappingNames = list(mappingNames)
+		self.mappingIndexes = { m : i for i, m in enumerate(self.mappingNames) }
+		self.symbols = [] # id -> symbol
+		self.symbolIds = {} # symbol -> id
+		self.projections = np.zeros((len(self.mappingNames), 64), dtype=np.int32) # mapping index, id -> projected id
+		for m in self.mappingNames:
+			mapp = getMapping(m)
+			self.getIds(mapp.projection.keys())
+			self.getIds(mapp.projection.values())
+		self.getIds(symbols)
+		for i, m in enumerate(self.mappingNames):
+			projection = getMapping(m).projection
+			for symbol, key in projection.items():
+				self.projections[i, self.symbolIds[symbol]] = self.symbolIds[key]
+
+	# Returns the ids of the given symbols, as an array:
+	def getIds(self, symbols):
+		ids = []
+		for symbol in symbols:
+			if symbol not in self.symbolIds:
+				self._addSymbol(symbol)
+			ids.append(self.symbolIds[symbol])
+		return np.array(ids, dtype=np.int32)
+
+	def _addSymbol(self, symbol):
+		newId = len(self.symbols)
+		if newId >= self.projections.shape[1]: # growing arrays by doubling, the added columns being overwritten below.
+			self.projections = np.concatenate([self.projections, np.zeros_like(self.projections)], axis=1)
+		self.projections[:, newId] = newId # projected to itself.
+		self.symbols.append(symbol)
+		self.symbolIds[symbol] = newId
+
+	# Returns the projected ids of the given symbols with every mapping, as an
+	# array of shape (mappings number, symbols number), rows being in the mappings order.
+	def projectIds(self, symbols):
+		return self.projections[:, self.getIds(symbols)]
+
+	# Same as projectIds(), returning a dict: mapping name -> list of projected symbols.
+	def projectSymbols(self, symbols):
+		projectedIds = self.projectIds(symbols).tolist()
+		return { m : self.getSymbols(projectedIds[index]) for m, index in self.mappingIndexes.items() }
+
+	def getSymbols(self, ids):
+		return [ self.symbols[i] for i in ids ]
+
+	# Aggregates answers given by their symbol ids and scores with every mapping, like formatter.aggregateAnswers().
+	# Returns for each mapping, in the mappings order, the array of the answered classes ids, best first:
+	# - if summingScores is True, scores of a class are summed, and classes sorted by decreasing score.
+	# - else, answers must be sorted by increasing distance, each class keeping its first (min) one.
+	# In both cases, ties are broken by the first occurrence of each class.
+	def aggregateIds(self, ids, scores, summingScores):
+		results = []
+		for projectedIds in self.projections[:, ids]:
+			classes, firstIndexes, inverse = np.unique(projectedIds, return_index=True, return_inverse=True)
+			if summingScores:
+				sums = np.bincount(inverse, weights=scores, minlength=len(classes)) # same summation order.
+				order = np.lexsort((firstIndexes, -sums))
+			else:
+				order = np.argsort(firstIndexes)
+			results.append(classes[order])
+		return results
+
+
 # Creating a new mapping by composing two given mappings
 # mapping1 and mapping2 into mapping1 o mapping2:
 def mappingsComposition(mapping1, mapping2, newMappingName):
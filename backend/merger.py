@@ -0,0 +1,190 @@
+import os, csv, json, math, random, shutil, hashlib, argparse, traceback
+from pathlib import Path
+
+# Backend code:
+import loader, formatter, preprocessing, dedup
+
+
+# Unified dataset format: CSV files with ';' as separator and '\n' as newline, with the header below. 'strokes' is the
+# compact JSON of a list of strokes, each stroke being a list of points [x, y, time], time starting from 0 for each sample.
+# Merged datasets are split in train and test parts, themselves split in shards of bounded size, named e.g 'train-003.csv'.
+# A manifest lists the shards with their samples number and SHA-256 checksum, also given in a 'sha256sum' compatible file.
+unifiedHeader = ['id', 'symbol', 'strokesNumber', 'totalPoints', 'userAgent', 'strokes']
+unifiedDatasetDir = loader.datasetDir / 'unified'
+
+# Merged datasets, and the service whose parser is used for each of them:
+mergerSources = {
+	'hwrt-train': ('hwrt', loader.trainDatasetPath_hwrt),
+	'hwrt-test': ('hwrt', loader.testDatasetPath_hwrt),
+	'detexify': ('detexify', loader.datasetPath_detexify),
+}
+
+# Preprocessing applied to each sample, see preprocessing.py:
+unifiedPipeline = [
+	('reshiftTime', {}),
+	('normalize', {'margin': 0.}),
+]
+
+
+# Returns the row of a sample in the unified format. Coordinates are rounded to 'precision' decimals, and time to ms.
+def getUnifiedRow(sampleId, symbol, points, strokeOffsets, userAgent='', precision=2):
+	pointsList = points.tolist()
+	bounds = strokeOffsets.tolist()
+	strokes = [ [ [round(x, precision), round(y, precision), int(round(t))] for x, y, t in pointsList[bounds[i]:bounds[i + 1]] ]
+		for i in range(len(bounds) - 1) ]
+	return [sampleId, symbol, len(strokes), len(pointsList), userAgent, formatter.compactStrokesString(strokes)]
+
+
+# Writes rows to numbered shards of at most 'shardSize' samples, computing their checksum on the fly.
+class ShardsWriter:
+	def __init__(self, dirPath, prefix, shardSize):
+		self.dirPath = Path(dirPath)
+		self.prefix = prefix # str
+		self.shardSize = shardSize # int, in samples
+		self.shards = [] # list of dict: name, samplesNumber, sha256
+		self.file = None
+
+	def writeRow(self, row):
+		if self.file is None or self.shards[-1]['samplesNumber'] >= self.shardSize:
+			self._openShard()
+		self.writer.writerow(row)
+		self.shards[-1]['samplesNumber'] += 1
+
+	def _openShard(self):
+		self._closeShard()
+		name = '%s-%03d.csv' % (self.prefix, len(self.shards))
+		self.file = open(self.dirPath / name, 'w', newline='')
+		self.hashingWriter = HashingWriter(self.file)
+		self.writer = csv.writer(self.hashingWriter, delimiter=';', lineterminator='\n')
+		self.writer.writerow(unifiedHeader)
+		self.shards.append({'name': name, 'samplesNumber': 0})
+
+	def _closeShard(self):
+		if self.file is not None:
+			self.shards[-1]['sha256'] = self.hashingWriter.hash.hexdigest()
+			self.file.close()
+			self.file = None
+
+	def close(self):
+		self._closeShard()
+		return self.shards
+
+
+# File wrapper, hashing what is written to it:
+class HashingWriter:
+	def __init__(self, file):
+		self.file = file
+		self.hash = hashlib.sha256()
+
+	def write(self, content):
+		self.hash.update(content.encode())
+		return self.file.write(content)
+
+
+# Merges the given sources into a unified dataset in 'outputDir'. Samples are streamed through the loader, thus are
+# labelled with the symbols names of their service, then preprocessed with 'pipeline'. The shuffle is external: samples
+# are first spread randomly over bucket files of at most about 'bucketSize' samples, each being then shuffled in memory.
+# Memory usage is thus bounded by the buckets size, whatever the datasets size. Results only depend on 'seed'.
+# - sources: list of source names from mergerSources, or of couples (service, datasetPath).
+# - dedupIndex: if given, a dedup.DedupIndex against which samples are checked, duplicates being dropped.
+def mergeDatasets(sources, outputDir=unifiedDatasetDir, testRatio=0.1, shardSize=50000, bucketSize=20000,
+	seed=0, pipeline=unifiedPipeline, dedupIndex=None):
+	outputDir = Path(outputDir)
+	bucketsDir = outputDir / 'buckets'
+	try:
+		sources = [ mergerSources[source] if type(source) == str else source for source in sources ]
+		samplesNumber = sum(loader.countSamples(service, path) for service, path in sources)
+		bucketsNumber = max(1, math.ceil(samplesNumber / bucketSize))
+		print('\n-> Merging %d samples from %d datasets, through %d buckets.' % (samplesNumber, len(sources), bucketsNumber))
+		os.makedirs(bucketsDir, exist_ok=True)
+		rng = random.Random(seed)
+		stats = spreadSamples(sources, bucketsDir, bucketsNumber, testRatio, rng, pipeline, dedupIndex)
+		manifest = {'format': 'unified', 'header': unifiedHeader, 'seed': seed, 'sources': [ str(path) for service, path in sources ],
+			'stats': stats, 'splits': {}}
+		for split in ['train', 'test']:
+			shardsWriter = ShardsWriter(outputDir, split, shardSize)
+			for bucket in range(bucketsNumber):
+				bucketPath = bucketsDir / ('%s-%d.csv' % (split, bucket))
+				if not bucketPath.exists():
+					continue
+				with open(bucketPath, 'r', newline='') as file:
+					rows = list(csv.reader(file, delimiter=';'))
+				rng.shuffle(rows)
+				for row in rows:
+					shardsWriter.writeRow(row)
+				os.remove(bucketPath)
+			manifest['splits'][split] = shardsWriter.close()
+		shutil.rmtree(bucketsDir)
+		loader.writeContent(outputDir / 'manifest.json', json.dumps(manifest, indent='  '))
+		loader.writeContent(outputDir / 'checksums.sha256', ''.join('%s  %s\n' % (shard['sha256'], shard['name'])
+			for shards in manifest['splits'].values() for shard in shards))
+		print('Merged %d samples: %s' % (stats['written'], ', '.join('%d %s shards' % (len(shards), split)
+			for split, shards in manifest['splits'].items())))
+		return manifest
+	except Exception:
+		print('\nFailure happened while merging datasets:\n')
+		print(traceback.format_exc())
+		return None
+
+
+# First pass of mergeDatasets(): each sample is given an id, a split and a random bucket.
+def spreadSamples(sources, bucketsDir, bucketsNumber, testRatio, rng, pipeline, dedupIndex):
+	stats = {'read': 0, 'written': 0, 'discarded': 0, 'duplicates': 0}
+	files, writers = {}, {}
+	try:
+		for service, datasetPath in sources:
+			for rank, (symbol, strokes) in enumerate(loader.iterDataset(service, datasetPath)):
+				stats['read'] += 1
+				sample = preprocessing.applyPipeline(pipeline, *formatter.strokesToArrays(json.loads(strokes)))
+				if sample is None:
+					stats['discarded'] += 1
+					continue
+				if dedupIndex is not None and dedupIndex.add(*sample, '%s:%d' % (Path(datasetPath).stem, rank))[0] is not None:
+					stats['duplicates'] += 1
+					continue
+				bucket = ('test' if rng.random() < testRatio else 'train', rng.randrange(bucketsNumber))
+				if bucket not in files:
+					files[bucket] = open(bucketsDir / ('%s-%d.csv' % bucket), 'w', newline='')
+					writers[bucket] = csv.writer(files[bucket], delimiter=';', lineterminator='\n')
+				writers[bucket].writerow(getUnifiedRow(stats['written'], symbol, *sample))
+				stats['written'] += 1
+	finally:
+		for file in files.values():
+			file.close()
+	return stats
+
+
+# Checks the shards of a merged dataset against its manifest. Returns True if they are all valid.
+def verifyChecksums(datasetDir=unifiedDatasetDir):
+	datasetDir = Path(datasetDir)
+	manifest = json.loads(loader.getFileContent(datasetDir / 'manifest.json'))
+	valid = True
+	for shards in manifest['splits'].values():
+		for shard in shards:
+			fileHash = hashlib.sha256()
+			with open(datasetDir / shard['name'], 'rb') as file:
+				for block in iter(lambda : file.read(1 << 20), b''):
+					fileHash.update(block)
+			if fileHash.hexdigest() != shard['sha256']:
+				print('Invalid checksum for shard:', shard['name'])
+				valid = False
+	return valid
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Merges datasets into a shuffled dataset in the unified format.')
+	parser.add_argument('sources', nargs='*', default=list(mergerSources.keys()),
+		help='merged datasets, among: %s.' % ', '.join(mergerSources.keys()))
+	parser.add_argument('--output', default=str(unifiedDatasetDir), help='directory of the merged dataset.')
+	parser.add_argument('--test-ratio', type=float, default=0.1)
+	parser.add_argument('--shard-size', type=int, default=50000, help='max number of samples per shard.')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--dedup', action='store_true', help='drops exact and near duplicates, see dedup.py.')
+	parser.add_argument('--verify', action='store_true', help='only verifies the checksums of a merged dataset.')
+	args = parser.parse_args()
+	if args.verify:
+		print('Valid checksums.' if verifyChecksums(args.output) else 'Invalid checksums!')
+		exit()
+	dedupIndex = dedup.DedupIndex(None, **dedup.dedupConfig) if args.dedup else None
+	mergeDatasets(args.sources, args.output, testRatio=args.test_ratio, shardSize=args.shard_size,
+		seed=args.seed, dedupIndex=dedupIndex)
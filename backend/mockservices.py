@@ -0,0 +1,151 @@
+import json, math, time, random, hashlib, argparse, threading
+from flask import Flask, request, Response, jsonify
+from werkzeug.serving import make_server
+
+# Backend code:
+import loader
+
+
+# Stand-in servers for the classification services, answering in the exact format of hwrt and detexify, on the same
+# ports and routes. Answered symbols are drawn from ../symbols/services/, deterministically given the request strokes
+# and 'seed': the same drawing always gets the same answer. Each request is delayed by a random latency, and fails
+# with 'errorStatus' with probability 'errorRate'. Latencies are in seconds, following 'latencyDistribution':
+# - 'constant': always 'latency'.
+# - 'uniform': uniform in [latency * (1 - latencySpread), latency * (1 + latencySpread)].
+# - 'lognormal': of median 'latency', the std of its log being 'latencySpread'. Gives a realistic long tail.
+# - 'exponential': of mean 'latency'.
+mockServicesConfig = {
+	'hwrt': {
+		'port': 5000,
+		'answersNumber': 10, # as hwrt.
+		'latency': 0.05,
+		'latencyDistribution': 'lognormal',
+		'latencySpread': 0.5,
+		'errorRate': 0.,
+		'errorStatus': 503,
+		'seed': 0,
+	},
+	'detexify': {
+		'port': 3000,
+		'answersNumber': None, # all symbols, as detexify.
+		'latency': 0.02,
+		'latencyDistribution': 'lognormal',
+		'latencySpread': 0.5,
+		'errorRate': 0.,
+		'errorStatus': 503,
+		'seed': 0,
+	},
+}
+
+
+# Returns the symbols answered by the mock of the given service, as a list of couples (raw id, symbol):
+def getMockSymbols(service):
+	symbols = sorted(loader.getSymbolsSet(service))
+	if service == 'hwrt':
+		datasetIds = {}
+		if loader.symbolsMap_hwrt.exists(): # ids of the hwrt dataset, when available.
+			datasetIds = { symbol : key for key, symbol in loader.getSymbolsDatasetMap(service).items() }
+		return [ (datasetIds.get(symbol, str(i)), symbol) for i, symbol in enumerate(symbols) ]
+	elif service == 'detexify':
+		return [ ('latex2e-OT1-' + symbol.replace('\\', '_'), symbol) for symbol in symbols ]
+	raise ValueError('Unsupported service: %s' % service)
+
+
+def drawLatency(rng, latency, latencyDistribution, latencySpread):
+	if latencyDistribution == 'constant':
+		return latency
+	elif latencyDistribution == 'uniform':
+		return rng.uniform(latency * (1. - latencySpread), latency * (1. + latencySpread))
+	elif latencyDistribution == 'lognormal':
+		return rng.lognormvariate(math.log(latency), latencySpread) if latency > 0. else 0.
+	elif latencyDistribution == 'exponential':
+		return rng.expovariate(1. / latency) if latency > 0. else 0.
+	raise ValueError('Unsupported latency distribution: %s' % latencyDistribution)
+
+
+# Answer of the mock service, in the format of the real one. 'content' is the request strokes, as a string:
+def getMockAnswer(service, symbols, content, answersNumber, seed):
+	rng = random.Random(hashlib.sha256(('%d:%s' % (seed, content)).encode()).digest())
+	answersNumber = len(symbols) if answersNumber is None else min(answersNumber, len(symbols))
+	picked = rng.sample(symbols, answersNumber)
+	if service == 'hwrt':
+		weights = sorted((rng.expovariate(1.) ** 2 for i in range(answersNumber)), reverse=True)
+		total = sum(weights) / (1. - rng.random() / 10.) # hwrt probabilities sum up to a bit less than 1.
+		return [ {'semantics': '%s;%s;;%s;;' % (key, symbol, symbol), 'probability': weight / total}
+			for (key, symbol), weight in zip(picked, weights) ]
+	else: # detexify, new version:
+		scores = sorted(rng.uniform(0.05, 1.) for i in range(answersNumber))
+		return {'results': [ {'id': key, 'score': score} for (key, symbol), score in zip(picked, scores) ]}
+
+
+# Creates the Flask app of the mock of the given service, with the settings of mockServicesConfig.
+def createMockApp(service, port=None, answersNumber=10, latency=0.05, latencyDistribution='lognormal', latencySpread=0.5,
+	errorRate=0., errorStatus=503, seed=0):
+	symbols = getMockSymbols(service)
+	faultsRng = random.Random(seed) # latencies and errors, not depending on the request.
+	faultsLock = threading.Lock()
+	stats = {'requests': 0, 'errors': 0}
+	app = Flask('mock-' + service)
+
+	def answer(content):
+		with faultsLock:
+			delay = drawLatency(faultsRng, latency, latencyDistribution, latencySpread)
+			failing = faultsRng.random() < errorRate
+			stats['requests'] += 1
+			stats['errors'] += failing
+		time.sleep(delay)
+		if failing:
+			return Response('Mock failure.', content_type='text/plain; charset=UTF-8', status=errorStatus)
+		return Response(json.dumps(getMockAnswer(service, symbols, content, answersNumber, seed)),
+			content_type='application/json')
+
+	@app.route('/', methods=['GET'])
+	def hello():
+		return jsonify({'mock': service, 'symbols': len(symbols), **stats})
+
+	if service == 'hwrt':
+		@app.route('/worker', methods=['GET', 'POST'])
+		def classify():
+			if request.method == 'GET': # as hwrt, answering its version.
+				return hello()
+			if 'classify' not in request.form:
+				return Response("Missing 'classify' field.", status=400)
+			return answer(request.form['classify'])
+	else:
+		@app.route('/classify', methods=['POST'])
+		def classify():
+			content = request.get_json(force=True, silent=True)
+			if content is None or 'strokes' not in content:
+				return Response("Missing 'strokes' field.", status=400)
+			return answer(json.dumps(content['strokes'], separators=(',', ':')))
+
+	return app
+
+
+# Serves the mock of the given service from a background thread, e.g for tests. Settings default to those of
+# mockServicesConfig. Returns the server, to be stopped with its shutdown() method.
+def startMockService(service, **settings):
+	config = dict(mockServicesConfig[service], **settings)
+	server = make_server('localhost', config['port'], createMockApp(service, **config), threaded=True)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	print("Mock service '%s' running on port %d." % (service, config['port']))
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Runs a mock classification service, answering like the real one.')
+	parser.add_argument('service', choices=list(mockServicesConfig.keys()))
+	parser.add_argument('--port', type=int, help='by default the port of the real service.')
+	parser.add_argument('--answers', type=int, help='number of answered symbols.')
+	parser.add_argument('--latency', type=float, help='median latency in seconds, see mockServicesConfig.')
+	parser.add_argument('--latency-distribution', choices=['constant', 'uniform', 'lognormal', 'exponential'])
+	parser.add_argument('--latency-spread', type=float)
+	parser.add_argument('--error-rate', type=float, help='probability of a request to fail.')
+	parser.add_argument('--error-status', type=int)
+	parser.add_argument('--seed', type=int)
+	args = parser.parse_args()
+	settings = {'port': args.port, 'answersNumber': args.answers, 'latency': args.latency,
+		'latencyDistribution': args.latency_distribution, 'latencySpread': args.latency_spread,
+		'errorRate': args.error_rate, 'errorStatus': args.error_status, 'seed': args.seed}
+	config = dict(mockServicesConfig[args.service], **{ key : value for key, value in settings.items() if value is not None })
+	createMockApp(args.service, **config).run(host='0.0.0.0', port=config['port'], threaded=True)
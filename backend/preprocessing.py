@@ -0,0 +1,258 @@
+import sys, json, math, itertools, traceback
+from pathlib import Path
+import numpy as np
+
+# Backend code:
+import formatter
+
+
+# Strokes preprocessing, done on the NumPy representation of strokes given by formatter.strokesToArrays():
+# a (pointsNumber, 3) points array, and the offsets of each stroke first point. Each stage takes and returns
+# a couple (points, strokeOffsets), or None when the sample must be discarded. Given arrays are never modified.
+
+# Universal box (xmin, xmax, ymin, ymax) in which strokes are rescaled, being the coordinates range of hwrt's dataset:
+universalBox = (-0.5, 2585., -1., 1096.)
+
+
+# Fixed-distance resampling: points are placed every 'step' along each stroke, their time being interpolated.
+# Over-sampled segments are thus merged, and long ones split. Each stroke keeps its first and last points.
+def resample(points, strokeOffsets, step=10.):
+	newPoints, newOffsets = [], [0]
+	for i in range(len(strokeOffsets) - 1):
+		stroke = points[strokeOffsets[i]:strokeOffsets[i + 1]]
+		if len(stroke) > 0:
+			lengths = np.concatenate(([0.], np.cumsum(np.hypot(*np.diff(stroke[:, :2], axis=0).T))))
+			if lengths[-1] == 0.:
+				stroke = stroke[:1] # a single dot.
+			else:
+				targets = np.arange(0., lengths[-1], step)
+				targets = np.append(targets, lengths[-1]) if targets[-1] < lengths[-1] else targets
+				stroke = np.stack([ np.interp(targets, lengths, stroke[:, c]) for c in range(3) ], axis=1)
+			newPoints.append(stroke)
+		newOffsets.append(newOffsets[-1] + len(stroke))
+	return concatenateStrokes(newPoints, newOffsets)
+
+
+# Returns the mask of the points of a stroke kept by the Douglas-Peucker algorithm, i.e
+# the points farther than 'epsilon' from the polyline of the points kept before them:
+def getDouglasPeuckerMask(stroke, epsilon):
+	kept = np.zeros(len(stroke), dtype=bool)
+	kept[[0, -1]] = True
+	ranges = [(0, len(stroke) - 1)]
+	while len(ranges) > 0:
+		first, last = ranges.pop()
+		if last - first < 2:
+			continue
+		origin, direction = stroke[first, :2], stroke[last, :2] - stroke[first, :2]
+		vectors = stroke[first + 1:last, :2] - origin
+		norm = math.hypot(*direction)
+		if norm == 0.: # closed segment, distances to its origin.
+			distances = np.hypot(vectors[:, 0], vectors[:, 1])
+		else:
+			distances = np.abs(direction[0] * vectors[:, 1] - direction[1] * vectors[:, 0]) / norm
+		farthest = int(np.argmax(distances))
+		if distances[farthest] > epsilon:
+			farthest += first + 1
+			kept[farthest] = True
+			ranges.extend([(first, farthest), (farthest, last)])
+	return kept
+
+
+# Douglas-Peucker simplification of each stroke, 'epsilon' being the max distance of a removed point to the result:
+def simplify(points, strokeOffsets, epsilon=2.):
+	newPoints, newOffsets = [], [0]
+	for i in range(len(strokeOffsets) - 1):
+		stroke = points[strokeOffsets[i]:strokeOffsets[i + 1]]
+		if len(stroke) > 2:
+			stroke = stroke[getDouglasPeuckerMask(stroke, epsilon)]
+		newPoints.append(stroke)
+		newOffsets.append(newOffsets[-1] + len(stroke))
+	return concatenateStrokes(newPoints, newOffsets)
+
+
+# Returns the scales and translations fitting samples of the given stats in the given box, keeping their aspect ratio.
+# Samples are centered, with a 'margin' ratio of the box kept empty on each side. Works on arrays of stats:
+def getNormalizationParams(stats, box=universalBox, margin=0.):
+	xmin, xmax, ymin, ymax = np.asarray(stats, dtype=formatter.pointsDtype).T
+	boxWidth, boxHeight = (box[1] - box[0]) * (1. - 2. * margin), (box[3] - box[2]) * (1. - 2. * margin)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		scales = np.fmin(boxWidth / (xmax - xmin), boxHeight / (ymax - ymin)) # NaN ignored when one side is null.
+	scales = np.where(np.isfinite(scales), scales, 1.) # single points are only centered.
+	xShifts = (box[0] + box[1]) / 2. - scales * (xmin + xmax) / 2.
+	yShifts = (box[2] + box[3]) / 2. - scales * (ymin + ymax) / 2.
+	return (scales, xShifts, yShifts)
+
+
+# Rescales and centers strokes in the given box:
+def normalize(points, strokeOffsets, box=universalBox, margin=0.):
+	if len(points) == 0:
+		return (points, strokeOffsets)
+	scale, xShift, yShift = getNormalizationParams(formatter.getPointsStats(points), box, margin)
+	newPoints = points.copy()
+	newPoints[:, 0] = scale * points[:, 0] + xShift
+	newPoints[:, 1] = scale * points[:, 1] + yShift
+	return (newPoints, strokeOffsets)
+
+
+# Batched version of normalize(), for samples stored like in columnar datasets:
+def normalizeBatch(points, strokeOffsets, sampleOffsets, box=universalBox, margin=0.):
+	pointOffsets = formatter.getPointOffsets(strokeOffsets, sampleOffsets)
+	stats = formatter.getBatchPointsStats(points, pointOffsets)
+	scales, xShifts, yShifts = [ np.repeat(param, np.diff(pointOffsets))
+		for param in getNormalizationParams(stats, box, margin) ]
+	newPoints = points[pointOffsets[0]:pointOffsets[-1]].copy()
+	newPoints[:, 0] = scales * newPoints[:, 0] + xShifts
+	newPoints[:, 1] = scales * newPoints[:, 1] + yShifts
+	strokeOffsets = strokeOffsets[sampleOffsets[0]:sampleOffsets[-1] + 1] - pointOffsets[0]
+	return (newPoints, strokeOffsets, sampleOffsets - sampleOffsets[0])
+
+
+# Shifts the sample time to start from 0:
+def reshiftTime(points, strokeOffsets):
+	newPoints = points.copy()
+	formatter.reshiftPointsTime(newPoints)
+	return (newPoints, strokeOffsets)
+
+
+# Discards noisy samples: empty ones, and those with too many strokes or points, or huge timesteps between points.
+def clean(points, strokeOffsets, maxStrokesNumber=50, maxPointsNumber=5000, maxTimestep=10000.):
+	if len(points) == 0 or len(strokeOffsets) - 1 > maxStrokesNumber or len(points) > maxPointsNumber:
+		return None
+	if len(points) > 1 and np.max(np.abs(np.diff(points[:, 2]))) > maxTimestep:
+		return None
+	return (points, strokeOffsets)
+
+
+def concatenateStrokes(pointsList, strokeOffsets):
+	points = np.concatenate(pointsList) if len(pointsList) > 0 else np.zeros((0, 3), dtype=formatter.pointsDtype)
+	return (points, np.array(strokeOffsets, dtype=formatter.offsetsDtype))
+
+
+stages = {
+	'clean': clean,
+	'reshiftTime': reshiftTime,
+	'normalize': normalize,
+	'resample': resample,
+	'simplify': simplify,
+}
+
+# Named pipelines: lists of stages (name, kwargs), applied in order. Distances of the stages following
+# a normalization are in the universal box units, otherwise they are in the strokes own units.
+pipelinesConfig = {
+	'none': [],
+	'light': [
+		('simplify', {'epsilon': 1.}),
+	],
+	'compact': [
+		('normalize', {'margin': 0.}),
+		('resample', {'step': 20.}),
+		('simplify', {'epsilon': 8.}),
+	],
+	'dataset': [
+		('clean', {'maxStrokesNumber': 50, 'maxPointsNumber': 5000, 'maxTimestep': 10000.}),
+		('reshiftTime', {}),
+		('normalize', {'margin': 0.}),
+		('resample', {'step': 10.}),
+		('simplify', {'epsilon': 4.}),
+	],
+}
+
+
+# Applies the given pipeline, being its name or a list of stages. Returns the
+# couple (points, strokeOffsets), or None if the sample has been discarded.
+def applyPipeline(pipeline, points, strokeOffsets):
+	if type(pipeline) == str:
+		pipeline = pipelinesConfig[pipeline]
+	sample = (points, strokeOffsets)
+	for stageName, kwargs in pipeline:
+		sample = stages[stageName](*sample, **kwargs)
+		if sample is None:
+			return None
+	return sample
+
+
+# Preprocesses strokes in any supported format, and returns them in the hwrt format, or None if they have been discarded:
+def preprocessStrokes(strokes, pipeline):
+	sample = applyPipeline(pipeline, *formatter.strokesToArrays(strokes))
+	return None if sample is None else formatter.arraysToStrokes(*sample)
+
+
+# Batched version of applyPipeline(), for samples stored like in columnar datasets. Returns the arrays
+# (points, strokeOffsets, sampleOffsets) of the kept samples, and the boolean mask of the kept samples.
+# A leading normalization is done at once on the whole batch, with normalizeBatch().
+def applyPipelineBatch(pipeline, points, strokeOffsets, sampleOffsets):
+	if type(pipeline) == str:
+		pipeline = pipelinesConfig[pipeline]
+	if len(pipeline) > 0 and pipeline[0][0] == 'normalize':
+		points, strokeOffsets, sampleOffsets = normalizeBatch(points, strokeOffsets, sampleOffsets, **pipeline[0][1])
+		pipeline = pipeline[1:]
+	kept = np.ones(len(sampleOffsets) - 1, dtype=bool)
+	pointsList, newStrokeOffsets, newSampleOffsets = [], [np.zeros(1, dtype=formatter.offsetsDtype)], [0]
+	pointsNumber = 0
+	for i in range(len(sampleOffsets) - 1):
+		offsets = strokeOffsets[sampleOffsets[i]:sampleOffsets[i + 1] + 1]
+		sample = applyPipeline(pipeline, points[offsets[0]:offsets[-1]], offsets - offsets[0])
+		if sample is None:
+			kept[i] = False
+			continue
+		pointsList.append(sample[0])
+		newStrokeOffsets.append(sample[1][1:] + pointsNumber)
+		pointsNumber += len(sample[0])
+		newSampleOffsets.append(newSampleOffsets[-1] + len(sample[1]) - 1)
+	points, strokeOffsets = concatenateStrokes(pointsList, np.concatenate(newStrokeOffsets))
+	return (points, strokeOffsets, np.array(newSampleOffsets, dtype=formatter.offsetsDtype), kept)
+
+
+# Preprocesses a whole dataset with the given pipeline, by shards of 'shardSize' samples. The result is saved in the
+# columnar format, at the given path or next to the dataset. Returns the number of kept samples.
+def preprocessDataset(service, datasetPath, pipeline='dataset', outputPath=None, shardSize=4096):
+	import columnar # lazy import, columnar being built on top of the formatter.
+	outputPath = Path(datasetPath).with_suffix('.%s.columnar' % pipeline) if outputPath is None else Path(outputPath)
+	try:
+		dataset = columnar.loadDataset(service, datasetPath)
+		print("\n-> Preprocessing with the '%s' pipeline to: %s" % (pipeline, outputPath))
+		samplesNumber = 0
+		with columnar.ColumnarWriter(outputPath, service) as writer:
+			for symbols, (points, strokeOffsets, sampleOffsets) in iterShards(dataset, shardSize):
+				points, strokeOffsets, sampleOffsets, kept = applyPipelineBatch(pipeline, points, strokeOffsets, sampleOffsets)
+				symbols = [ symbol for symbol, isKept in zip(symbols, kept.tolist()) if isKept ]
+				writer.appendArrays(symbols, points, strokeOffsets, sampleOffsets)
+				samplesNumber += len(kept)
+		print('Kept %d samples out of %d.' % (writer.samplesNumber, samplesNumber))
+		return writer.samplesNumber
+	except Exception:
+		print('\nFailure happened while preprocessing a dataset:\n')
+		print(traceback.format_exc())
+		return 0
+
+
+# Yields the shards of the given dataset, as couples (symbols, (points, strokeOffsets, sampleOffsets)).
+# Contiguous shards of a columnar dataset are views of its arrays, other datasets samples being converted.
+def iterShards(dataset, shardSize):
+	import columnar
+	if isinstance(dataset, columnar.ColumnarDataset) and np.all(np.diff(dataset.ranks) == 1):
+		for first in range(0, len(dataset), shardSize):
+			shard = dataset[first:first + shardSize]
+			symbols = [ shard.symbols[label] for label in shard.getLabels().tolist() ]
+			sampleOffsets = shard.sampleOffsets[shard.ranks[0]:shard.ranks[-1] + 2]
+			strokeOffsets = shard.strokeOffsets[sampleOffsets[0]:sampleOffsets[-1] + 1]
+			points = shard.points[strokeOffsets[0]:strokeOffsets[-1]]
+			yield (symbols, (points, strokeOffsets - strokeOffsets[0], sampleOffsets - sampleOffsets[0]))
+		return
+	samples = iter(dataset)
+	while True:
+		shard = list(itertools.islice(samples, shardSize))
+		if len(shard) == 0:
+			return
+		strokesList = [ json.loads(strokes) if type(strokes) == str else strokes for symbol, strokes in shard ]
+		yield ([ symbol for symbol, strokes in shard ], formatter.strokesListToArrays(strokesList))
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3 or sys.argv[2] not in pipelinesConfig:
+		print('Please give as args a service name, a pipeline name, and optionally a dataset path.'
+			'\n- Supported pipelines: %s' % ', '.join(pipelinesConfig.keys()))
+		exit()
+	import loader
+	datasetPath = sys.argv[3] if len(sys.argv) > 3 else loader.getDefaultDatasetPath(sys.argv[1])
+	preprocessDataset(sys.argv[1], datasetPath, sys.argv[2])
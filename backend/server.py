@@ -1,11 +1,12 @@
-import os, traceback, json
+import os, time, traceback, json, gzip, hashlib, threading, mimetypes
 from flask import Flask, request, Response, redirect, jsonify, send_from_directory, send_file
 from flask_cors import CORS
 import requests
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # Backend code:
-import loader, formatter, mappings
+import loader, formatter, mappings, services, cache, preprocessing, assets, ensemble
 
 frontendPath = Path('../frontend/')
 libsFrontendPath = Path('../libs-frontend/')
@@ -97,6 +98,59 @@ def extractRequestData(request):
 		print('Failed to extract a request data.\n\n' + traceback.format_exc())
 		return None
 
+# Responses of static endpoints, built once, serialized and gzipped, along with a strong ETag for each encoding.
+# Each one depends on some source files, and is rebuilt once any of them has changed (mtime or size). Loaded
+# symbols and mappings are then forgotten too, for the new response to be built from the files content.
+class StaticResponse:
+	def __init__(self, content, signature):
+		self.content = content # bytes
+		self.gzipped = gzip.compress(content, compresslevel=9)
+		digest = hashlib.sha256(content).hexdigest()[:32]
+		self.etags = {'identity': digest, 'gzip': digest + '-gzip'}
+		self.signature = signature # tuple
+
+_staticResponsesLoader = {}
+_staticResponsesLock = threading.Lock()
+
+
+def getFilesSignature(paths):
+	''' Returns the (mtime, size) of each given file, None for missing ones. '''
+	signature = []
+	for path in paths:
+		try:
+			fileStat = os.stat(path)
+			signature.append((fileStat.st_mtime_ns, fileStat.st_size))
+		except OSError:
+			signature.append(None)
+	return tuple(signature)
+
+
+def sendStaticResponse(key, sourcePaths, buildData):
+	''' Sends the JSON response of 'buildData()', built once for the given key and as long as the source files are unchanged. '''
+	''' Answers 304 when the client already has it, and gzipped when the client accepts it. '''
+	signature = getFilesSignature(sourcePaths)
+	staticResponse = _staticResponsesLoader.get(key)
+	if staticResponse is None or staticResponse.signature != signature:
+		with _staticResponsesLock:
+			staticResponse = _staticResponsesLoader.get(key)
+			if staticResponse is None or staticResponse.signature != signature:
+				if staticResponse is not None: # a source file changed.
+					loader.forgetSymbolsData()
+					mappings.forgetMappings()
+				staticResponse = StaticResponse(jsonify(buildData()).get_data(), signature)
+				_staticResponsesLoader[key] = staticResponse
+	encoding = 'gzip' if 'gzip' in request.accept_encodings else 'identity'
+	if any(request.if_none_match.contains(etag) for etag in staticResponse.etags.values()):
+		response = Response(status=304)
+	else:
+		response = Response(staticResponse.gzipped if encoding == 'gzip' else staticResponse.content, mimetype='application/json')
+		if encoding == 'gzip':
+			response.headers['Content-Encoding'] = 'gzip'
+	response.set_etag(staticResponse.etags[encoding])
+	response.headers['Cache-Control'] = 'no-cache' # the client must check with the ETag that its copy is still valid.
+	response.headers['Vary'] = 'Accept-Encoding'
+	return response
+
 ##################################################
 # TeXdrawer specific functions:
 
@@ -106,7 +160,7 @@ def serveFrontendLibsDir(dirPath='.'):
 	''' Returns the list of files and directories from any directory in 'libs-frontend', given its relative path. '''
 	try:
 		assert '..' not in dirPath, 'Path must not contain double dots!' # just to be sure.
-		return jsonify(os.listdir(libsFrontendPath / dirPath))
+		return jsonify(assets.listDirectory(libsFrontendPath / dirPath))
 	except Exception as e:
 		return handleError("Error from serveFrontendLibsDir(): directory '%s' not found." % dirPath, 404)
 
@@ -114,9 +168,17 @@ def serveFrontendLibsDir(dirPath='.'):
 @app.route('/libs-frontend-file/<path:filePath>', methods=['GET'])
 def serveFrontendLibsFile(filePath):
 	''' Returns any file from the 'libs-frontend' directory, given its relative path. Works in sub directories too. '''
+	''' Its precompressed variant is sent if accepted by the client, see assets.py. Range requests are supported. '''
 	try:
 		assert '..' not in filePath, 'Path must not contain double dots!' # just to be sure.
-		return send_file(str(libsFrontendPath / filePath))
+		path, encoding = assets.getServedFile(libsFrontendPath, filePath, request.accept_encodings)
+		mimetype = mimetypes.guess_type(filePath)[0] or 'application/octet-stream'
+		response = send_file(str(path), mimetype=mimetype, conditional=True, cache_timeout=assets.assetsCacheTimeout)
+		if encoding is not None and response.status_code != 304:
+			response.headers['Content-Encoding'] = encoding
+		response.cache_control.public = True
+		response.headers['Vary'] = 'Accept-Encoding'
+		return response
 	except Exception as e:
 		return handleError("Error from serveFrontendLibsFile(): file '%s' not found." % filePath, 404)
 
@@ -125,18 +187,24 @@ def serveFrontendLibsFile(filePath):
 def serveLatexToUnicodeMap():
 	''' Sends a map to convert latex commands to unicode values. '''
 	try:
-		return jsonify(loader.getLatexToUnicodeMap())
+		return sendStaticResponse('latex-to-unicode', [loader.latexToUnicodePath], loader.getLatexToUnicodeMap)
 	except Exception as e:
 		return handleError('Unknown error in serveLatexToUnicodeMap().', 500)
 
 
 @app.route('/services-and-mappings', methods=['GET'])
 def serveServicesAndMappingsList():
-	''' Returns the lists of supported services and mappings. '''
+	''' Returns the lists of supported services and mappings, and the live health of each service, '''
+	''' see services.ServiceHealth. An ensemble is available while any of its services is. '''
 	try:
+		health = services.getServicesHealth()
+		health['ensemble'] = {'state': 'ensemble', 'available': any(health[member]['available']
+			for member in ensemble.getMembers('ensemble'))}
 		return jsonify({
-			'services': loader.getSupportedServices(),
-			'mappings': loader.getSupportedMappings()
+			'services': [ service for service in loader.getSupportedServices() if service not in services.localServicesConfig
+				or health[service]['available'] ], # local services only once ready.
+			'mappings': loader.getSupportedMappings(),
+			'health': health
 		})
 	except Exception as e:
 		return handleError('Unknown error in serveServicesAndMappingsList().', 500)
@@ -146,7 +214,10 @@ def serveServicesAndMappingsList():
 def serveMapping(mapping):
 	''' Returns the equivalence classes for the given mapping. '''
 	try:
-		return jsonify(mappings.getMapping(mapping).classes)
+		mappingPath = loader.mappingsDir / ('%s.json' % mapping)
+		if not mappingPath.exists():
+			mapping = 'none' # same fallback as getMapping(), for unknown mappings to share the same response.
+		return sendStaticResponse(('mapping', mapping), [mappingPath], lambda : mappings.getMapping(mapping).classes)
 	except Exception as e:
 		return handleError('Unknown error in serveMapping().', 500)
 
@@ -157,20 +228,32 @@ def serveProjectedSymbols(service, mapping='none'):
 	''' Returns the sorted list of supported symbols and their unicode, for the given service. '''
 	''' If a mapping is given, then the projected symbols are returned. '''
 	try:
-		latexToUnicodeMap = loader.getLatexToUnicodeMap()
-		projectedSymbols = mappings.getServiceProjectedSymbolsSorted(service, mapping)
-		data = []
-		for symbol in projectedSymbols:
-			data.append({
-				'symbol_class': symbol,
-				'unicode': loader.getSymbolUnicode(symbol),
-				'package': '',
-			})
-		return jsonify(data)
+		if service not in loader.getSupportedServices():
+			return handleError("Unsupported service '%s' in serveProjectedSymbols()." % service, 404)
+		mappingPath = loader.mappingsDir / ('%s.json' % mapping)
+		if not mappingPath.exists():
+			mapping = 'none' # same fallback as getMapping().
+		names = loader.getSymbolsListsNames(service)
+		sourcePaths = [ loader.symbolsListsDir / (name + '.txt') for name in names ] + [mappingPath, loader.latexToUnicodePath]
+		return sendStaticResponse(('symbols', service, mapping, tuple(names)), sourcePaths,
+			lambda : getProjectedSymbolsData(service, mapping))
 	except Exception as e:
 		return handleError('Unknown error in serveProjectedSymbols().', 500)
 
 
+def getProjectedSymbolsData(service, mapping):
+	latexToUnicodeMap = loader.getLatexToUnicodeMap()
+	projectedSymbols = mappings.getServiceProjectedSymbolsSorted(service, mapping)
+	data = []
+	for symbol in projectedSymbols:
+		data.append({
+			'symbol_class': symbol,
+			'unicode': latexToUnicodeMap.get(symbol, 'U+0'), # see loader.getSymbolUnicode()
+			'package': '',
+		})
+	return data
+
+
 @app.route('/classify', methods=['POST'])
 def serveClassifyRequest():
 	''' Serves the result of a classification request to a chosen service: '''
@@ -182,7 +265,8 @@ def serveClassifyRequest():
 		mapping = receivedInput['mapping'] if 'mapping' in receivedInput else 'none'
 		bound = receivedInput['bound'] if 'bound' in receivedInput else 0
 		pretty = receivedInput['pretty'] if 'pretty' in receivedInput else False
-		answers, status = classifyRequest(service, mapping, strokes, bound=bound, pretty=pretty)
+		pipeline = receivedInput['preprocessing'] if 'preprocessing' in receivedInput else None
+		answers, status = classifyRequest(service, mapping, strokes, bound=bound, pretty=pretty, pipeline=pipeline)
 		if status != 200:
 			return handleError('Failure from classifyRequest().', status)
 		return jsonify(answers)
@@ -190,31 +274,130 @@ def serveClassifyRequest():
 		return handleError('Unknown error in serveClassifyRequest().', 500)
 
 
-def classifyRequest(service, mapping, strokes, bound=0, pretty=False):
-	''' Sends a classification request to the chosen service. See aggregateAnswers() for args details. '''
+@app.route('/cache-stats', methods=['GET'])
+def serveCacheStats():
+	''' Returns the hit/miss counters of the service answers cache. '''
 	try:
-		formattedRequest = formatter.formatRequest(service, strokes)
-		if service == 'hwrt':
-			# url = 'http://write-math.com/worker' # website - fails
-			url = 'http://localhost:5000/worker' # local
-			response = requests.post(url=url, headers={}, data=formattedRequest)
-		elif service == 'detexify':
-			# url = 'http://detexify.kirelabs.org/api/classify' # website - fails (old version)
-			url = 'http://localhost:3000/classify' # local (from branch 'stack')
-			response = requests.post(url=url, headers={}, json=formattedRequest)
-		else:
-			print('Unsupported service:', service)
+		return jsonify(cache.getAnswersCache().getStats())
+	except Exception as e:
+		return handleError('Unknown error in serveCacheStats().', 500)
+
+
+@app.route('/classify/batch', methods=['POST'])
+def serveClassifyBatchRequest():
+	''' Serves the results of several classification requests, given as a list of samples. '''
+	''' Results are returned in the same order, a failed sample having an error instead of answers. '''
+	try:
+		receivedInput = extractRequestData(request)
+		service = receivedInput['service']
+		samples = receivedInput['samples']
+		pretty = receivedInput['pretty'] if 'pretty' in receivedInput else False
+		return jsonify(classifyBatchRequest(service, samples, pretty=pretty))
+	except Exception as e:
+		return handleError('Unknown error in serveClassifyBatchRequest().', 500)
+
+
+def classifyRequest(service, mapping, strokes, bound=0, pretty=False, pipeline=None):
+	''' Sends a classification request to the chosen service. See aggregateAnswers() and guessToJson() for args details. '''
+	''' If a preprocessing 'pipeline' is given, strokes are preprocessed before being sent, see preprocessing.py. '''
+	''' The service can also be 'ensemble' or a list of services, whose answers are then fused, see ensemble.py. '''
+	if ensemble.isEnsemble(service):
+		return classifyEnsembleRequest(service, mapping, strokes, bound, pretty, pipeline)
+	strokes, status = preprocessRequestStrokes(strokes, pipeline)
+	if status != 200:
+		return ([], status)
+	vanillaAnswers, status = classifyVanillaRequest(service, strokes)
+	if status != 200:
+		return ([], status)
+	answers = formatter.aggregateAnswers(service, mapping, vanillaAnswers, bound=bound)
+	return (formatter.guessesToJson(service, answers, pretty=pretty), 200)
+
+
+def classifyEnsembleRequest(service, mapping, strokes, bound=0, pretty=False, pipeline=None):
+	''' Same as classifyRequest(), the strokes being sent concurrently to each service of the ensemble. '''
+	try:
+		members = ensemble.getMembers(service)
+	except ValueError as e:
+		print(e)
+		return ([], 400)
+	memberAnswers, status = ensemble.classifyVanillaRequests(strokes, members, pipeline)
+	if status != 200:
+		return ([], status)
+	answers = ensemble.fuseAnswers(memberAnswers, mapping, bound=bound)
+	return (formatter.guessesToJson('ensemble', answers, pretty=pretty), 200)
+
+
+def classifyVanillaRequest(service, strokes, timings=None):
+	''' Sends a classification request to the chosen service, and returns its answers without any mapping, as formatter.Guess. '''
+	''' If a 'timings' dict is given, the durations of the request phases are set in it, see ServiceClient.classify(). '''
+	''' It stays empty when answers are cached. '''
+	try:
+		client = services.getClient(service)
+		if client is None:
 			return ([], 404)
-		answers = formatter.extractServiceAnswer(service, response.json())
-		answers = formatter.aggregateAnswers(service, mapping, answers, bound=bound, pretty=pretty)
+		answersCache = cache.getAnswersCache()
+		strokesHash = cache.getStrokesHash(service, strokes)
+		answers = answersCache.get(strokesHash)
+		if answers is None:
+			rawAnswer = client.classify(strokes, timings)
+			extractionStart = time.perf_counter()
+			answers = formatter.extractServiceAnswer(service, rawAnswer)
+			if timings is not None:
+				timings['extraction'] = time.perf_counter() - extractionStart
+			if answers != []: # not caching invalid answers.
+				answersCache.put(strokesHash, answers)
 		return (answers, 200)
+	except services.CircuitOpenError:
+		return ([], 503) # service known to be down, failing fast.
+	except services.ServiceUnavailableError as e:
+		print("\n-> '%s' service not ready: %s\n" % (service, e))
+		return ([], 503)
 	except Exception as e:
 		print("\n-> '%s' service seems not available.\n" % service)
 		# print(traceback.format_exc())
 		return ([], 500)
 
 
+def preprocessRequestStrokes(strokes, pipeline):
+	''' Returns the strokes preprocessed with the given pipeline name, in the hwrt format sent to all services. Strokes discarded '''
+	''' by the pipeline, or an unknown pipeline, give a 400 status. '''
+	if pipeline is None or pipeline == 'none':
+		return (strokes, 200)
+	if pipeline not in preprocessing.pipelinesConfig:
+		print('Unsupported preprocessing pipeline:', pipeline)
+		return ([], 400)
+	try:
+		strokes = preprocessing.preprocessStrokes(strokes, pipeline)
+		return (strokes, 200) if strokes is not None else ([], 400)
+	except Exception as e:
+		print('Failed to preprocess some strokes.\n\n' + traceback.format_exc())
+		return ([], 400)
+
+
+batchWorkersNumber = 8 # max number of concurrent requests sent by a batch.
+_batchExecutor = ThreadPoolExecutor(max_workers=batchWorkersNumber)
+
+def classifyBatchRequest(service, samples, pretty=False):
+	''' Classifies concurrently a list of samples, each being a dict with keys 'strokes', and optionally '''
+	''' 'mapping', 'bound' and 'preprocessing'. Returns for each sample, in the input order, either its answers or an error. '''
+	def classifySample(sample):
+		try:
+			strokes = sample['strokes']
+			mapping = sample['mapping'] if 'mapping' in sample else 'none'
+			bound = sample['bound'] if 'bound' in sample else 0
+			pipeline = sample['preprocessing'] if 'preprocessing' in sample else None
+		except Exception as e:
+			return {'status': 400, 'error': "Invalid sample, 'strokes' are required."}
+		answers, status = classifyRequest(service, mapping, strokes, bound=bound, pretty=pretty, pipeline=pipeline)
+		if status != 200:
+			return {'status': status, 'error': "Classification failed for service '%s'." % service}
+		return {'status': 200, 'answers': answers}
+	return list(_batchExecutor.map(classifySample, samples)) # map() keeps the input order.
+
+
 # Set debug=True to not have to restart the server for code changes
 # to take effects. Careful though, this can cause security issues!
 if __name__ == '__main__':
+	assets.startPrecompression(libsFrontendPath)
+	services.startHealthChecks()
 	app.run(host='0.0.0.0', port=5050, debug=False) # '0.0.0.0' works both with and without docker.
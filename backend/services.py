@@ -0,0 +1,304 @@
+import time, threading
+from collections import deque
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Backend code:
+import formatter
+
+
+# Settings of each supported remote service. Timeouts are in seconds, and
+# 'backoffFactor' sets the delay between retries: backoffFactor * 2^(retry - 1).
+servicesConfig = {
+	'hwrt': {
+		# 'url': 'http://write-math.com/worker', # website - fails
+		'url': 'http://localhost:5000/worker', # local
+		'healthUrl': 'http://localhost:5000/worker', # answers its version to GET requests.
+		'sendAsJson': False, # form-encoded data.
+		'connectTimeout': 2.,
+		'readTimeout': 10.,
+		'retries': 2,
+		'backoffFactor': 0.1,
+		'poolConnections': 1,
+		'poolMaxSize': 16,
+	},
+	'detexify': {
+		# 'url': 'http://detexify.kirelabs.org/api/classify', # website - fails (old version)
+		'url': 'http://localhost:3000/classify', # local (from branch 'stack')
+		'healthUrl': 'http://localhost:3000/',
+		'sendAsJson': True,
+		'connectTimeout': 2.,
+		'readTimeout': 10.,
+		'retries': 2,
+		'backoffFactor': 0.1,
+		'poolConnections': 1,
+		'poolMaxSize': 16,
+	},
+}
+
+
+# Settings of each local service, running inside the backend process. See the client class of each one:
+localServicesConfig = {
+	'knn': {
+		'datasetService': 'hwrt',
+		'pointsNumber': 32,
+		'metric': 'dtw',
+		'window': 3,
+		'neighboursNumber': 30,
+	},
+}
+
+
+# Health tracking of the remote services, by a circuit breaker for each one. After 'failureThreshold' consecutive
+# failed requests (connection errors, timeouts or 5xx answers, once retries are exhausted), the circuit opens:
+# requests then fail at once with a CircuitOpenError, instead of each one waiting for the failure. Once 'openDuration'
+# seconds have passed, or once a health check succeeds, the circuit is half-open: a single request is let through
+# as a probe, closing the circuit if it succeeds, and opening it again otherwise. Health checks are GET requests
+# sent to the 'healthUrl' of each service every 'checkInterval' seconds by a background thread, any answer below
+# 500 meaning the service is up. They are only run once started, see startHealthChecks().
+healthConfig = {
+	'failureThreshold': 5,
+	'openDuration': 10., # in seconds.
+	'checkInterval': 5., # in seconds.
+	'checkTimeout': 1., # in seconds.
+	'latenciesNumber': 100, # number of recent requests latencies kept.
+}
+
+
+class CircuitOpenError(Exception):
+	pass
+
+
+# Raised by a local service which cannot classify yet, e.g the knn service while its index is not built:
+class ServiceUnavailableError(Exception):
+	pass
+
+
+class ServiceHealth:
+	def __init__(self, service, failureThreshold=5, openDuration=10., latenciesNumber=100, **settings):
+		self.service = service # str
+		self.failureThreshold = failureThreshold # int
+		self.openDuration = openDuration # float, in seconds
+		self.latencies = deque(maxlen=latenciesNumber) # recent successful requests latencies, in seconds
+		self.state = 'closed' # 'closed', 'open' or 'half-open'
+		self.failuresNumber = 0 # consecutive failures
+		self.openingTime = 0.
+		self.probeTime = None # start of the pending probe, if any
+		self.lastError = None # str
+		self.lastCheck = None # dict
+		self.counters = {'successes': 0, 'failures': 0, 'rejected': 0}
+		self.lock = threading.Lock()
+
+	# Whether a request can be sent to the service. Counts as the probe when the circuit is half-open.
+	def allowRequest(self):
+		with self.lock:
+			now = time.monotonic()
+			if self.state == 'closed':
+				return True
+			if self.state == 'open' and now - self.openingTime >= self.openDuration:
+				self.state = 'half-open'
+			# A probe never reported, e.g a cancelled request, is replaced after openDuration:
+			if self.state == 'half-open' and (self.probeTime is None or now - self.probeTime >= self.openDuration):
+				self.probeTime = now
+				return True
+			self.counters['rejected'] += 1
+			return False
+
+	# Whether the circuit is open, without counting as a request:
+	def isOpen(self):
+		with self.lock:
+			return self.state == 'open' and time.monotonic() - self.openingTime < self.openDuration
+
+	def recordSuccess(self, latency=None):
+		with self.lock:
+			if self.state != 'closed':
+				print("\n-> '%s' service is available again.\n" % self.service)
+			self.state, self.failuresNumber, self.probeTime = 'closed', 0, None
+			self.counters['successes'] += 1
+			if latency is not None:
+				self.latencies.append(latency)
+
+	def recordFailure(self, error):
+		with self.lock:
+			self.failuresNumber += 1
+			self.counters['failures'] += 1
+			self.lastError = '%s: %s' % (type(error).__name__, error)
+			if self.state == 'half-open' or (self.state == 'closed' and self.failuresNumber >= self.failureThreshold):
+				print("\n-> '%s' service seems not available, its requests will fail fast for %.1fs.\n"
+					% (self.service, self.openDuration))
+				self.state, self.openingTime, self.probeTime = 'open', time.monotonic(), None
+
+	# Records the result of a health check: a failure counts as a failed request, and a success
+	# lets a probe through at once if the circuit is open, the service being up again.
+	def recordCheck(self, latency, error=None):
+		with self.lock:
+			self.lastCheck = {'ok': error is None, 'latency_ms': round(1000. * latency, 3), 'time': time.time()}
+			if error is None and self.state == 'open':
+				self.state = 'half-open'
+		if error is not None:
+			self.recordFailure(error)
+
+	def getStatus(self):
+		with self.lock:
+			latencies = np.array(self.latencies, dtype=np.float64) * 1000.
+			status = {
+				'available': self.state != 'open',
+				'state': self.state,
+				'consecutive_failures': self.failuresNumber,
+				'last_error': self.lastError,
+				'last_check': self.lastCheck,
+				'latency_ms': { 'p%d' % q : round(float(np.percentile(latencies, q)), 3) if len(latencies) > 0 else None
+					for q in (50, 90, 99) },
+			}
+			status.update(self.counters)
+		return status
+
+
+_healthLoader = {}
+
+# Returns the health tracker of the given remote service, created on first use:
+def getHealth(service):
+	if service not in _healthLoader:
+		with _clientsLock:
+			if service not in _healthLoader:
+				_healthLoader[service] = ServiceHealth(service, **healthConfig)
+	return _healthLoader[service]
+
+
+# Health of each supported service. Local services are available once ready, see isLocalServiceReady().
+def getServicesHealth():
+	health = { service : getHealth(service).getStatus() for service in servicesConfig }
+	health.update({ service : {'available': isLocalServiceReady(service), 'state': 'local'} for service in localServicesConfig })
+	return health
+
+
+# Whether the given local service can classify, e.g the knn service once its index is built:
+def isLocalServiceReady(service):
+	client = getClient(service)
+	return client is not None and client.isReady()
+
+
+# Sends a GET request to the health URL of the given service, and records its result:
+def checkHealth(service):
+	start = time.perf_counter()
+	try:
+		response = requests.get(servicesConfig[service]['healthUrl'], timeout=healthConfig['checkTimeout'])
+		if response.status_code >= 500:
+			response.raise_for_status()
+		getHealth(service).recordCheck(time.perf_counter() - start)
+	except requests.RequestException as e:
+		getHealth(service).recordCheck(time.perf_counter() - start, e)
+
+
+_healthChecksThread = None
+
+# Starts the background health checks of the remote services, if not running yet.
+def startHealthChecks():
+	global _healthChecksThread
+	def checkLoop():
+		while True:
+			for service in list(servicesConfig):
+				checkHealth(service)
+			time.sleep(healthConfig['checkInterval'])
+	with _clientsLock:
+		if _healthChecksThread is None:
+			_healthChecksThread = threading.Thread(target=checkLoop, daemon=True)
+			_healthChecksThread.start()
+
+
+# Whether an error of a request shows that the service is failing, rather than the request being invalid:
+def isServiceFailure(statusCode):
+	return statusCode is None or statusCode >= 500
+
+
+# Client of a classification service. Connections are kept alive and pooled by a single
+# session, so that successive requests do not pay for a new TCP handshake each time.
+# Only connection errors and 502/503/504 answers are retried, with an exponential backoff.
+class ServiceClient:
+	def __init__(self, service, url, healthUrl=None, sendAsJson=False, connectTimeout=2., readTimeout=10.,
+		retries=2, backoffFactor=0.1, poolConnections=1, poolMaxSize=16):
+		self.service = service # str
+		self.url = url # str
+		self.healthUrl = healthUrl # str, see checkHealth()
+		self.sendAsJson = sendAsJson # bool
+		self.timeout = (connectTimeout, readTimeout)
+		retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoffFactor,
+			status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET', 'HEAD', 'POST']),
+			raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxSize,
+			max_retries=retry, pool_block=False)
+		self.session = requests.Session()
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	# Sends the given strokes to the service, and returns its raw JSON answer.
+	# Raises an exception on timeouts, connection failures or HTTP errors, and a CircuitOpenError
+	# at once if the service is known to be down, see ServiceHealth.
+	# If a 'timings' dict is given, the durations of the 'formatting' and 'request' phases are set in it.
+	def classify(self, strokes, timings=None):
+		start = time.perf_counter()
+		formattedRequest = formatter.formatRequest(self.service, strokes)
+		health = getHealth(self.service)
+		if not health.allowRequest():
+			raise CircuitOpenError(self.service)
+		requestStart = time.perf_counter()
+		try:
+			if self.sendAsJson:
+				response = self.session.post(url=self.url, json=formattedRequest, timeout=self.timeout)
+			else:
+				response = self.session.post(url=self.url, data=formattedRequest, timeout=self.timeout)
+			response.raise_for_status()
+			answer = response.json()
+		except Exception as e:
+			statusCode = e.response.status_code if isinstance(e, requests.HTTPError) else None
+			if isServiceFailure(statusCode):
+				health.recordFailure(e)
+			else:
+				health.recordSuccess()
+			raise
+		health.recordSuccess(time.perf_counter() - requestStart)
+		if timings is not None:
+			timings['formatting'] = requestStart - start
+			timings['request'] = time.perf_counter() - requestStart
+		return answer
+
+	def close(self):
+		self.session.close()
+
+
+_clientsLoader = {}
+_clientsLock = threading.Lock()
+
+# Returns the client of the given service, or None if the service is unsupported.
+# Clients are created once and shared, for their connections pool to be reused:
+def getClient(service):
+	if service in _clientsLoader:
+		return _clientsLoader[service]
+	if service not in servicesConfig and service not in localServicesConfig:
+		print('Unsupported service:', service)
+		return None
+	with _clientsLock: # a server may have several threads.
+		if service not in _clientsLoader:
+			_clientsLoader[service] = createClient(service)
+	return _clientsLoader[service]
+
+
+def createClient(service):
+	if service == 'knn':
+		import knn # imported here, for its index not to be loaded when the service is unused.
+		return knn.KnnClient(service, **localServicesConfig[service])
+	return ServiceClient(service, **servicesConfig[service])
+
+
+# Updates the settings of the given service. Its current client is closed, and
+# a new one will be created with those settings on the next getClient() call:
+def configureService(service, **settings):
+	if service not in servicesConfig and service not in localServicesConfig:
+		print('Unsupported service:', service)
+		return
+	with _clientsLock:
+		(servicesConfig if service in servicesConfig else localServicesConfig)[service].update(settings)
+		if service in _clientsLoader:
+			_clientsLoader.pop(service).close()